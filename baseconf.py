@@ -33,5 +33,65 @@ TRANSLATION_FEED_ATOM = None
 AUTHOR_FEED_ATOM = None
 AUTHOR_FEED_RSS = None
 
+# Rendered pages are cached on disk, keyed by a hash of all inputs, so that
+# unchanged pages are not rendered again. The size is in bytes.
+RENDER_CACHE_PATH = '.cache/render'
+RENDER_CACHE_SIZE = 256 * 1024 ** 2
+# The files that each page depends on, such as included exercises, are
+# recorded here. See plugins/dependencies.py for how to query this.
+DEPENDENCY_GRAPH_PATH = '.cache/dependencies.json'
+# Highlighted code is cached across builds, keyed by a hash of the code
+HIGHLIGHT_CACHE_PATH = '.cache/highlight.pickle'
+# The number of worker processes that render pages in parallel. Set to 1 to
+# render pages one by one in the main process.
+RENDER_PROCESSES = os.cpu_count() or 1
+# Figures are served as WebP, with the original format as fallback, at these
+# widths in pixels (if Pillow is installed). The resized images are cached.
+IMAGE_WIDTHS = [480, 960, 1440]
+IMAGE_CACHE_PATH = '.cache/images'
+# The ```python blocks of the pages in these folders (relative to PATH) are
+# executed during the build, and their output is inserted after them, for
+# example: ['pages/numerical']. See plugins/code_execution.py. The output is
+# cached, and the code of a page is stopped after the timeout in seconds.
+EXECUTE_CODE_BLOCKS = []
+CODE_EXECUTION_CACHE_PATH = '.cache/code.json'
+CODE_EXECUTION_TIMEOUT = 300
+
+# To profile the build, set BUILD_PROFILE to the path of a JSON report, for
+# example: BUILD_PROFILE=profile.json pelican -s pelicanconf.py. Tracing memory
+# allocations makes the build considerably slower.
+BUILD_PROFILE = os.environ.get('BUILD_PROFILE')
+BUILD_PROFILE_ALLOCATIONS = True
+
+# With 'inline', the mega menu (generated by build-menu.py) is part of every
+# page. With 'json', it is downloaded once as JSON, and rendered by
+# mega-menu.js, and pages only contain a minimal fallback menu.
+MENU_MODE = 'json'
+
+# Minify the generated HTML, and inline the CSS rules that each page uses,
+# so that the stylesheets can be loaded without blocking the first paint.
+# See plugins/html_optimize.py. Elements that are created by scripts are not
+# in the generated HTML, so the classes that they use are listed here.
+OPTIMIZE_HTML = True
+CRITICAL_CSS_SAFELIST = [
+    '.dropdown', '.mega-dropdown', '.dropdown-toggle', '.dropdown-menu',
+    '.mega-dropdown-menu', '.dropdown-header', '.row', '.col-sm-3',
+    '.glyphicon', '.glyphicon-menu-down', '.open', '.exercise-pending',
+    '.exercises_progress', '.exercises_reset', '.all_solved', '.btn',
+    '.btn-default', '.solved', '.incorrect', '.output',
+    ]
+
+# Pages link to the pages before and after them in the same section of
+# sitemap.yaml, and the browser is asked to fetch the next page in advance.
+# With SPECULATION_RULES, browsers that support it are also allowed to
+# prefetch it. See plugins/page_hierarchy.py and prefetch.html.
+PREFETCH_NEXT_PAGE = True
+SPECULATION_RULES = False
+
+# Generate a service worker (output/sw.js) that caches the site in the
+# browser, so that it also works offline, and register it on every page. See
+# plugins/service_worker.py.
+SERVICE_WORKER = True
+
 DEFAULT_PAGINATION = 5
 SUMMARY_MAX_LENGTH = 250
@@ -0,0 +1,471 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+"""
+Times the stages of the site build on synthetic content trees of increasing
+size, so that the scaling of each stage can be followed as the site grows.
+For each size, a content tree is generated in a temporary folder, with a
+sitemap.yaml of configurable depth, pages with links, code blocks and
+included exercises, and translations of some of the pages. The following
+stages are then timed separately:
+
+- sitemap: parsing sitemap.yaml
+- build_menu, build_live_sitemap: the outputs of build-menu.py
+- process_links: the table of internal links
+- reader: AcademicMarkdownReader.read() for all pages, with empty caches
+- set_relationships: the page_hierarchy plugin
+- inject_constants, seo_sitemap, optimize_html, fingerprint,
+  service_worker: the stages of parse-theme.py, each on a fresh output
+  folder, and again when nothing changed. parse_theme is their total.
+  The output folder contains a generated page for every page, and the
+  theme's stylesheets.
+
+Every size runs in a fresh process, so that caches that are kept in memory
+don't carry over from one size to the next. The reader is skipped if
+academicmarkdown or Pelican cannot be imported.
+
+Results can be saved as a baseline, and later runs are compared against it:
+
+    # Record a baseline
+    python3 benchmarks/build.py --pages 100 1000 10000 --save
+    # Fail (exit status 1) if a stage became more than 20% slower
+    python3 benchmarks/build.py --pages 100 1000 10000 --max-slowdown 0.2
+
+Run from the root of the repository.
+"""
+
+import os
+import sys
+import time
+import json
+import random
+import shutil
+import argparse
+import tempfile
+import contextlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import yaml
+REPO = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.join(REPO, 'plugins'))
+import sitemap
+
+DEFAULT_BASELINE_PATH = os.path.join(REPO, 'benchmarks', 'baseline.json')
+SITEURL = 'https://pythontutorials.eu'
+# The stages of parse-theme.py
+PARSE_THEME_STAGES = ['inject_constants', 'seo_sitemap', 'optimize_html',
+                      'fingerprint', 'service_worker', 'parse_theme']
+STAGES = ['sitemap', 'build_menu', 'build_live_sitemap', 'process_links',
+          'reader', 'set_relationships'] + [
+          stage + suffix for suffix in ('', ' (unchanged)')
+          for stage in PARSE_THEME_STAGES]
+PAGE_TEMPLATE = '''<!DOCTYPE html>
+<html lang="%(lang)s">
+<head>
+<title>%(title)s</title>
+<link href="/theme/css/mega-menu.css" rel="stylesheet">
+<link href="/theme/css/bootstrap.min.css" rel="stylesheet">
+<link href="/theme/css/monokai.css" rel="stylesheet">
+</head>
+<body>
+<div class="container">
+<div class="row">
+<div class="col-md-12">
+<section id="content" class="body">
+%(content)s
+</section>
+</div>
+</div>
+</div>
+<script src="/theme/js/script-0.js"></script>
+</body>
+</html>
+'''
+# Differences below this many seconds are considered noise
+NOISE = .005
+
+
+class Corpus:
+
+    """A synthetic content tree. Pages are spread over the leaves of a tree
+    of sections that is depth levels deep, and every page has a unique
+    name, so that it can be linked to by name."""
+
+    def __init__(self, folder, n_pages, depth=2, links=10, code=5,
+                 includes=1, translations=.1, seed=0):
+
+        self.folder = folder
+        self.n_pages = n_pages
+        self.depth = depth
+        self.n_links = links
+        self.n_code = code
+        self.n_includes = includes
+        self.translations = translations
+        self._random = random.Random(seed)
+        # The number of subsections per section, such that there are
+        # roughly as many leaves as pages at the deepest level
+        self.fanout = max(2, int(round(n_pages ** (1. / (depth + 1)))))
+        self.entries = []
+        self.tree = self._section([], iter(range(n_pages)), depth)
+
+    def _section(self, path, counter, depth):
+
+        tree = {}
+        if depth == 0:
+            for i in range(self.fanout):
+                n = next(counter, None)
+                if n is None:
+                    break
+                entry = '/'.join(path + ['p%d' % n])
+                self.entries.append(entry)
+                tree['Page %d' % n] = entry
+            return tree
+        for i in range(self.fanout):
+            name = 's%d' % i
+            subtree = self._section(path + [name], counter, depth - 1)
+            if subtree:
+                tree['Section %s' % '.'.join(path + [name])] = subtree
+        # Pages that don't fit in the leaves are added at the top level
+        if not path:
+            remaining = list(counter)
+            if remaining:
+                tree['More'] = {'Page %d' % n: 'p%d' % n for n in remaining}
+                self.entries += ['p%d' % n for n in remaining]
+        return tree
+
+    def page(self, entry):
+
+        name = entry.split('/')[-1]
+        lines = ['title: Page %s' % name, '', '', '## Introduction', '']
+        for i in range(self.n_links):
+            target = self._random.choice(self.entries).split('/')[-1]
+            kind = ('link', 'url')[i % 2]
+            lines.append('A sentence that refers to %%%s:%s%%, with some more '
+                         'text to make it a paragraph of typical length.'
+                         % (kind, target))
+            lines.append('')
+        for i in range(self.n_code):
+            lines += [
+                '```python', 'import numpy as np',
+                'x = np.arange(%d)' % i,
+                'for i in range(x.size):',
+                '    print(\'%s\', i, x[i] ** 2)' % name, '```', ''
+                ]
+        for i in range(self.n_includes):
+            lines += ['### Exercise %d' % i, '',
+                      '%%-- include: exercises/%s-%d.md --%%' % (entry, i), '']
+        return '\n'.join(lines)
+
+    def exercise(self, entry, i):
+
+        return ('Write a function that computes the square of %d numbers.\n\n'
+                '```python\nprint(%d ** 2)\n```\n' % (i + 1, i))
+
+    def html(self, entry, lang='en'):
+
+        """A stand-in for the page as Pelican generates it, with the
+        paragraphs and code blocks of page() as HTML."""
+
+        parts = []
+        for block in self.page(entry).split('\n\n')[1:]:
+            block = block.strip()
+            if block.startswith('## '):
+                parts.append('<h2>%s</h2>' % block[3:])
+            elif block.startswith('```'):
+                parts.append('<div class="highlight"><pre><code>%s</code>'
+                             '</pre></div>' % block.strip('`')[6:])
+            elif block:
+                parts.append('<p class="lead">%s</p>' % block)
+        return PAGE_TEMPLATE % {'lang': lang, 'title': entry,
+                                'content': '\n'.join(parts)}
+
+    def write(self):
+
+        with open(os.path.join(self.folder, 'sitemap.yaml'), 'w') as fd:
+            yaml.dump(self.tree, fd, default_flow_style=False,
+                      sort_keys=False)
+        shutil.copy(os.path.join(REPO, 'constants.yaml'), self.folder)
+        n_translations = int(len(self.entries) * self.translations)
+        for n, entry in enumerate(self.entries):
+            self._write('content/pages/%s.md' % entry, self.page(entry))
+            self._write('output/%s/index.html' % entry, self.html(entry))
+            for i in range(self.n_includes):
+                self._write('exercises/%s-%d.md' % (entry, i),
+                            self.exercise(entry, i))
+            if n < n_translations:
+                name = entry.split('/')[-1]
+                self._write('content/pages/%s-nl.md' % entry,
+                            'lang: nl\nslug: %s\n' % name + self.page(entry))
+                self._write('output/%s-nl/index.html' % entry,
+                            self.html(entry, 'nl'))
+        # The service worker template and the theme's stylesheets, which
+        # parse-theme.py reads
+        os.makedirs(os.path.join(self.folder, 'themes/cogsci'))
+        shutil.copy(os.path.join(REPO, 'themes/cogsci/service-worker.js'),
+                    os.path.join(self.folder, 'themes/cogsci'))
+        shutil.copytree(os.path.join(REPO, 'themes/cogsci/static/css'),
+                        os.path.join(self.folder, 'output/theme/css'))
+        # The theme's JavaScript is copied to the output for every build. We
+        # generate one file per ten pages, which is more than the real theme
+        # has, but shows how parse-theme.py scales.
+        with open(os.path.join(self.folder, 'constants.yaml')) as fd:
+            const = yaml.load(fd, Loader=yaml.SafeLoader)
+        placeholders = ' '.join('$%s$' % var for var in const)
+        for i in range(max(10, self.n_pages // 10)):
+            self._write('output/theme/js/script-%d.js' % i,
+                        'var constants = "%s";\n' % placeholders
+                        + 'function f(x) { return x * 2; }\n' * 200)
+
+    def source_paths(self):
+
+        paths = []
+        for dirname, dirnames, filenames in os.walk(
+                os.path.join(self.folder, 'content')):
+            dirnames.sort()
+            paths += [os.path.join(dirname, basename)
+                      for basename in sorted(filenames)]
+        return paths
+
+    def _write(self, path, content):
+
+        path = os.path.join(self.folder, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as fd:
+            fd.write(content)
+
+
+class Page:
+
+    """A stand-in for a Pelican page, with only the attributes that
+    page_hierarchy uses."""
+
+    settings = {'DEFAULT_LANG': 'en'}
+
+    def __init__(self, corpus, source_path):
+
+        relpath = os.path.relpath(source_path,
+                                  os.path.join(corpus.folder, 'content/pages'))
+        path = relpath[:-3]
+        self.source_path = source_path
+        if path.endswith('-nl'):
+            path = path[:-3]
+            self.lang = 'nl'
+            self.url = 'pages/%s-nl/' % path
+            self.save_as = '%s-nl/index.html' % path
+        else:
+            self.lang = 'en'
+            self.url = 'pages/%s/' % path
+            self.save_as = '%s/index.html' % path
+        self.slug = os.path.basename(path)
+
+
+class Generator:
+
+    def __init__(self, pages):
+
+        self.pages = [page for page in pages if page.lang == 'en']
+        self.translations = [page for page in pages if page.lang != 'en']
+
+
+def timed(fnc, *args, repeat=1):
+
+    """Returns the shortest time in which fnc(*args) runs."""
+
+    best = None
+    for i in range(repeat):
+        t0 = time.perf_counter()
+        fnc(*args)
+        dt = time.perf_counter() - t0
+        best = dt if best is None else min(best, dt)
+    return best
+
+
+def load_script(path):
+
+    """Imports a script from the root of the repository, which cannot be
+    imported normally because its name contains a dash."""
+
+    import importlib.util
+    name = os.path.splitext(os.path.basename(path))[0].replace('-', '_')
+    spec = importlib.util.spec_from_file_location(name,
+                                                  os.path.join(REPO, path))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def time_parse_theme():
+
+    """Times the stages of parse-theme.py, first on the fresh output
+    folder, and then again, when nothing changed. All optional stages are
+    enabled."""
+
+    sys.path.insert(0, REPO)
+    parse_theme = load_script('parse-theme.py')
+    settings = dict(parse_theme.load_settings(), SITEURL=SITEURL,
+                    OUTPUT_PATH='output', PATH='content', OPTIMIZE_HTML=True,
+                    SERVICE_WORKER=True)
+    results = {}
+    for suffix in ('', ' (unchanged)'):
+        total = 0
+        for name, stage in parse_theme.stages(settings):
+            # The stages print every file that they process
+            with contextlib.redirect_stdout(None):
+                results[name + suffix] = dt = timed(stage)
+            total += dt
+        results['parse_theme' + suffix] = total
+    return results
+
+
+def time_reader(corpus):
+
+    sys.path.insert(0, REPO)
+    import importlib.util
+    try:
+        from pelican.settings import DEFAULT_CONFIG
+        spec = importlib.util.spec_from_file_location(
+            'cogsci_preprocess',
+            os.path.join(REPO, 'plugins', 'cogsci-preprocess.py'))
+        plugin = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(plugin)
+    except ImportError as e:
+        print('skipping reader: %s' % e)
+        return None
+    settings = dict(DEFAULT_CONFIG, PATH=os.path.join(corpus.folder, 'content'))
+    plugin.init_academicmarkdown(None)
+    reader = plugin.AcademicMarkdownReader(settings)
+    paths = corpus.source_paths()
+    t0 = time.perf_counter()
+    for path in paths:
+        reader.read(path)
+    return time.perf_counter() - t0
+
+
+def run(options):
+
+    """Generates a corpus and times all stages. This is called in a fresh
+    process for every size."""
+
+    n_pages, args = options
+    folder = tempfile.mkdtemp(prefix='benchmark-')
+    cwd = os.getcwd()
+    try:
+        corpus = Corpus(folder, n_pages, args['depth'], args['links'],
+                        args['code'], args['includes'], args['translations'])
+        corpus.write()
+        # The plugins use paths that are relative to the root of the site
+        os.chdir(folder)
+        results = {}
+        with open('sitemap.yaml') as fd:
+            source = fd.read()
+        repeat = args['repeat']
+        results['sitemap'] = timed(sitemap.orderedLoad, source, repeat=repeat)
+        tree = sitemap.orderedLoad(source)
+        pages = sitemap.flatten(tree)
+        results['build_menu'] = timed(sitemap.build_menu, tree, SITEURL,
+                                      repeat=repeat)
+        results['build_live_sitemap'] = timed(sitemap.build_live_sitemap,
+                                              tree, repeat=repeat)
+        results['process_links'] = timed(sitemap.process_links, pages,
+                                         repeat=repeat)
+        if 'reader' not in args['skip']:
+            results['reader'] = time_reader(corpus)
+        if 'set_relationships' not in args['skip']:
+            import page_hierarchy
+            source_paths = corpus.source_paths()
+
+            def set_relationships():
+                generator = Generator([Page(corpus, path)
+                                       for path in source_paths])
+                page_hierarchy.set_relationships(generator)
+            results['set_relationships'] = timed(set_relationships,
+                                                 repeat=repeat)
+        results.update(time_parse_theme())
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(folder)
+    return {stage: dt for stage, dt in results.items() if dt is not None}
+
+
+def compare(results, baseline, max_slowdown):
+
+    """Returns a list of messages for all stages that are more than
+    max_slowdown (a fraction) slower than the baseline."""
+
+    failures = []
+    for stage, sizes in results.items():
+        for size, dt in sizes.items():
+            reference = baseline.get(stage, {}).get(size)
+            if reference is None:
+                continue
+            if dt > reference * (1 + max_slowdown) and dt - reference > NOISE:
+                failures.append('%s (%s pages): %.3f s, baseline %.3f s'
+                                % (stage, size, dt, reference))
+    return failures
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description='Times the site build on synthetic content trees.')
+    parser.add_argument('--pages', type=int, nargs='+', default=[100, 1000],
+                        help='the number of pages of each corpus')
+    parser.add_argument('--depth', type=int, default=2,
+                        help='the depth of the sections in sitemap.yaml')
+    parser.add_argument('--links', type=int, default=10,
+                        help='the number of links per page')
+    parser.add_argument('--code', type=int, default=5,
+                        help='the number of code blocks per page')
+    parser.add_argument('--includes', type=int, default=1,
+                        help='the number of included exercises per page')
+    parser.add_argument('--translations', type=float, default=.1,
+                        help='the fraction of pages that is translated')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='the number of times that fast stages are run')
+    parser.add_argument('--skip', nargs='+', default=[],
+                        choices=['reader', 'set_relationships'],
+                        help='stages to skip')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE_PATH)
+    parser.add_argument('--save', action='store_true',
+                        help='save the results as the baseline')
+    parser.add_argument('--max-slowdown', type=float, default=.2,
+                        help='the allowed slowdown relative to the baseline')
+    args = parser.parse_args()
+    results = {}
+    context = multiprocessing.get_context(
+        'fork' if 'fork' in multiprocessing.get_all_start_methods()
+        else None)
+    for n_pages in args.pages:
+        with ProcessPoolExecutor(1, mp_context=context) as pool:
+            for stage, dt in pool.submit(run, (n_pages, vars(args))
+                                         ).result().items():
+                results.setdefault(stage, {})[str(n_pages)] = dt
+    print('%-30s %8s %12s %14s' % ('stage', 'pages', 'time (ms)',
+                                   'us per page'))
+    for stage in STAGES:
+        for size, dt in results.get(stage, {}).items():
+            print('%-30s %8s %12.2f %14.2f' % (stage, size, 1000 * dt,
+                                               1e6 * dt / int(size)))
+    if args.save:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as fd:
+                baseline = json.load(fd)
+        for stage, sizes in results.items():
+            baseline.setdefault(stage, {}).update(sizes)
+        with open(args.baseline, 'w') as fd:
+            json.dump(baseline, fd, indent=1, sort_keys=True)
+        print('Saved baseline to %s' % args.baseline)
+        return
+    if not os.path.exists(args.baseline):
+        return
+    with open(args.baseline) as fd:
+        baseline = json.load(fd)
+    failures = compare(results, baseline, args.max_slowdown)
+    for failure in failures:
+        print('slower than baseline: %s' % failure)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+"""
+Times link substitution on synthetic pages with an increasing number of
+%link%, %url% and %static% directives. The time per directive should stay
+roughly constant, which means that substitution scales linearly.
+
+Usage: python3 benchmarks/links.py
+"""
+
+import os
+import sys
+import time
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'plugins'))
+from link_substitution import substitute_links
+
+SITEURL = 'https://pythontutorials.eu'
+
+
+def synthetic_page(n_links, n_targets=100):
+
+    links = {'page%d' % i: 'section/page%d' % i for i in range(n_targets)}
+    paragraphs = []
+    for i in range(n_links):
+        kind = ('link', 'url', 'static')[i % 3]
+        target = 'page%d' % (i % n_targets) if kind != 'static' \
+            else 'data/file%d.csv' % i
+        paragraphs.append(
+            'Some text with a reference %%%s:%s%% and more text.'
+            % (kind, target))
+    return '\n\n'.join(paragraphs), links
+
+
+def main():
+
+    print('%10s %12s %16s' % ('links', 'time (ms)', 'us per link'))
+    for n_links in (100, 1000, 10000, 100000):
+        text, links = synthetic_page(n_links)
+        t0 = time.perf_counter()
+        substitute_links(text, links, SITEURL)
+        dt = time.perf_counter() - t0
+        print('%10d %12.2f %16.3f' % (n_links, 1000 * dt, 1e6 * dt / n_links))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+"""
+Times page_hierarchy.set_relationships() on synthetic page trees of 1k, 10k
+and 100k pages, of which a tenth are translations. The time per page should
+stay roughly constant, which means that the hierarchy is built in linear
+time.
+
+Usage: python3 benchmarks/page_hierarchy.py [n_pages ...]
+"""
+
+import os
+import sys
+import time
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'plugins'))
+from page_hierarchy import set_relationships
+
+SETTINGS = {'DEFAULT_LANG': 'en'}
+
+
+class Page:
+
+    settings = SETTINGS
+
+    def __init__(self, path, lang='en'):
+
+        self.slug = os.path.basename(path)
+        self.lang = lang
+        self.source_path = 'content/pages/%s.md' % path
+        if lang == SETTINGS['DEFAULT_LANG']:
+            self.url = 'pages/%s/' % path
+            self.save_as = '%s/index.html' % path
+        else:
+            self.url = 'pages/%s-%s/' % (path, lang)
+            self.save_as = '%s-%s/index.html' % (path, lang)
+
+
+class Generator:
+
+    def __init__(self, n_pages, fanout=10):
+
+        # Pages are laid out as a tree, in which each page has fanout children
+        paths = ['p0']
+        for i in range(1, n_pages):
+            paths.append('%s/p%d' % (paths[(i - 1) // fanout], i))
+        self.pages = [Page(path) for path in paths]
+        self.translations = [Page(path, 'nl') for path in paths[::10]]
+
+
+def main():
+
+    sizes = [int(arg) for arg in sys.argv[1:]] or [1000, 10000, 100000]
+    print('%10s %12s %16s' % ('pages', 'time (ms)', 'us per page'))
+    for n_pages in sizes:
+        generator = Generator(n_pages)
+        n_total = len(generator.pages) + len(generator.translations)
+        t0 = time.perf_counter()
+        set_relationships(generator)
+        dt = time.perf_counter() - t0
+        print('%10d %12.2f %16.3f' % (n_total, 1000 * dt, 1e6 * dt / n_total))
+
+
+if __name__ == '__main__':
+    main()
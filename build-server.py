@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+"""
+Builds the site, and then keeps running to rebuild it whenever the content,
+the exercises, the sitemap, the constants or the theme change. The
+plugins, the parsed sitemap and the caches stay in memory between builds.
+
+If only files that pages depend on changed, only the pages that the
+dependency graph (see plugins/dependencies.py) reports as affected are
+rendered and written. The other pages are still read, because pages refer to
+each other, but they come from the render cache. The post-build stages of
+parse-theme.py then only process the pages that were written. Changes to
+the theme, the sitemap or the constants, and files that were added or
+removed, trigger a full build, after which the menu is regenerated (if the
+sitemap changed), and all stages of parse-theme.py run, as build-menu.py
+and parse-theme.py do.
+
+Usage: python3 build-server.py [pelicanconf.py|publishconf.py] [--port PORT]
+
+With --port, the output folder is also served on localhost.
+"""
+
+import os
+import sys
+import time
+import logging
+import threading
+import traceback
+import importlib.util
+from functools import partial
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'plugins'))
+from pelican import Pelican
+from pelican.generators import StaticGenerator
+from pelican.log import init as init_logging
+from pelican.settings import read_settings
+from pelican.writers import Writer
+from dependencies import DependencyGraph
+
+WATCHED = ['content', 'exercises', 'sitemap.yaml', 'constants.yaml', 'themes']
+# The menu is generated into the theme by build-menu.py, so it shouldn't
+# trigger a rebuild
+IGNORED = ['themes/cogsci/templates/mega-menu-content.html',
+           'themes/cogsci/templates/mega-menu-fallback.html',
+           'themes/cogsci/static/menu/mega-menu.json']
+POLL_INTERVAL = .1
+
+
+def load_script(path):
+
+    """Imports a script that cannot be imported normally because its name
+    contains a dash."""
+
+    name = os.path.splitext(os.path.basename(path))[0].replace('-', '_')
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def snapshot():
+
+    """Returns a dict that maps all watched files to a (modification time,
+    size) signature."""
+
+    files = {}
+    for path in WATCHED:
+        if os.path.isfile(path):
+            st = os.stat(path)
+            files[path] = st.st_mtime_ns, st.st_size
+            continue
+        for dirname, dirnames, filenames in os.walk(path):
+            for basename in filenames:
+                filepath = os.path.join(dirname, basename)
+                if filepath in IGNORED:
+                    continue
+                try:
+                    st = os.stat(filepath)
+                except OSError:
+                    continue
+                files[filepath] = st.st_mtime_ns, st.st_size
+    return files
+
+
+class SelectiveWriter(Writer):
+
+    """Only writes the pages whose source is in selected, and keeps track of
+    the files that it writes."""
+
+    def __init__(self, output_path, settings=None, selected=()):
+
+        super().__init__(output_path, settings=settings)
+        self.selected = selected
+        self.written = []
+
+    def write_file(self, name, template, context, *args, **kwargs):
+
+        page = kwargs.get('page', kwargs.get('article'))
+        if page is None or \
+                os.path.relpath(page.source_path) not in self.selected:
+            return
+        super().write_file(name, template, context, *args, **kwargs)
+        self.written.append(os.path.join(self.output_path, name))
+
+
+class IncrementalPelican(Pelican):
+
+    """A Pelican that only writes the pages in selected, and only copies the
+    static files in changed. The theme is not copied at all. This overrides
+    private methods of Pelican 4."""
+
+    def __init__(self, settings, selected, changed):
+
+        super().__init__(settings)
+        self.selected = selected
+        self.changed = changed
+        self.writer = None
+
+    def _get_generator_classes(self):
+
+        changed = self.changed
+
+        class ChangedStaticGenerator(StaticGenerator):
+
+            def generate_output(self, writer):
+
+                for sc in self.context['staticfiles']:
+                    if os.path.relpath(os.path.join(
+                            self.path, sc.source_path)) in changed:
+                        self._link_or_copy_staticfile(sc)
+
+        return [ChangedStaticGenerator if cls is StaticGenerator else cls
+                for cls in super()._get_generator_classes()]
+
+    def _get_writer(self):
+
+        self.writer = SelectiveWriter(self.output_path, self.settings,
+                                      self.selected)
+        return self.writer
+
+
+def affected_pages(changed, graph_path):
+
+    """Returns the pages that need to be written again because files in
+    changed changed, or None if everything needs to be built again. This is
+    the case if a file changed that the dependency graph doesn't know about,
+    such as the theme, the sitemap or the constants, or a new file, or if a
+    file was removed."""
+
+    graph = DependencyGraph(graph_path)
+    if not all(os.path.exists(path) and graph.tracks(path)
+               for path in changed):
+        return None
+    return graph.affected(changed)
+
+
+def build(settings_path, build_menu, parse_theme, changed=None):
+
+    t0 = time.perf_counter()
+    settings = read_settings(settings_path)
+    selected = None if changed is None \
+        else affected_pages(changed, settings['DEPENDENCY_GRAPH_PATH'])
+    if selected is None:
+        if changed is None or 'sitemap.yaml' in changed:
+            build_menu.main()
+        Pelican(settings).run()
+        written = None
+    else:
+        for page in selected:
+            print('affected: %s' % page)
+        pelican = IncrementalPelican(settings, set(selected), set(changed))
+        pelican.run()
+        written = pelican.writer.written
+    for name, stage in parse_theme.stages(settings, written):
+        stage()
+    print('Built in %d ms' % (1000 * (time.perf_counter() - t0)))
+
+
+def serve(port, output_path):
+
+    handler = partial(SimpleHTTPRequestHandler, directory=output_path)
+    server = ThreadingHTTPServer(('localhost', port), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    print('Serving %s on http://localhost:%d' % (output_path, port))
+
+
+def main():
+
+    settings_path = 'publishconf.py' if 'publishconf.py' in sys.argv \
+        else 'pelicanconf.py'
+    init_logging(level=logging.WARNING)
+    build_menu = load_script('build-menu.py')
+    # build-menu.py takes the root from the command line, which we don't share
+    build_menu.ROOT = read_settings(settings_path)['SITEURL']
+    parse_theme = load_script('parse-theme.py')
+    build(settings_path, build_menu, parse_theme)
+    # Taken after the first build, so that the files that it generates don't
+    # count as changes
+    files = snapshot()
+    if '--port' in sys.argv:
+        port = int(sys.argv[sys.argv.index('--port') + 1])
+        serve(port, read_settings(settings_path)['OUTPUT_PATH'])
+    print('Watching for changes')
+    while True:
+        time.sleep(POLL_INTERVAL)
+        new_files = snapshot()
+        if new_files == files:
+            continue
+        changed = {path for path in set(files) | set(new_files)
+                   if files.get(path) != new_files.get(path)}
+        files = new_files
+        for path in sorted(changed):
+            print('changed: %s' % path)
+        try:
+            build(settings_path, build_menu, parse_theme, changed)
+        except Exception:
+            traceback.print_exc()
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except KeyboardInterrupt:
+        pass
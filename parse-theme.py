@@ -2,27 +2,94 @@
 # coding=utf-8
 
 import os
+import sys
+import glob
 import yaml
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'plugins'))
+from inject_constants import parse_folder
+from html_optimize import optimize
+from seo_sitemap import write_sitemap, SITEMAP_NAME, SHARD_PATTERN
+from search_index import SEARCH_FOLDER
+from sitemap import load as load_sitemap
+from fingerprint import fingerprint
+from service_worker import write_service_worker
 
-with open('constants.yaml') as f:
-    const = yaml.load(f, Loader=yaml.SafeLoader)
+if '--publish' in sys.argv:
+    import publishconf as conf
+else:
+    import pelicanconf as conf
 
 
-def parse_folder(dirname):
+def load_settings():
 
-    for basename in os.listdir(dirname):
-        path = os.path.join(dirname, basename)
-        if os.path.isdir(path):
-            parse_folder(path)
-            continue
-        if path.endswith('.js'):
-            print('processing %s' % path)
-            with open(path) as fd:
-                content = fd.read()
-            with open(path, 'w') as fd:
-                for var, val in const.items():
-                    content = content.replace(u'$%s$' % var, str(val))
-                fd.write(content)
+    """Returns the settings of pelicanconf.py or publishconf.py as a dict."""
 
+    return {name: getattr(conf, name) for name in dir(conf)
+            if name.isupper()}
 
-parse_folder('output')
+
+def stages(settings, changed=None):
+
+    """Returns a list of (name, function) tuples for the stages that run
+    after Pelican has generated the site, in order. settings is a dict, as
+    returned by load_settings() or by Pelican. The stages are separate
+    functions so that benchmarks/build.py can time them.
+
+    changed is an optional list of generated pages, if only these pages
+    were written, and the theme wasn't copied again, as happens for
+    incremental builds by build-server.py. The stages then only process
+    these pages, and the files that the build always writes: the search
+    index, and the files that the stages write themselves."""
+
+    output_path = settings['OUTPUT_PATH']
+    siteurl = settings['SITEURL']
+
+    def inject_constants():
+        with open('constants.yaml') as f:
+            const = yaml.load(f, Loader=yaml.SafeLoader)
+        parse_folder(output_path, const)
+
+    def seo_sitemap():
+        write_sitemap(load_sitemap().seo_pages(siteurl), output_path, siteurl,
+                      os.path.join(settings['PATH'], 'pages'),
+                      changed=None if changed is None else set(changed))
+
+    def optimize_html():
+        optimize(output_path, siteurl, settings['CRITICAL_CSS_SAFELIST'],
+                 paths=changed)
+
+    def fingerprint_theme():
+        if changed is None:
+            fingerprint(output_path, siteurl)
+            return
+        paths = changed + glob.glob(os.path.join(output_path, SITEMAP_NAME)) \
+            + glob.glob(os.path.join(output_path, SHARD_PATTERN)) \
+            + sorted(glob.glob(os.path.join(output_path, SEARCH_FOLDER, '*')))
+        fingerprint(output_path, siteurl, paths=paths)
+
+    def service_worker():
+        write_service_worker(output_path, load_sitemap().seo_pages(''))
+
+    # Only the theme's JavaScript has placeholders for constants
+    result = [] if changed is not None \
+        else [('inject_constants', inject_constants)]
+    result.append(('seo_sitemap', seo_sitemap))
+    if settings.get('OPTIMIZE_HTML'):
+        result.append(('optimize_html', optimize_html))
+    result.append(('fingerprint', fingerprint_theme))
+    if settings.get('SERVICE_WORKER'):
+        result.append(('service_worker', service_worker))
+    return result
+
+
+def main():
+
+    for name, stage in stages(load_settings()):
+        stage()
+
+
+# The steps run in worker processes, which import this script again if they
+# are started with spawn (the default on macOS and Windows)
+if __name__ == '__main__':
+    main()
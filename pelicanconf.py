@@ -6,3 +6,6 @@ sys.path.append(os.path.dirname(__file__))
 from baseconf import *
 
 SITEURL = 'http://localhost:8000'
+# While writing, pages should always be fresh, rather than served from the
+# cache of the service worker
+SERVICE_WORKER = False
@@ -0,0 +1,283 @@
+# coding=utf-8
+
+'''
+Runs the ```python blocks of pages during the build, and inserts their
+output after each block, so that the output that is shown is always that
+of the current code. This is opt-in, through EXECUTE_CODE_BLOCKS in
+baseconf.py.
+
+The blocks of a page run in order, in a single interpreter session, in the
+same way as in a notebook. The session is a separate Python process, which
+runs in a temporary folder in which data refers to the data folder of the
+repository, so that the code can read the data files (and can write files
+without cluttering the repository). The output of each block is cached by a
+hash of the block, all blocks that precede it, and the data files, so that
+a page only runs again if one of these changed. If any block of a page is
+not cached, the entire page runs again, because the blocks depend on the
+state that the blocks before them left behind. Blocks that didn't finish
+within the timeout are not cached, so that they run again in the next
+build, and show what they printed before they were stopped. The same goes
+for the page itself: insert_outputs() reports whether all blocks finished,
+and pages for which this is not the case are not put in the render cache.
+
+Pages are rendered in parallel by cogsci-preprocess.py, so their sessions
+also run in parallel. New entries are sent from worker processes to the
+main process with take_new() and update(), as for the highlight cache.
+'''
+
+import os
+import re
+import sys
+import json
+import shutil
+import hashlib
+import tempfile
+import traceback
+import subprocess
+from collections import OrderedDict
+from render_cache import cache_key
+from inject_constants import write_atomic
+
+PYTHON_BLOCK = re.compile(r'```python(?P<code>.*?)```', re.DOTALL)
+OUTPUT_TEMPLATE = '\n\n__Output:__\n\n%(fence)s\n%(output)s\n%(fence)s\n'
+TILDES = re.compile(r'~{3,}')
+
+
+def data_digest(data_path):
+
+    '''Returns a hash of the names and contents of all files in data_path.'''
+
+    h = hashlib.sha1()
+    for dirpath, dirnames, filenames in os.walk(data_path):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            path = os.path.join(dirpath, filename)
+            h.update(os.path.relpath(path, data_path).encode('utf-8'))
+            with open(path, 'rb') as fd:
+                h.update(hashlib.sha1(fd.read()).digest())
+    return h.hexdigest()
+
+
+def format_output(output):
+
+    # The fence needs to be longer than any fence in the output
+    longest = max([len(m) for m in TILDES.findall(output)] + [2])
+    return OUTPUT_TEMPLATE % {'fence': '~' * (longest + 1),
+                              'output': output}
+
+
+class CodeRunner:
+
+    def __init__(self, cache_path, data_path, timeout=300,
+                 max_entries=20000):
+
+        self.cache_path = cache_path
+        self.data_path = os.path.abspath(data_path)
+        self.timeout = timeout
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._new = {}
+        self._dirty = False
+        self._data_digest = None
+        try:
+            with open(cache_path) as fd:
+                self._entries = OrderedDict(json.load(fd))
+        except (OSError, ValueError):
+            self._entries = OrderedDict()
+
+    @property
+    def digest(self):
+
+        '''A hash of the data files and the Python version, which is
+        computed once per build. See reset().'''
+
+        if self._data_digest is None:
+            self._data_digest = cache_key(sys.version,
+                                          data_digest(self.data_path))
+        return self._data_digest
+
+    def reset(self):
+
+        '''Makes sure that changes to the data files are noticed when the
+        build runs again in the same process.'''
+
+        self._data_digest = None
+
+    def cell_keys(self, cells):
+
+        keys = []
+        key = self.digest
+        for cell in cells:
+            key = cache_key(key, cell)
+            keys.append(key)
+        return keys
+
+    def run(self, cells):
+
+        '''Returns an (outputs, complete) tuple, where outputs is the output of
+        each cell, from the cache if possible, and complete indicates whether
+        all cells finished within the timeout.'''
+
+        keys = self.cell_keys(cells)
+        if all(key in self._entries for key in keys):
+            self.hits += len(keys)
+            for key in keys:
+                self._entries.move_to_end(key)
+            return [self._entries[key] for key in keys], True
+        self.misses += len(keys)
+        outputs, finished = self._run_session(cells)
+        for key, output in zip(keys[:finished], outputs):
+            self._entries[key] = output
+            self._new[key] = output
+            self._dirty = True
+        return outputs, finished == len(cells)
+
+    def _run_session(self, cells):
+
+        '''Returns the output of each cell, and the number of cells that
+        finished.'''
+
+        workdir = tempfile.mkdtemp(prefix='code-execution-')
+        try:
+            os.symlink(self.data_path, os.path.join(workdir, 'data'))
+            process = subprocess.Popen(
+                [sys.executable, os.path.abspath(__file__)], cwd=workdir,
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL, text=True,
+                env=dict(os.environ, MPLBACKEND='Agg'))
+            try:
+                stdout = process.communicate(json.dumps(cells),
+                                             timeout=self.timeout)[0]
+            except subprocess.TimeoutExpired:
+                process.kill()
+                stdout = process.communicate()[0]
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+        # The session writes output while it runs, so that it is kept if the
+        # session is killed
+        outputs = [''] * len(cells)
+        finished = 0
+        for line in stdout.splitlines():
+            try:
+                message = json.loads(line)
+            except ValueError:
+                # The last line may be incomplete
+                continue
+            if 'output' in message:
+                outputs[message['cell']] += message['output']
+            else:
+                finished = message['cell'] + 1
+        outputs = [output.rstrip() for output in outputs]
+        for i in range(finished, len(cells)):
+            outputs[i] = (outputs[i] + '\nTimeoutError: the code on this page '
+                          'took more than %d s' % self.timeout).lstrip()
+        return outputs, finished
+
+    def insert_outputs(self, text):
+
+        '''Inserts the output of every ```python block after the block, and
+        returns a (text, complete) tuple. See run().'''
+
+        blocks = list(PYTHON_BLOCK.finditer(text))
+        if not blocks:
+            return text, True
+        outputs, complete = self.run([m.group('code').strip()
+                                      for m in blocks])
+        parts = []
+        end = 0
+        for m, output in zip(blocks, outputs):
+            parts.append(text[end:m.end()])
+            if output:
+                parts.append(format_output(output))
+            end = m.end()
+        parts.append(text[end:])
+        return ''.join(parts), complete
+
+    def take_new(self):
+
+        new = self._new, self.hits, self.misses
+        self._new = {}
+        self.hits = self.misses = 0
+        return new
+
+    def update(self, entries, hits=0, misses=0):
+
+        self.hits += hits
+        self.misses += misses
+        if not entries:
+            return
+        self._entries.update(entries)
+        self._dirty = True
+
+    def save(self):
+
+        if not self._dirty:
+            return
+        # Least-recently used entries are at the start
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        os.makedirs(os.path.dirname(self.cache_path) or '.', exist_ok=True)
+        write_atomic(self.cache_path,
+                     json.dumps(self._entries).encode('utf-8'))
+        self._dirty = False
+
+    def report(self):
+
+        return 'code execution: %d cached, %d executed' % (self.hits,
+                                                          self.misses)
+
+
+def session():
+
+    '''Runs cells that are read as a JSON list from stdin, in a shared
+    namespace. Output is written as lines of JSON while it is printed, and
+    a line marks the end of each cell.'''
+
+    from contextlib import redirect_stdout, redirect_stderr
+    cells = json.load(sys.stdin)
+    # Output that bypasses sys.stdout, for example from C extensions or
+    # subprocesses, should not end up between the results
+    stdout = os.fdopen(os.dup(1), 'w')
+    os.dup2(os.open(os.devnull, os.O_WRONLY), 1)
+    namespace = {'__name__': '__main__'}
+    for i, cell in enumerate(cells):
+        output = CellOutput(stdout, i)
+        with redirect_stdout(output), redirect_stderr(output):
+            try:
+                exec(compile(cell, '<cell>', 'exec'), namespace)
+            except BaseException as e:
+                output.write(''.join(
+                    traceback.format_exception_only(type(e), e)))
+        stdout.write(json.dumps({'cell': i}) + '\n')
+        stdout.flush()
+
+
+class CellOutput:
+
+    '''A file-like object that passes output on to the build as soon as it is
+    written.'''
+
+    def __init__(self, stdout, cell):
+
+        self._stdout = stdout
+        self._cell = cell
+
+    def write(self, s):
+
+        if s:
+            self._stdout.write(json.dumps({'cell': self._cell,
+                                           'output': s}) + '\n')
+            self._stdout.flush()
+        return len(s)
+
+    def flush(self):
+
+        pass
+
+
+if __name__ == '__main__':
+    # The code should import modules from the working directory, and not
+    # from the plugins folder
+    sys.path[0] = os.getcwd()
+    session()
@@ -4,9 +4,22 @@ import os
 import re
 import sys
 import shutil
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 sys.path.insert(0, '/home/sebastiaan/git/academicmarkdown')
+sys.path.insert(0, os.path.dirname(__file__))
 import yaml
-from collections import OrderedDict
+if 'publishconf.py' in sys.argv:
+    from publishconf import *
+else:
+    from pelicanconf import *
+import profiler
+if BUILD_PROFILE:
+    profiler.enable(BUILD_PROFILE_ALLOCATIONS)
+# The highlight cache needs to be installed before Markdown and academicmarkdown
+# import pygments.highlight()
+import highlight_cache
+highlighter = highlight_cache.install(HIGHLIGHT_CACHE_PATH)
 from pelican import signals
 from pelican.readers import MarkdownReader
 from markdown import Markdown
@@ -14,10 +27,14 @@ from markdown.extensions import codehilite
 from markdown.extensions.toc import TocExtension
 from markdown.extensions.tables import TableExtension
 from academicmarkdown import build, HTMLFilter, _FigureParser
-if 'publishconf.py' in sys.argv:
-    from publishconf import *
-else:
-    from pelicanconf import *
+from render_cache import RenderCache, cache_key
+from link_substitution import substitute_links
+from html_postprocess import HTMLPostProcessor
+from sitemap import load as load_sitemap
+from dependencies import DependencyGraph, list_files, signature
+from images import ImageIndex, build_derivatives, rewrite as rewrite_images
+from search_index import SearchIndex, page_document
+from code_execution import CodeRunner
 
 _FigureParser.figureTemplate[u'jekyll'] = u"""
 ![%(source)s](%(source)s)
@@ -39,26 +56,166 @@ ITEM_TYPES = [
 
 root = os.path.dirname(os.path.dirname(__file__)) + '/content'
 
-with open('constants.yaml') as f:
-    const = yaml.load(f, Loader=yaml.SafeLoader)
+# Bump this whenever the rendering pipeline changes in a way that affects the
+# output, so that stale entries in the render cache are no longer used.
+RENDER_CACHE_VERSION = '5'
+
+const_source = None
+
+
+def load_constants():
 
+    """(Re)loads constants.yaml, unless it is unchanged since it was last
+    loaded."""
+
+    global const_source, const, postprocess_html
+    with open('constants.yaml') as f:
+        source = f.read()
+    if source == const_source:
+        return
+    const_source = source
+    const = yaml.load(const_source, Loader=yaml.SafeLoader)
+    postprocess_html = HTMLPostProcessor(const, ITEM_TYPES)
+
+
+load_constants()
+
+_academicmarkdown_initialized = False
+sitemap = None
 links = {}
+# The links as part of the render key, which is computed once per build
+links_source = ''
 duplicate_names = []
 try:
     shutil.rmtree('.memoize')
 except:
     pass
+render_cache = RenderCache(RENDER_CACHE_PATH, RENDER_CACHE_SIZE)
+# Pages that have been rendered ahead of time, by render key
+prerendered = {}
+dependency_graph = DependencyGraph(DEPENDENCY_GRAPH_PATH)
+image_index = ImageIndex(IMAGE_CACHE_PATH, IMAGE_WIDTHS)
+# The searchable content of the pages that have been read, by source path
+search_documents = {}
+search_index = SearchIndex()
+code_runner = CodeRunner(CODE_EXECUTION_CACHE_PATH, 'data',
+                         CODE_EXECUTION_TIMEOUT)
 
-class AcademicMarkdownReader(MarkdownReader):
 
-    enabled = True
+def page_paths(source_path):
 
-    def read(self, source_path):
+    """Returns the folders in which academicmarkdown looks for the figures,
+    listings and tables of a page."""
 
-        """Parse content and metadata of markdown files"""
+    base = os.path.basename(source_path)[:-3]
+    folder = os.path.dirname(source_path)
+    return [folder + '/img/' + base, folder + '/lst/' + base,
+            folder + '/tbl/' + base]
 
-        self._source_path = source_path
-        self._md = Markdown(
+
+def find_includes(text, folders, seen=None):
+
+    """Returns a list of (path, content) tuples for all files that are
+    (recursively) included in text through %-- include: path --% blocks. The
+    path is resolved against folders, in the same way as academicmarkdown
+    does. Includes that cannot be found are listed with None as content."""
+
+    if seen is None:
+        seen = set()
+    includes = []
+    for m in re.finditer(r'%--\s*include:\s*(?P<path>\S+)\s*--%', text):
+        path = m.group('path')
+        if path in seen:
+            continue
+        seen.add(path)
+        for folder in [''] + folders:
+            candidate = os.path.join(folder, path)
+            if os.path.isfile(candidate):
+                break
+        else:
+            includes.append((path, None))
+            continue
+        with open(candidate) as fd:
+            content = fd.read()
+        includes.append((candidate, content))
+        includes += find_includes(content, folders, seen)
+    return includes
+
+
+def executes_code(source_path):
+
+    """Returns whether the code blocks of a page are executed during the
+    build. See EXECUTE_CODE_BLOCKS."""
+
+    path = os.path.relpath(source_path, os.path.abspath(PATH))
+    return any(path.startswith(folder.rstrip('/') + '/')
+               for folder in EXECUTE_CODE_BLOCKS)
+
+
+_file_digests = {}
+
+
+def file_digest(path):
+
+    """Returns a hash of the content of a file, which is only read again if
+    its size or modification time changed."""
+
+    sig = signature(path)
+    if path not in _file_digests or _file_digests[path][0] != sig:
+        with open(path, 'rb') as fd:
+            _file_digests[path] = sig, cache_key(fd.read())
+    return _file_digests[path][1]
+
+
+def read_source(source_path):
+
+    with open(source_path) as fd:
+        text = fd.read()
+    if hasattr(text, 'decode'): # Python 2
+        text = text.decode('utf-8')
+    return text
+
+
+def render_key(source_path, text):
+
+    """Returns a (key, dependencies) tuple for a page. The key is the
+    render-cache key, which covers everything that affects the rendered
+    output, including the content of the figures, listings and tables of the
+    page, and the image widths. The dependencies are all files that the page
+    uses."""
+
+    parts = [RENDER_CACHE_VERSION, source_path, text, const_source,
+             links_source, SITEURL, image_index.config]
+    folders = page_paths(source_path)
+    dependencies = []
+    for path, content in find_includes(text, folders + build.path):
+        parts += [path, content if content is not None else '\0missing']
+        if content is not None:
+            dependencies.append(path)
+    for path in list_files(folders):
+        dependencies.append(path)
+        parts += [path, file_digest(path)]
+    if executes_code(source_path):
+        parts += ['\0execute', code_runner.digest]
+    return cache_key(*parts), dependencies
+
+
+_markdown = None
+_meta_preprocessor = None
+
+
+def markdown_engine():
+
+    """Returns the Markdown instance of this process, which is created once and
+    reset before each use."""
+
+    global _markdown, _meta_preprocessor
+    if _markdown is not None:
+        # Pelican deregisters the meta preprocessor when it parses metadata
+        if 'meta' not in _markdown.preprocessors:
+            _markdown.preprocessors.register(_meta_preprocessor, 'meta', 27)
+    else:
+        _markdown = Markdown(
             extensions=[
                 TocExtension(toc_depth=3, title='Contents'),
                 'markdown.extensions.tables',
@@ -67,102 +224,201 @@ class AcademicMarkdownReader(MarkdownReader):
                 codehilite.CodeHiliteExtension(css_class='highlight'),
                 ],
             )
-        img_path = os.path.dirname(source_path) + '/img/' \
-            + os.path.basename(source_path)[:-3]
-        lst_path = os.path.dirname(source_path) + '/lst/' \
-            + os.path.basename(source_path)[:-3]
-        tbl_path = os.path.dirname(source_path) + '/tbl/' \
-            + os.path.basename(source_path)[:-3]
-        build.path = [img_path, lst_path, tbl_path] + build.path
-        with open(source_path) as fd:
-            text = fd.read()
-            if hasattr(text, 'decode'): # Python 2
-                text = text.decode('utf-8')
-            for m in re.finditer('```python(?P<code>.*?)```', text, re.DOTALL):
-                new_block = (
-                    u'\n%--\npython: |\n'
-                    + u'\n'.join([u' '+ s for s in m.group('code').strip().split(u'\n')])
-                    + u'\n--%\n'
-                )
-                text = text.replace(m.group(0), new_block)
+        _meta_preprocessor = _markdown.preprocessors['meta']
+    return _markdown.reset()
+
+
+def python_block(m):
+
+    return (
+        u'\n%--\npython: |\n'
+        + u'\n'.join([u' '+ s for s in m.group('code').strip().split(u'\n')])
+        + u'\n--%\n'
+    )
+
+
+def render(source_path, text):
+
+    """Runs the full rendering pipeline and returns a ((content, meta,
+    document, images), cacheable) tuple, where meta is the raw metadata from
+    the Markdown parser, document is the searchable content of the page,
+    images are the images that the page refers to (see images.rewrite()), and
+    cacheable is False if the code on the page didn't finish in time, in which
+    case the page should run again in the next build. The academicmarkdown
+    search path is restored afterwards, so that this can safely be called for
+    one page after another, also in worker processes."""
+
+    page = os.path.relpath(source_path)
+    saved_path = build.path
+    build.path = page_paths(source_path) + build.path
+    cacheable = True
+    try:
+        if executes_code(source_path):
+            with profiler.stage('execute', page):
+                text, cacheable = code_runner.insert_outputs(text)
+        with profiler.stage('python-blocks', page):
+            text = re.sub('```python(?P<code>.*?)```', python_block, text,
+                          flags=re.DOTALL)
+        with profiler.stage('academicmarkdown', page):
             text = build.MD(text)
-            # Process internal links
-            for m in re.finditer('%link:(?P<link>[\w/-]+)%', text):
-                full = m.group(0)
-                link = m.group('link')
-                print('link', link, full)
-                if link not in links:
-                    raise Exception(u'%s not a key in %s' % (link, links))
-                text = text.replace(full, '<%s/%s>' % (SITEURL, links[link]))
-            for m in re.finditer('%url:(?P<link>[\w/-]+)%', text):
-                full = m.group(0)
-                link = m.group('link')
-                print('url', link, full)
-                if link not in links:
-                    raise Exception(u'%s not a key in %s' % (link, links))
-                text = text.replace(full, '%s/%s' % (SITEURL, links[link]))
-            for m in re.finditer('%static:(?P<link>[\w/.-]+)%', text):
-                full = m.group(0)
-                link = m.group('link')
-                print('static', link, full)
-                text = text.replace(full, '<%s/%s>' % (SITEURL, link))
+        with profiler.stage('links', page):
+            text = substitute_links(text, links, SITEURL)
             text = text.replace(root, u'')
             text = HTMLFilter.DOI(text)
-            content = self._md.convert(text)
-            for var, val in const.items():
-                content = content.replace(u'$%s$' % var, str(val))
-            for item_type in ITEM_TYPES:
-                content = content.replace(item_type,
-                    u'<span class="item-type">%s</span>' % item_type.lower())
-        metadata = self._parse_metadata(self._md.Meta)
-        build.path = build.path[3:]
-        return content, metadata
+        with profiler.stage('markdown', page):
+            md = markdown_engine()
+            content = md.convert(text)
+        with profiler.stage('postprocess', page):
+            content = postprocess_html(content)
+        with profiler.stage('images', page):
+            content, images = rewrite_images(content, image_index, SITEURL,
+                                             PATH)
+        with profiler.stage('search', page):
+            document = page_document(content, md.toc_tokens)
+    finally:
+        build.path = saved_path
+    return (content, md.Meta, document, images), cacheable
 
 
-def init_academicmarkdown(sender):
+def cached_render(key):
 
-    build.postMarkdownFilters = []
-    build.figureTemplate = 'jekyll'
-    build.tableTemplate = 'kramdown'
-    build.figureSourcePrefix = SITEURL
-    build.path += u'include'
-    build.extensions.remove('toc')
-    build.extensions.insert(0, 'toc')
-    with open('sitemap.yaml') as f:
-        d = orderedLoad(f)
-    process_links(d)
+    """Returns a page from the render cache, or None if it isn't there, or if
+    one of its images changed."""
 
+    cached = render_cache.get(key)
+    if cached is None or not image_index.register(cached[3]):
+        return None
+    return cached
 
-def isseparator(pagename):
 
-    for ch in pagename:
-        if ch != '_':
-            return False
-    return True
+def _render_job(job):
 
+    # Pages that fail to render are rendered again by read(), so that the
+    # error is reported by Pelican for the page in question
+    try:
+        result = render(*job)
+    except Exception:
+        result = None
+    return result, highlighter.take_new(), image_index.take_new(), \
+        code_runner.take_new(), profiler.take_records()
 
-def process_links(d):
 
-    for pagename, entry in d.items():
-        if isinstance(entry, list):
-            entry = entry[0]
-        if isseparator(pagename) or entry in [None, '']:
-            continue
-        if isinstance(entry, dict):
-            process_links(entry)
-            continue
-        name = entry.split('/')[-1]
-        if not name.strip():
-            continue
-        links[entry] = entry
-        if entry == name or name in duplicate_names:
+def prerender_pages(generator):
+
+    """Renders all pages that are not in the render cache in a pool of worker
+    processes, before Pelican reads them one by one. Each worker is a forked
+    copy of this process, and therefore has its own academicmarkdown and
+    Markdown state. The results are kept in memory until read() asks for
+    them, so the order in which Pelican processes pages is unchanged, and are
+    only put in the render cache if they are cacheable."""
+
+    if RENDER_PROCESSES <= 1 or \
+            'fork' not in multiprocessing.get_all_start_methods():
+        return
+    jobs = []
+    keys = []
+    for path in sorted(generator.get_files(
+            generator.settings['PAGE_PATHS'],
+            exclude=generator.settings['PAGE_EXCLUDES'],
+            extensions=('md',))):
+        source_path = os.path.abspath(os.path.join(generator.path, path))
+        text = read_source(source_path)
+        key = render_key(source_path, text)[0]
+        cached = cached_render(key)
+        if cached is not None:
+            prerendered[key] = cached
             continue
-        if name not in links:
-            links[name] = entry
+        jobs.append((source_path, text))
+        keys.append(key)
+    if len(jobs) < 2:
+        return
+    with ProcessPoolExecutor(
+            RENDER_PROCESSES,
+            mp_context=multiprocessing.get_context('fork')) as pool:
+        for key, (result, highlighted, images, outputs, profile) in zip(
+                keys, pool.map(_render_job, jobs)):
+            highlighter.update(*highlighted)
+            image_index.update(images)
+            code_runner.update(*outputs)
+            profiler.merge(profile)
+            if result is None:
+                continue
+            cached, cacheable = result
+            prerendered[key] = cached
+            if cacheable:
+                render_cache.put(key, cached)
+
+
+class AcademicMarkdownReader(MarkdownReader):
+
+    enabled = True
+
+    def read(self, source_path):
+
+        """Parse content and metadata of markdown files"""
+
+        self._source_path = source_path
+        # Pelican uses the Markdown instance to parse metadata
+        self._md = markdown_engine()
+        text = read_source(source_path)
+        with profiler.stage('render-key', os.path.relpath(source_path)):
+            key, dependencies = render_key(source_path, text)
+        dependency_graph.record(source_path, dependencies)
+        cached = prerendered.pop(key, None)
+        if cached is None:
+            cached = cached_render(key)
+        if cached is None:
+            cached, cacheable = render(source_path, text)
+            if cacheable:
+                render_cache.put(key, cached)
+        content, meta, document = cached[:3]
+        search_documents[source_path] = document
+        metadata = self._parse_metadata(meta)
+        return content, metadata
+
+
+def init_academicmarkdown(sender):
+
+    """Initializes academicmarkdown, and loads the constants and the sitemap.
+    This is called for every build, which happens more than once when Pelican
+    is kept running by build-server.py, in which case only the constants and
+    the sitemap are reloaded if they changed."""
+
+    global sitemap, links_source, _academicmarkdown_initialized
+    if not _academicmarkdown_initialized:
+        build.postMarkdownFilters = []
+        build.figureTemplate = 'jekyll'
+        build.tableTemplate = 'kramdown'
+        build.figureSourcePrefix = SITEURL
+        build.path += u'include'
+        build.extensions.remove('toc')
+        build.extensions.insert(0, 'toc')
+        _academicmarkdown_initialized = True
+    load_constants()
+    code_runner.reset()
+    sitemap = load_sitemap()
+    links.clear()
+    links.update(sitemap.links)
+    links_source = repr(sorted(links.items()))
+    duplicate_names[:] = sitemap.duplicate_names
+
+
+def collect_search_documents(generator):
+
+    """Adds the pages that have been read to the search index, with their
+    title from the sitemap if they are listed there."""
+
+    titles = {entry: pagename for pagename, entry in sitemap.pages}
+    search_index.clear()
+    for page in generator.pages + generator.translations:
+        document = search_documents.get(page.source_path)
+        if document is None:
             continue
-        duplicate_names.append(name)
-        del links[name]
-        print('Duplicate name: %s' % name)
+        entry = page.save_as
+        if entry.endswith('index.html'):
+            entry = entry[:-len('index.html')]
+        entry = entry.strip('/')
+        search_index.add('/' + entry, titles.get(entry, page.title), document)
 
 
 def add_reader(readers):
@@ -170,20 +426,32 @@ def add_reader(readers):
     readers.reader_classes['md'] = AcademicMarkdownReader
 
 
+def finalize_caches(sender):
+
+    highlighter.save()
+    code_runner.save()
+    dependency_graph.save()
+    build_derivatives(image_index, sender.output_path, RENDER_PROCESSES)
+    with profiler.stage('search-index'):
+        search_index.write(sender.output_path)
+    image_index.save()
+    print(render_cache.report())
+    print(highlighter.report())
+    if EXECUTE_CODE_BLOCKS:
+        print(code_runner.report())
+    render_cache.reset_counters()
+    highlighter.hits = highlighter.misses = 0
+    code_runner.hits = code_runner.misses = 0
+    if profiler.enabled:
+        profiler.write_report(BUILD_PROFILE)
+        profiler.take_records()
+
+
 def register():
 
     signals.readers_init.connect(add_reader)
     signals.initialized.connect(init_academicmarkdown)
+    signals.page_generator_init.connect(prerender_pages)
+    signals.page_generator_finalized.connect(collect_search_documents)
+    signals.finalized.connect(finalize_caches)
 
-
-def orderedLoad(stream, Loader=yaml.Loader, object_pairs_hook=OrderedDict):
-
-    class OrderedLoader(Loader):
-        pass
-    def construct_mapping(loader, node):
-        loader.flatten_mapping(node)
-        return object_pairs_hook(loader.construct_pairs(node))
-    OrderedLoader.add_constructor(
-        yaml.resolver.BaseResolver.DEFAULT_MAPPING_TAG,
-        construct_mapping)
-    return yaml.load(stream, OrderedLoader)
@@ -0,0 +1,129 @@
+# coding=utf-8
+
+'''
+Keeps track of which files each page depends on: files that are included
+through %-- include: --% blocks, and the figures, listings and tables in the
+img/, lst/ and tbl/ folders of the page. The graph is recorded during the
+build and saved to disk, so that it can be queried afterwards:
+
+    # List the pages that depend on a file
+    python3 plugins/dependencies.py exercises/numerical/numpy-1.md
+    # List the pages that depend on files that changed since the last build
+    python3 plugins/dependencies.py --changed
+'''
+
+import os
+import sys
+import json
+import tempfile
+
+DEFAULT_PATH = '.cache/dependencies.json'
+
+
+def signature(path):
+
+    '''Returns a cheap signature of a file, or None if it doesn't exist.'''
+
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return '%d:%d' % (st.st_size, st.st_mtime_ns)
+
+
+def list_files(folders):
+
+    files = []
+    for folder in folders:
+        for dirname, dirnames, filenames in os.walk(folder):
+            dirnames.sort()
+            files += [os.path.join(dirname, basename)
+                      for basename in sorted(filenames)]
+    return files
+
+
+class DependencyGraph:
+
+    def __init__(self, path=DEFAULT_PATH):
+
+        self.path = path
+        try:
+            with open(path) as fd:
+                self._pages = json.load(fd)
+        except (OSError, ValueError):
+            self._pages = {}
+        self._dirty = False
+
+    def record(self, page, dependencies):
+
+        '''Records the files that page depends on. The page itself is recorded
+        as a dependency too, so that changes to it are picked up by changed().'''
+
+        deps = {os.path.relpath(dep): signature(dep)
+                for dep in [page] + list(dependencies)}
+        page = os.path.relpath(page)
+        if self._pages.get(page) != deps:
+            self._pages[page] = deps
+            self._dirty = True
+
+    def dependencies(self, page):
+
+        return sorted(self._pages.get(os.path.relpath(page), {}))
+
+    def tracks(self, path):
+
+        '''Returns True if path is a page, or a file that a page depends on.'''
+
+        path = os.path.relpath(path)
+        return any(path in deps for deps in self._pages.values())
+
+    def affected(self, paths):
+
+        '''Returns the pages that are, or depend on, any of paths.'''
+
+        paths = {os.path.relpath(path) for path in paths}
+        return sorted(page for page, deps in self._pages.items()
+                      if page in paths or not paths.isdisjoint(deps))
+
+    def changed(self):
+
+        '''Returns the files that pages depend on, and that changed since they
+        were recorded.'''
+
+        changed = set()
+        for page, deps in self._pages.items():
+            for dep, sig in deps.items():
+                if dep not in changed and signature(dep) != sig:
+                    changed.add(dep)
+        return sorted(changed)
+
+    def save(self):
+
+        if not self._dirty:
+            return
+        folder = os.path.dirname(self.path) or '.'
+        os.makedirs(folder, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=folder, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self._pages, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.path)
+        self._dirty = False
+
+
+def main():
+
+    args = sys.argv[1:]
+    if not args or args[0] in ('-h', '--help'):
+        print(__doc__)
+        return
+    graph = DependencyGraph()
+    if args == ['--changed']:
+        args = graph.changed()
+        for path in args:
+            print('changed: %s' % path)
+    for page in graph.affected(args):
+        print(page)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,255 @@
+# coding=utf-8
+
+'''
+Fingerprints the theme's static files, so that they can be cached by
+browsers and proxies for as long as they like. This is used by
+parse-theme.py after Pelican has generated the site, and after constants
+have been injected.
+
+Every file in output/theme is copied to output/assets, with a hash of its
+content in its name (e.g. css/bootstrap.min.3f2a91c0.css). url() references
+in stylesheets, and /theme/ references in the generated HTML, are rewritten
+to point to the fingerprinted copies. The originals are left in place for
+anything that still refers to them. Python files in output/theme/py are not
+fingerprinted, because Brython imports them by name from there. An
+.htaccess file gives the fingerprinted copies, and the resized images (see
+images.py), far-future cache headers.
+
+Finally, text files in the output get precompressed .gz siblings, and .br
+siblings if the brotli module is available, so that the web server doesn't
+need to compress them on the fly. A manifest keeps track of what has been
+done, so that unchanged files are neither fingerprinted nor compressed
+again.
+'''
+
+import os
+import re
+import gzip
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+from inject_constants import write_atomic, load_manifest, save_manifest
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+DEFAULT_MANIFEST_PATH = '.cache/fingerprint.json'
+THEME_FOLDER = 'theme'
+ASSETS_FOLDER = 'assets'
+# Brython imports modules from here by name, so they are not fingerprinted
+IMPORT_FOLDER = 'py'
+# Folders in the output whose files never change without changing names
+IMMUTABLE_FOLDERS = [ASSETS_FOLDER, 'images']
+COMPRESS_EXTENSIONS = ('.html', '.css', '.js', '.py', '.svg', '.json', '.xml',
+                       '.txt', '.yml', '.ttf', '.eot')
+HTACCESS = '''<IfModule mod_headers.c>
+Header set Cache-Control "public, max-age=31536000, immutable"
+</IfModule>
+'''
+CSS_URL = re.compile(r'''url\(\s*(['"]?)([^'")]+)\1\s*\)''')
+
+
+def digest(data):
+
+    return hashlib.sha1(data).hexdigest()
+
+
+def fingerprinted_name(path, data):
+
+    base, ext = os.path.splitext(path)
+    return '%s.%s%s' % (base, digest(data)[:8], ext)
+
+
+def compress(path, data):
+
+    '''Writes precompressed siblings of path. The gzip header doesn't contain
+    a timestamp, so that the same content always gives the same file.'''
+
+    write_atomic(path + '.gz', gzip.compress(data, 9, mtime=0))
+    if brotli is not None:
+        write_atomic(path + '.br', brotli.compress(data))
+
+
+def rewrite_css(content, relpath, mapping):
+
+    '''Points relative url() references in a stylesheet, whose path relative
+    to the theme folder is relpath, to fingerprinted files.'''
+
+    folder = os.path.dirname(relpath)
+
+    def _replace(m):
+        url = m.group(2)
+        if ':' in url or url.startswith('/'):
+            return m.group(0)
+        path, sep, suffix = re.match(r'([^?#]*)([?#]?)(.*)', url).groups()
+        target = os.path.normpath(os.path.join(folder, path))
+        if target not in mapping:
+            return m.group(0)
+        new_path = os.path.relpath(mapping[target], folder)
+        return 'url(%s%s%s%s%s)' % (m.group(1), new_path, sep, suffix,
+                                    m.group(1))
+
+    return CSS_URL.sub(_replace, content)
+
+
+def html_pattern(siteurl):
+
+    '''Returns a regular expression that matches references to files in the
+    theme folder, either relative to the root or starting with siteurl.'''
+
+    prefix = '(?:%s)?' % re.escape(siteurl) if siteurl else ''
+    return re.compile(r'''(?<=["'])(%s/)%s/([^"'?#\s]+)'''
+                      % (prefix, THEME_FOLDER))
+
+
+def process_html(job):
+
+    '''Rewrites references to theme files in an HTML file, and compresses
+    it if its content changed since the last run. Returns (path, manifest
+    entry, changed). This runs in a worker process.'''
+
+    path, pattern, mapping, previous = job
+    with open(path, 'rb') as fd:
+        data = fd.read()
+    content = data.decode('utf-8', 'surrogateescape')
+
+    def _replace(m):
+        if m.group(2) not in mapping:
+            return m.group(0)
+        return '%s%s/%s' % (m.group(1), ASSETS_FOLDER, mapping[m.group(2)])
+
+    new_data = pattern.sub(_replace, content).encode('utf-8',
+                                                     'surrogateescape')
+    if new_data != data:
+        write_atomic(path, new_data)
+    return (path,) + compress_file(path, new_data, previous)
+
+
+def compress_file(path, data, previous):
+
+    '''Compresses a file if it differs from when it was last compressed, and
+    returns (manifest entry, changed).'''
+
+    h = digest(data)
+    changed = previous is None or previous['hash'] != h \
+        or not os.path.exists(path + '.gz')
+    if changed:
+        compress(path, data)
+    st = os.stat(path)
+    return {'hash': h, 'size': st.st_size, 'mtime_ns': st.st_mtime_ns}, \
+        changed
+
+
+def _unchanged(path, previous):
+
+    if previous is None:
+        return False
+    st = os.stat(path)
+    return previous['size'] == st.st_size \
+        and previous['mtime_ns'] == st.st_mtime_ns
+
+
+def list_output(dirname, exclude):
+
+    for folder, dirnames, filenames in os.walk(dirname):
+        dirnames[:] = sorted(d for d in dirnames
+                             if os.path.join(folder, d) not in exclude)
+        for basename in sorted(filenames):
+            yield os.path.join(folder, basename)
+
+
+def fingerprint_theme(dirname, manifest):
+
+    '''Copies the theme files in dirname to fingerprinted files, removes
+    fingerprinted files that are no longer used, and returns a dict that
+    maps theme files to fingerprinted files.'''
+
+    theme_path = os.path.join(dirname, THEME_FOLDER)
+    assets_path = os.path.join(dirname, ASSETS_FOLDER)
+    # Stylesheets refer to other files, so they are fingerprinted last, after
+    # their references have been rewritten
+    relpaths = [os.path.relpath(path, theme_path)
+                for path in list_output(theme_path, [
+                    os.path.join(theme_path, IMPORT_FOLDER)])]
+    relpaths.sort(key=lambda relpath: relpath.endswith('.css'))
+    mapping = {}
+    for relpath in relpaths:
+        with open(os.path.join(theme_path, relpath), 'rb') as fd:
+            data = fd.read()
+        if relpath.endswith('.css'):
+            data = rewrite_css(data.decode('utf-8'), relpath,
+                               mapping).encode('utf-8')
+        mapping[relpath] = fingerprinted_name(relpath, data)
+        target = os.path.join(assets_path, mapping[relpath])
+        if not os.path.exists(target):
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            write_atomic(target, data)
+    # Fingerprinted files from before the previous run are no longer referred
+    # to by any page that a browser may have cached
+    keep = set(mapping.values()) | set(manifest.get('assets', {}).values())
+    for path in list_output(assets_path, []):
+        relpath = os.path.relpath(path, assets_path)
+        if relpath.endswith(('.gz', '.br')):
+            relpath = relpath[:-3]
+        if relpath != '.htaccess' and relpath not in keep:
+            os.remove(path)
+    for folder in IMMUTABLE_FOLDERS:
+        if os.path.isdir(os.path.join(dirname, folder)):
+            path = os.path.join(dirname, folder, '.htaccess')
+            with open(path, 'w') as fd:
+                fd.write(HTACCESS)
+    return mapping
+
+
+def fingerprint(dirname, siteurl='', manifest_path=DEFAULT_MANIFEST_PATH,
+                processes=None, paths=None):
+
+    '''Fingerprints the theme files in dirname, rewrites references to them,
+    and precompresses all text files. If paths is given, the theme is
+    assumed to be unchanged since the last run, and only the files in paths
+    are rewritten and compressed. Returns the list of files that were
+    (re)compressed.'''
+
+    manifest = load_manifest(manifest_path)
+    old_files = manifest.get('files', {})
+    theme_path = os.path.join(dirname, THEME_FOLDER)
+    if paths is None:
+        mapping = fingerprint_theme(dirname, manifest)
+        paths = list_output(dirname, [theme_path])
+        files = {}
+    else:
+        mapping = manifest.get('assets', {})
+        files = dict(old_files)
+    pattern = html_pattern(siteurl)
+    html_jobs = []
+    changed = []
+    for path in paths:
+        if not path.endswith(COMPRESS_EXTENSIONS):
+            continue
+        previous = old_files.get(path)
+        if _unchanged(path, previous):
+            files[path] = previous
+            continue
+        if path.endswith('.html'):
+            html_jobs.append((path, pattern, mapping, previous))
+            continue
+        with open(path, 'rb') as fd:
+            data = fd.read()
+        files[path], file_changed = compress_file(path, data, previous)
+        if file_changed:
+            changed.append(path)
+    if processes is None:
+        processes = os.cpu_count() or 1
+    if processes > 1 and len(html_jobs) > 1:
+        with ProcessPoolExecutor(processes) as pool:
+            results = list(pool.map(process_html, html_jobs, chunksize=8))
+    else:
+        results = [process_html(job) for job in html_jobs]
+    for path, entry, file_changed in results:
+        files[path] = entry
+        if file_changed:
+            changed.append(path)
+    print('fingerprinted %d theme files, compressed %d files'
+          % (len(mapping), len(changed)))
+    save_manifest(manifest_path, {'assets': mapping, 'files': files})
+    return changed
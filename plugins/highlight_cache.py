@@ -0,0 +1,106 @@
+# encoding=utf-8
+
+'''
+A persistent cache for Pygments syntax highlighting. install() replaces
+pygments.highlight() by a version that looks up the highlighted code in a
+cache that is keyed by the lexer and its options, the formatter and its
+options, and a hash of the code. It should be called before importing
+modules that do `from pygments import highlight`, such as Markdown's
+CodeHilite extension.
+'''
+
+import os
+import pickle
+import tempfile
+from collections import OrderedDict
+import pygments
+from render_cache import cache_key
+
+_highlight = pygments.highlight
+
+
+class HighlightCache:
+
+    def __init__(self, path, max_entries=20000):
+
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._new = {}
+        self._dirty = False
+        try:
+            with open(path, 'rb') as fd:
+                self._entries = pickle.load(fd)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            self._entries = OrderedDict()
+
+    def highlight(self, code, lexer, formatter, outfile=None):
+
+        if outfile is not None:
+            return _highlight(code, lexer, formatter, outfile)
+        key = cache_key(
+            pygments.__version__,
+            type(lexer).__name__, repr(sorted(lexer.options.items())),
+            type(formatter).__name__,
+            repr(sorted(formatter.options.items())),
+            code)
+        if key in self._entries:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key]
+        self.misses += 1
+        result = _highlight(code, lexer, formatter)
+        self._entries[key] = result
+        self._new[key] = result
+        self._dirty = True
+        return result
+
+    def take_new(self):
+
+        '''Returns and forgets the entries that were added, and the number of
+        hits and misses, since the last call. This is used to send entries
+        from worker processes back to the main process.'''
+
+        new = self._new, self.hits, self.misses
+        self._new = {}
+        self.hits = self.misses = 0
+        return new
+
+    def update(self, entries, hits=0, misses=0):
+
+        self.hits += hits
+        self.misses += misses
+        if not entries:
+            return
+        self._entries.update(entries)
+        self._dirty = True
+
+    def save(self):
+
+        # The new entries have been merged or were added in this process, and
+        # shouldn't be sent back again by processes that are forked later
+        self._new = {}
+        if not self._dirty:
+            return
+        # Least-recently used entries are at the start
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path) or '.',
+                                        suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(self._entries, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.path)
+        self._dirty = False
+
+    def report(self):
+
+        return 'highlight cache: %d hits, %d misses' % (self.hits, self.misses)
+
+
+def install(path, max_entries=20000):
+
+    cache = HighlightCache(path, max_entries)
+    pygments.highlight = cache.highlight
+    return cache
@@ -0,0 +1,379 @@
+# coding=utf-8
+
+'''
+Optimizes the generated HTML for the first paint. This is used by
+parse-theme.py and build-server.py after Pelican has generated the site, and
+before fingerprint.py rewrites references to theme files and compresses the
+output.
+
+- Whitespace is collapsed, and removed around block-level tags, and comments
+  are removed (except conditional comments). Nothing is changed inside
+  <pre>, <code>, <textarea>, <script> and <style> elements, nor inside
+  elements that are hidden or whose class starts with solution_, because
+  these contain the code and expected output of exercises (see
+  install_exercises.py), in which whitespace matters. As a safeguard, a page
+  for which this would change the text of an exercise is left alone.
+- The rules of the theme's stylesheets that a page can use are inlined in a
+  <style> element in the <head>, and the stylesheets themselves are loaded
+  asynchronously, so that they don't block rendering. A rule can be used if
+  all tag names, classes and ids in one of its selectors occur in the page,
+  or in CRITICAL_CSS_SAFELIST, for elements that are created by scripts. The
+  full stylesheets are applied once they are loaded, so it doesn't matter if
+  a rule is inlined that isn't actually needed.
+
+Pages that use the same selectors, which are typically pages that use the
+same template, get the same critical CSS, which is cached by the
+stylesheets and the set of selectors. Pages that have already been
+optimized are left alone.
+'''
+
+import os
+import re
+import json
+import hashlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from inject_constants import write_atomic, load_manifest, save_manifest
+
+DEFAULT_CACHE_PATH = '.cache/critical-css.json'
+CRITICAL_CSS_ID = 'critical-css'
+# Optimized pages record the cache key of their critical CSS
+CRITICAL_CSS_KEY = re.compile(r'<style id="%s"(?: data-key="(\w+)")?'
+                              % CRITICAL_CSS_ID)
+PRESERVE = re.compile(
+    r'(<(pre|code|textarea|script|style)\b.*?</\2\s*>)|(<!--.*?-->)|'
+    r'''(<([a-zA-Z][\w-]*)\b[^>]*?(?:\shidden(?=[\s>=/])|'''
+    r'''\sclass\s*=\s*["'][^"']*?\bsolution_)[^>]*>.*?</\5\s*>)''',
+    re.DOTALL | re.IGNORECASE)
+EXERCISE_PAYLOAD = re.compile(
+    r'''<([a-zA-Z][\w-]*)\b[^>]*?\sclass\s*=\s*["'][^"']*?\bsolution_'''
+    r'''[^>]*>.*?</\1\s*>''', re.DOTALL | re.IGNORECASE)
+WHITESPACE = re.compile(r'\s+')
+BLOCK_TAGS = ('html|head|body|title|meta|link|div|p|ul|ol|li|dl|dt|dd|'
+              'h[1-6]|table|thead|tbody|tfoot|tr|th|td|form|nav|section|'
+              'article|aside|header|footer|main|figure|figcaption|'
+              'blockquote|hr|noscript')
+AROUND_BLOCK = re.compile(r'\s*(</?(?:%s)\b[^>]*>)\s*' % BLOCK_TAGS,
+                          re.IGNORECASE)
+STYLESHEET = re.compile(r'<link\b[^>]*>', re.IGNORECASE)
+ATTRIBUTE = re.compile(r'''([\w-]+)\s*=\s*(["'])(.*?)\2''', re.DOTALL)
+START_TAG = re.compile(r'<([a-zA-Z][\w-]*)([^>]*)>')
+CSS_COMMENT = re.compile(r'/\*.*?\*/', re.DOTALL)
+CSS_URL = re.compile(r'''url\(\s*(['"]?)([^'")]+)\1\s*\)''')
+# Pseudo-classes and -elements, and attribute selectors, don't affect
+# whether a selector can match
+SELECTOR_NOISE = re.compile(r'::?[\w-]+(\([^)]*\))?|\[[^\]]*\]')
+SELECTOR_TOKEN = re.compile(r'([.#]?)(-?[_a-zA-Z][\w-]*)')
+
+
+def minify(html):
+
+    parts = []
+    end = 0
+    for m in PRESERVE.finditer(html):
+        parts.append(_minify_text(html[end:m.start()]))
+        # Conditional comments are for old versions of Internet Explorer
+        if m.group(3) is None or m.group(3).startswith('<!--['):
+            parts.append(m.group(0))
+        end = m.end()
+    parts.append(_minify_text(html[end:]))
+    return ''.join(parts)
+
+
+def exercise_payloads(html):
+
+    return [m.group(0) for m in EXERCISE_PAYLOAD.finditer(html)]
+
+
+def _minify_text(text):
+
+    text = WHITESPACE.sub(' ', text)
+    return AROUND_BLOCK.sub(r'\1', text)
+
+
+def _find_block_end(css, start):
+
+    '''Returns the position after the } that closes the block that starts at
+    start, which is the position after the {.'''
+
+    depth = 1
+    i = start
+    quote = None
+    while i < len(css):
+        ch = css[i]
+        if quote is not None:
+            if ch == '\\':
+                i += 1
+            elif ch == quote:
+                quote = None
+        elif ch in '"\'':
+            quote = ch
+        elif ch == '{':
+            depth += 1
+        elif ch == '}':
+            depth -= 1
+            if not depth:
+                return i + 1
+        i += 1
+    return len(css)
+
+
+def parse_css(css):
+
+    '''Parses a stylesheet into a list of rules. Style rules are
+    (selectors, declarations) tuples, @media and @supports rules are
+    (prelude, rules) tuples, and other at-rules are strings.'''
+
+    rules = []
+    i = 0
+    while i < len(css):
+        brace = css.find('{', i)
+        semicolon = css.find(';', i)
+        if brace < 0:
+            break
+        prelude = css[i:brace].strip()
+        if prelude.startswith('@') and 0 <= semicolon < brace:
+            # For example @charset or @import
+            rules.append(css[i:semicolon + 1].strip())
+            i = semicolon + 1
+            continue
+        end = _find_block_end(css, brace + 1)
+        body = css[brace + 1:end - 1]
+        if prelude.startswith(('@media', '@supports')):
+            rules.append((prelude, parse_css(body)))
+        elif prelude.startswith('@'):
+            rules.append(css[i:end].strip())
+        elif prelude:
+            rules.append(([s.strip() for s in prelude.split(',')],
+                          body.strip()))
+        i = end
+    return rules
+
+
+def selector_tokens(selector):
+
+    '''Returns the tag names, classes and ids that an element needs to have
+    for a selector to match, as a set of strings like 'div', '.row' and
+    '#main'.'''
+
+    selector = SELECTOR_NOISE.sub(' ', selector)
+    return {prefix + name.lower() if not prefix else prefix + name
+            for prefix, name in SELECTOR_TOKEN.findall(selector)}
+
+
+def page_tokens(html):
+
+    tokens = set()
+    for m in START_TAG.finditer(html):
+        tokens.add(m.group(1).lower())
+        for name, quote, value in ATTRIBUTE.findall(m.group(2)):
+            name = name.lower()
+            if name == 'class':
+                tokens.update('.' + cls for cls in value.split())
+            elif name == 'id':
+                tokens.add('#' + value)
+    return tokens
+
+
+class Stylesheet:
+
+    def __init__(self, href, path):
+
+        '''href is the URL of the stylesheet in the HTML, and path its path
+        on disk.'''
+
+        self.href = href
+        with open(path, 'rb') as fd:
+            data = fd.read()
+        self.digest = hashlib.sha1(data).hexdigest()
+        css = CSS_COMMENT.sub('', data.decode('utf-8'))
+        # url() references are relative to the stylesheet, and need to be
+        # relative to the page once the rules are inlined. The quotes allow
+        # fingerprint.py to recognize them.
+        folder = os.path.dirname(href)
+        css = CSS_URL.sub(lambda m: m.group(0) if ':' in m.group(2)
+                          or m.group(2).startswith('/')
+                          else 'url("%s")' % os.path.normpath(
+                              os.path.join(folder, m.group(2))), css)
+        self.rules = parse_css(css)
+        self.tokens = set()
+        self._collect_tokens(self.rules)
+
+    def _collect_tokens(self, rules):
+
+        for rule in rules:
+            if isinstance(rule, str):
+                continue
+            if isinstance(rule[1], list):
+                self._collect_tokens(rule[1])
+                continue
+            for selector in rule[0]:
+                self.tokens |= selector_tokens(selector)
+
+    def critical(self, tokens, rules=None):
+
+        '''Returns the CSS of the rules that can match an element with the
+        given tokens.'''
+
+        css = []
+        for rule in self.rules if rules is None else rules:
+            if isinstance(rule, str):
+                # @font-face rules only load fonts that are used
+                if rule.startswith('@font-face'):
+                    css.append(rule)
+                continue
+            prelude, body = rule
+            if isinstance(body, list):
+                inner = self.critical(tokens, body)
+                if inner:
+                    css.append('%s{%s}' % (prelude, inner))
+                continue
+            selectors = [s for s in prelude
+                         if selector_tokens(s) <= tokens]
+            if selectors:
+                css.append('%s{%s}' % (','.join(selectors), body))
+        return ''.join(css)
+
+
+def _theme_stylesheet(tag, siteurl):
+
+    '''Returns the href of a <link> to a stylesheet in the theme folder, or
+    None.'''
+
+    attributes = {name.lower(): value
+                  for name, quote, value in ATTRIBUTE.findall(tag)}
+    href = attributes.get('href', '')
+    if attributes.get('rel', '').lower() != 'stylesheet':
+        return None
+    if siteurl and href.startswith(siteurl + '/'):
+        href = href[len(siteurl):]
+    if not href.startswith('/theme/'):
+        return None
+    return href
+
+
+def async_link(href):
+
+    return ('<link rel="preload" href="%s" as="style" '
+            'onload="this.onload=null;this.rel=\'stylesheet\'">'
+            '<noscript><link rel="stylesheet" href="%s"></noscript>'
+            % (href, href))
+
+
+def optimize_page(job):
+
+    '''Optimizes a single page, and returns (key, css, optimized), where key
+    identifies its critical CSS, css is None if it was taken from the cache,
+    and optimized is False if the page had already been optimized. This runs
+    in a worker process.'''
+
+    path, dirname, siteurl, safelist = job
+    with open(path, encoding='utf-8', errors='surrogateescape') as fd:
+        html = fd.read()
+    m = CRITICAL_CSS_KEY.search(html)
+    if m is not None:
+        return m.group(1), None, False
+    links = [(m.group(0), _theme_stylesheet(m.group(0), siteurl))
+             for m in STYLESHEET.finditer(html)]
+    stylesheets = [_load_stylesheet(dirname, href)
+                   for tag, href in links if href is not None]
+    stylesheets = [s for s in stylesheets if s is not None]
+    result = None, None, True
+    if stylesheets:
+        tokens = page_tokens(html) | set(safelist)
+        used = set()
+        for stylesheet in stylesheets:
+            used |= tokens & stylesheet.tokens
+        key = hashlib.sha1(json.dumps(
+            [[s.href, s.digest] for s in stylesheets] + sorted(used)
+            ).encode('utf-8')).hexdigest()
+        if key in _cache:
+            css = _cache[key]
+            result = key, None, True
+        else:
+            css = ''.join(s.critical(used) for s in stylesheets)
+            result = key, css, True
+        loaded = {s.href for s in stylesheets}
+        first = True
+        for tag, href in links:
+            if href not in loaded:
+                continue
+            # The critical CSS goes where the first stylesheet was, so that
+            # the order of the rules doesn't change
+            replacement = async_link(href)
+            if first:
+                replacement = '<style id="%s" data-key="%s">%s</style>%s' % (
+                    CRITICAL_CSS_ID, key, css, replacement)
+                first = False
+            html = html.replace(tag, replacement, 1)
+    minified = minify(html)
+    if exercise_payloads(minified) != exercise_payloads(html):
+        print('not minifying %s, because this changes an exercise' % path)
+        minified = html
+    write_atomic(path, minified.encode('utf-8', 'surrogateescape'))
+    return result
+
+
+# These are inherited by the worker processes
+_stylesheets = {}
+_cache = {}
+
+
+def _load_stylesheet(dirname, href):
+
+    '''Stylesheets are parsed once per process.'''
+
+    path = os.path.join(dirname, href.lstrip('/'))
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    signature = href, st.st_mtime_ns, st.st_size
+    if _stylesheets.get(path, (None,))[0] != signature:
+        _stylesheets[path] = signature, Stylesheet(href, path)
+    return _stylesheets[path][1]
+
+
+def optimize(dirname, siteurl='', safelist=(), cache_path=DEFAULT_CACHE_PATH,
+             processes=None, paths=None):
+
+    '''Optimizes all HTML files in dirname, except for the theme folder, or
+    only the HTML files in paths. Critical CSS that is no longer used by any
+    page is removed from the cache, unless only some pages are optimized.'''
+
+    _cache.clear()
+    _cache.update(load_manifest(cache_path))
+    prune = paths is None
+    if paths is None:
+        paths = []
+        theme_path = os.path.join(dirname, 'theme')
+        for folder, dirnames, filenames in os.walk(dirname):
+            dirnames[:] = sorted(d for d in dirnames
+                                 if os.path.join(folder, d) != theme_path)
+            paths += [os.path.join(folder, basename)
+                      for basename in sorted(filenames)]
+    jobs = [(path, dirname, siteurl, list(safelist)) for path in paths
+            if path.endswith('.html')]
+    if processes is None:
+        processes = os.cpu_count() or 1
+    if processes > 1 and len(jobs) > 1 and \
+            'fork' in multiprocessing.get_all_start_methods():
+        with ProcessPoolExecutor(
+                processes,
+                mp_context=multiprocessing.get_context('fork')) as pool:
+            results = list(pool.map(optimize_page, jobs, chunksize=8))
+    else:
+        results = [optimize_page(job) for job in jobs]
+    # Pages that were already optimized also keep their critical CSS in the
+    # cache, so that it doesn't need to be rebuilt when they are generated
+    # again
+    used = {key: _cache[key] if css is None else css
+            for key, css, optimized in results
+            if key is not None and (css is not None or key in _cache)}
+    new = sum(key not in _cache for key in used)
+    if not prune:
+        used = dict(_cache, **used)
+    if used != _cache:
+        save_manifest(cache_path, used)
+    print('optimized %d pages, %d new critical stylesheets'
+          % (sum(optimized for key, css, optimized in results), new))
@@ -0,0 +1,122 @@
+# encoding=utf-8
+
+'''
+Post-processes rendered HTML in a single walk over the document:
+
+- $name$ placeholders are replaced by values from constants.yaml, both in text
+  and in attribute values (so that they can be used in links).
+- Item types (e.g. SKETCHPAD) in text are wrapped in
+  <span class="item-type">. Item types in attributes, or in already wrapped
+  spans, are left alone.
+
+Nothing is replaced inside <pre>, <code>, <script>, <style> and <textarea>
+elements. All keywords are compiled into a single regular expression that is
+factored by common prefixes (like a trie), so that the cost of matching does
+not grow linearly with the number of keywords.
+'''
+
+import re
+
+TAG = re.compile(r'<!--.*?-->|<(?P<close>/?)(?P<name>[a-zA-Z][\w-]*)[^>]*>',
+                 re.DOTALL)
+SKIP_TAGS = {'pre', 'code', 'script', 'style', 'textarea'}
+ITEM_TYPE_SPAN = '<span class="item-type">'
+
+
+def trie_pattern(words):
+
+    '''
+    Returns a regular-expression pattern that matches any of words, and
+    prefers longer matches over shorter ones. The alternatives are nested by
+    common prefix, so that at most one branch is explored per character.
+    '''
+
+    trie = {}
+    for word in words:
+        node = trie
+        for ch in word:
+            node = node.setdefault(ch, {})
+        node[''] = {}
+    return _node_pattern(trie)
+
+
+def _node_pattern(node):
+
+    alternatives = [re.escape(ch) + _node_pattern(child)
+                    for ch, child in sorted(node.items()) if ch]
+    if not alternatives:
+        return ''
+    optional = '' in node
+    if len(alternatives) == 1 and not optional:
+        return alternatives[0]
+    pattern = '(?:%s)' % '|'.join(alternatives)
+    # The quantifier is greedy, so longer keywords win over their prefixes
+    return pattern + '?' if optional else pattern
+
+
+class HTMLPostProcessor:
+
+    def __init__(self, constants, item_types):
+
+        self._constants = {u'$%s$' % var: str(val)
+                           for var, val in constants.items()}
+        self._item_types = {item_type: u'<span class="item-type">%s</span>'
+                            % item_type.lower() for item_type in item_types}
+        alternatives = []
+        if constants:
+            self._constant_re = re.compile(
+                r'\$(?:%s)\$' % trie_pattern(constants))
+            alternatives.append(self._constant_re.pattern)
+        else:
+            self._constant_re = None
+        if item_types:
+            alternatives.append(r'(?<!\w)(?:%s)(?!\w)'
+                                % trie_pattern(item_types))
+        self._text_re = re.compile('|'.join(alternatives)) \
+            if alternatives else None
+
+    def _replace(self, m):
+
+        s = m.group(0)
+        if s in self._constants:
+            return self._constants[s]
+        return self._item_types[s]
+
+    def __call__(self, html):
+
+        if self._text_re is None:
+            return html
+        chunks = []
+        pos = 0
+        skip = None  # The name of the element that we're skipping
+        depth = 0  # Nesting depth of that element
+        for m in TAG.finditer(html):
+            text = html[pos:m.start()]
+            tag = m.group(0)
+            pos = m.end()
+            if skip is None:
+                chunks.append(self._text_re.sub(self._replace, text))
+                if self._constant_re is not None and m.group('name'):
+                    tag = self._constant_re.sub(self._replace, tag)
+            else:
+                chunks.append(text)
+            chunks.append(tag)
+            name = m.group('name')
+            if name is None:  # Comment
+                continue
+            name = name.lower()
+            closing = m.group('close') == '/'
+            if skip is None:
+                if closing:
+                    continue
+                if name in SKIP_TAGS or tag == ITEM_TYPE_SPAN:
+                    skip = name
+                    depth = 1
+            elif name == skip:
+                depth += -1 if closing else 1
+                if not depth:
+                    skip = None
+        text = html[pos:]
+        chunks.append(text if skip is not None
+                      else self._text_re.sub(self._replace, text))
+        return u''.join(chunks)
@@ -0,0 +1,289 @@
+# coding=utf-8
+
+'''
+Responsive figures. Instead of the original, often multi-megabyte, images,
+figures are served as resized and recompressed derivatives: WebP, with the
+original format as a fallback, at several widths. rewrite() turns the <img>
+tags in the rendered HTML into <picture> elements with a srcset, the
+intrinsic width and height of the image, and loading="lazy".
+
+The derivatives are generated after the build by build_derivatives(), in a
+pool of worker processes. They are named after a hash of the original image,
+and cached, so that every image is resized only once, however often the site
+is built.
+
+Pillow is optional. Without it, images are served as they are, and are only
+given loading="lazy".
+
+The rendered HTML refers to derivatives by name, so the widths and whether
+Pillow is available (see ImageIndex.config) need to be part of the key of
+anything that caches it. A page that is taken from such a cache also needs
+to register() the images that rewrite() found, so that their derivatives
+are built.
+'''
+
+import io
+import os
+import re
+import json
+import shutil
+import hashlib
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from dependencies import signature
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+EXTENSIONS = ('.png', '.jpg', '.jpeg')
+DEFAULT_WIDTHS = 480, 960, 1440
+# The content column is 750 pixels wide on medium and large screens
+SIZES = '(min-width: 992px) 750px, 100vw'
+# The folder in the output to which derivatives are copied
+OUTPUT_FOLDER = 'images'
+IMG_TAG = re.compile(r'<img\s[^>]*>')
+ATTRIBUTE = re.compile(r'([\w-]+)="([^"]*)"')
+
+
+def derivative_name(entry, width, ext):
+
+    return '%s-%d%s' % (entry['digest'][:16], width, ext)
+
+
+def write_atomic(path, data):
+
+    folder = os.path.dirname(path) or '.'
+    fd, tmp_path = tempfile.mkstemp(dir=folder, suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def generate(job):
+
+    '''Generates the derivatives of a single image that are not cached yet.
+    This runs in a worker process.'''
+
+    path, derivatives, cache_path = job
+    with Image.open(path) as im:
+        im.load()
+        for name, width, ext in derivatives:
+            height = max(1, round(im.height * width / im.width))
+            resized = im if width == im.width \
+                else im.resize((width, height), Image.LANCZOS)
+            fd = io.BytesIO()
+            if ext == '.webp':
+                resized.save(fd, 'WEBP', quality=80, method=4)
+            elif ext == '.png':
+                resized.save(fd, 'PNG', optimize=True)
+            else:
+                if resized.mode not in ('RGB', 'L'):
+                    resized = resized.convert('RGB')
+                resized.save(fd, 'JPEG', quality=85, optimize=True,
+                             progressive=True)
+            data = fd.getvalue()
+            # Recompressing doesn't always help, and the original is a valid
+            # fallback at its own width
+            if width == im.width and path.lower().endswith(ext) \
+                    and len(data) >= os.path.getsize(path):
+                with open(path, 'rb') as original:
+                    data = original.read()
+            write_atomic(os.path.join(cache_path, name), data)
+    return path
+
+
+class ImageIndex:
+
+    '''Keeps track of the images that are used by pages, with their hash and
+    size. The index is kept on disk, and an image is only read again when
+    its modification time or size changes.'''
+
+    def __init__(self, cache_path, widths=DEFAULT_WIDTHS):
+
+        self.cache_path = cache_path
+        self.widths = sorted(widths)
+        self._index_path = os.path.join(cache_path, 'index.json')
+        try:
+            with open(self._index_path) as fd:
+                self._images = json.load(fd)
+        except (OSError, ValueError):
+            self._images = {}
+        self._new = {}
+        self._dirty = False
+
+    @property
+    def config(self):
+
+        '''A string that identifies the settings that affect rewrite().'''
+
+        return '%s:%s' % (Image is not None,
+                          ','.join(str(width) for width in self.widths))
+
+    def info(self, path):
+
+        '''Returns a dict with the hash, width, height and extension of an
+        image, or None if path is not an image that can be resized.'''
+
+        if Image is None or not path.lower().endswith(EXTENSIONS):
+            return None
+        path = os.path.relpath(path)
+        sig = signature(path)
+        if sig is None:
+            return None
+        entry = self._images.get(path)
+        if entry is not None and entry['signature'] == sig:
+            return entry
+        with open(path, 'rb') as fd:
+            data = fd.read()
+        try:
+            with Image.open(io.BytesIO(data)) as im:
+                width, height = im.size
+        except (OSError, ValueError):
+            return None
+        ext = os.path.splitext(path)[1].lower().replace('.jpeg', '.jpg')
+        entry = {'signature': sig, 'digest': hashlib.sha1(data).hexdigest(),
+                 'width': width, 'height': height, 'ext': ext}
+        self._images[path] = self._new[path] = entry
+        self._dirty = True
+        return entry
+
+    def derivatives(self, entry):
+
+        '''Returns a list of (name, width, extension) tuples, from small to
+        large. Images are never scaled up.'''
+
+        widths = [width for width in self.widths if width < entry['width']]
+        widths.append(entry['width'])
+        return [(derivative_name(entry, width, ext), width, ext)
+                for width in widths for ext in ('.webp', entry['ext'])]
+
+    def register(self, images):
+
+        '''Adds images, a dict of paths and hashes as returned by rewrite(),
+        to the index. Returns False if any of them changed, in which case the
+        HTML that refers to them is outdated.'''
+
+        for path, digest in images.items():
+            entry = self.info(path)
+            if entry is None or entry['digest'] != digest:
+                return False
+        return True
+
+    def items(self):
+
+        return sorted(self._images.items())
+
+    def take_new(self):
+
+        '''Returns and forgets the entries that were added since the last
+        call. This is used to send entries from worker processes back to the
+        main process.'''
+
+        new = self._new
+        self._new = {}
+        return new
+
+    def update(self, entries):
+
+        if entries:
+            self._images.update(entries)
+            self._dirty = True
+
+    def save(self):
+
+        if not self._dirty:
+            return
+        os.makedirs(self.cache_path, exist_ok=True)
+        write_atomic(self._index_path, json.dumps(
+            self._images, indent=1, sort_keys=True).encode('utf-8'))
+        self._dirty = False
+
+
+def rewrite(html, index, siteurl, content_path):
+
+    '''Turns <img> tags that refer to images in content_path into <picture>
+    elements with responsive derivatives. Other images, and all images if
+    Pillow is not available, are only given loading="lazy". Returns the HTML
+    and a dict with the paths and hashes of the images that were turned into
+    <picture> elements.'''
+
+    images = {}
+
+    def _rewrite(m):
+        tag = m.group(0)
+        attrs = dict(ATTRIBUTE.findall(tag))
+        if 'srcset' in attrs or 'src' not in attrs:
+            return tag
+        attrs.setdefault('loading', 'lazy')
+        src = attrs['src']
+        entry = None
+        if src.startswith(siteurl + '/'):
+            entry = index.info(os.path.join(content_path,
+                                            src[len(siteurl) + 1:]))
+        if entry is None:
+            return _tag('img', attrs)
+        images[os.path.relpath(os.path.join(
+            content_path, src[len(siteurl) + 1:]))] = entry['digest']
+        derivatives = index.derivatives(entry)
+        base = '%s/%s/' % (siteurl, OUTPUT_FOLDER)
+        srcsets = {}
+        for name, width, ext in derivatives:
+            srcsets.setdefault(ext, []).append(
+                '%s%s %dw' % (base, name, width))
+        attrs['src'] = base + derivatives[-1][0]
+        attrs['srcset'] = ', '.join(srcsets[entry['ext']])
+        attrs['sizes'] = SIZES
+        attrs['width'] = str(entry['width'])
+        attrs['height'] = str(entry['height'])
+        source = _tag('source', {'type': 'image/webp',
+                                 'srcset': ', '.join(srcsets['.webp']),
+                                 'sizes': SIZES})
+        return '<picture>%s%s</picture>' % (source, _tag('img', attrs))
+
+    return IMG_TAG.sub(_rewrite, html), images
+
+
+def _tag(name, attrs):
+
+    return '<%s %s />' % (name, ' '.join('%s="%s"' % item
+                                          for item in attrs.items()))
+
+
+def build_derivatives(index, output_path, processes=None):
+
+    '''Generates the derivatives of all images in the index that are not
+    cached yet, and copies them to the output folder if they are not there
+    yet.'''
+
+    if Image is None:
+        return
+    os.makedirs(index.cache_path, exist_ok=True)
+    jobs = []
+    names = []
+    for path, entry in index.items():
+        if signature(path) != entry['signature']:
+            continue
+        derivatives = index.derivatives(entry)
+        names += [name for name, width, ext in derivatives]
+        missing = [derivative for derivative in derivatives if not
+                   os.path.exists(os.path.join(index.cache_path,
+                                               derivative[0]))]
+        if missing:
+            jobs.append((path, missing, index.cache_path))
+    if processes is None:
+        processes = os.cpu_count() or 1
+    if processes > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(processes) as pool:
+            for path in pool.map(generate, jobs):
+                print('resized %s' % path)
+    else:
+        for job in jobs:
+            print('resized %s' % generate(job))
+    folder = os.path.join(output_path, OUTPUT_FOLDER)
+    os.makedirs(folder, exist_ok=True)
+    for name in names:
+        target = os.path.join(folder, name)
+        # Derivatives are named after their content, so they never change
+        if not os.path.exists(target):
+            shutil.copyfile(os.path.join(index.cache_path, name), target)
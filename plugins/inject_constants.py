@@ -0,0 +1,159 @@
+# coding=utf-8
+
+'''
+Replaces $name$ placeholders in generated JavaScript files by values from
+constants.yaml. This is used by parse-theme.py after Pelican has generated
+the site.
+
+A manifest keeps track of the files that have already been processed, so that
+only files that are new or changed since the last run (or all files, if the
+constants changed) are read again. Files in which nothing needs to be
+replaced are never written, so that their modification time, and hence any
+cache that depends on it, is left alone. Files that do change are written
+atomically, and the work is spread over a pool of worker processes.
+'''
+
+import os
+import re
+import json
+import hashlib
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from html_postprocess import trie_pattern
+
+DEFAULT_MANIFEST_PATH = '.cache/parse-theme.json'
+# The permissions of new files, as they would be without mkstemp(). The
+# umask can only be read by setting it, which isn't safe to do while other
+# threads create files, so this is done once.
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+DEFAULT_MODE = 0o666 & ~_UMASK
+
+
+def constants_hash(const):
+
+    return hashlib.sha1(json.dumps(sorted(
+        (str(var), str(val)) for var, val in const.items())).encode('utf-8')
+        ).hexdigest()
+
+
+def replace_constants(content, const):
+
+    '''Replaces all $name$ placeholders in a single pass.'''
+
+    if not const:
+        return content
+    values = {u'$%s$' % var: str(val) for var, val in const.items()}
+    pattern = re.compile(r'\$(?:%s)\$' % trie_pattern(const))
+    return pattern.sub(lambda m: values[m.group(0)], content)
+
+
+def write_atomic(path, content):
+
+    '''Writes content to a temporary file, which then replaces path, so that
+    readers never see a partially written file. Existing files keep their
+    permissions, but files that were written with the permissions of
+    mkstemp() (readable only by the owner) become readable again.'''
+
+    folder = os.path.dirname(path) or '.'
+    fd, tmp_path = tempfile.mkstemp(dir=folder, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+        # mkstemp() creates files that only the owner can read, which the
+        # web server may not be
+        mode = DEFAULT_MODE
+        if os.path.exists(path):
+            mode |= os.stat(path).st_mode & 0o777
+        os.chmod(tmp_path, mode)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def process_file(job):
+
+    '''Processes a single file and returns (path, manifest entry, changed).'''
+
+    path, const, const_digest, previous = job
+    with open(path, 'rb') as fd:
+        data = fd.read()
+    digest = hashlib.sha1(data).hexdigest()
+    changed = False
+    # If the file has the same content as when we last saw it, it has already
+    # been processed with the same constants
+    if previous is None or previous['hash'] != digest \
+            or previous['constants'] != const_digest:
+        content = data.decode('utf-8', 'surrogateescape')
+        new_data = replace_constants(content, const).encode(
+            'utf-8', 'surrogateescape')
+        if new_data != data:
+            write_atomic(path, new_data)
+            digest = hashlib.sha1(new_data).hexdigest()
+            changed = True
+    st = os.stat(path)
+    entry = {'hash': digest, 'constants': const_digest,
+             'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+    return path, entry, changed
+
+
+def load_manifest(manifest_path):
+
+    try:
+        with open(manifest_path) as fd:
+            return json.load(fd)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_manifest(manifest_path, manifest):
+
+    folder = os.path.dirname(manifest_path) or '.'
+    os.makedirs(folder, exist_ok=True)
+    write_atomic(manifest_path,
+                 json.dumps(manifest, sort_keys=True).encode('utf-8'))
+
+
+def parse_folder(dirname, const, manifest_path=DEFAULT_MANIFEST_PATH,
+                 processes=None, extensions=('.js',)):
+
+    '''Processes all files with the given extensions in dirname (recursively),
+    and returns the list of files that were changed.'''
+
+    manifest = load_manifest(manifest_path)
+    const_digest = constants_hash(const)
+    jobs = []
+    new_manifest = {}
+    for folder, dirnames, filenames in os.walk(dirname):
+        dirnames.sort()
+        for basename in sorted(filenames):
+            if not basename.endswith(extensions):
+                continue
+            path = os.path.join(folder, basename)
+            previous = manifest.get(path)
+            st = os.stat(path)
+            # Files that haven't been touched since the last run are skipped
+            # without reading them
+            if previous is not None \
+                    and previous['constants'] == const_digest \
+                    and previous['size'] == st.st_size \
+                    and previous['mtime_ns'] == st.st_mtime_ns:
+                new_manifest[path] = previous
+                continue
+            jobs.append((path, const, const_digest, previous))
+    if processes is None:
+        processes = os.cpu_count() or 1
+    if processes > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(processes) as pool:
+            results = list(pool.map(process_file, jobs, chunksize=8))
+    else:
+        results = [process_file(job) for job in jobs]
+    changed = []
+    for path, entry, file_changed in results:
+        new_manifest[path] = entry
+        if file_changed:
+            print('processed %s' % path)
+            changed.append(path)
+    save_manifest(manifest_path, new_manifest)
+    return changed
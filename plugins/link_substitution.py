@@ -0,0 +1,49 @@
+# encoding=utf-8
+
+'''
+Substitutes %link:name%, %url:name% and %static:path% directives in a single
+scan over the text. The output is built from slices of the input, so the cost
+is linear in the size of the text, regardless of the number of directives.
+'''
+
+import re
+
+DIRECTIVE = re.compile(
+    r'%(?:(?P<kind>link|url):(?P<link>[\w/-]+)|static:(?P<static>[\w/.-]+))%')
+
+
+class UnresolvedLinks(Exception): pass
+
+
+def substitute_links(text, links, siteurl):
+
+    '''
+    Replaces all directives in text. %link:% and %url:% directives are resolved
+    through the links table (see process_links()); %static:% directives are
+    taken as paths relative to siteurl. If any links cannot be resolved, a
+    single UnresolvedLinks exception lists all of them.
+    '''
+
+    chunks = []
+    unresolved = []
+    pos = 0
+    for m in DIRECTIVE.finditer(text):
+        chunks.append(text[pos:m.start()])
+        pos = m.end()
+        static = m.group('static')
+        if static is not None:
+            chunks.append('<%s/%s>' % (siteurl, static))
+            continue
+        link = m.group('link')
+        if link not in links:
+            unresolved.append(link)
+            continue
+        if m.group('kind') == 'link':
+            chunks.append('<%s/%s>' % (siteurl, links[link]))
+        else:
+            chunks.append('%s/%s' % (siteurl, links[link]))
+    if unresolved:
+        raise UnresolvedLinks(u'not a key in the links table: %s'
+                              % u', '.join(sorted(set(unresolved))))
+    chunks.append(text[pos:])
+    return u''.join(chunks)
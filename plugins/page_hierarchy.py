@@ -1,11 +1,20 @@
 from pelican import signals, contents
 import os.path
+import sys
 from copy import copy
 from itertools import chain
+sys.path.insert(0, os.path.dirname(__file__))
+import profiler
+from sitemap import load as load_sitemap
 
 '''
 This plugin creates a URL hierarchy for pages that matches the
-directory hierarchy of their sources.
+directory hierarchy of their sources. It also links every page that is
+listed in sitemap.yaml to the pages before and after it in the same
+section (previous_page and next_page), so that templates can hint the
+browser to fetch the next page in advance (see prefetch.html). The
+sitemap_path of these pages is their path as used in the sitemap, e.g.
+basic/syntax.
 '''
 
 class UnexpectedException(Exception): pass
@@ -25,6 +34,7 @@ def in_default_lang(page):
     # page.in_default_lang property is undocumented (=unstable) interface
     return page.lang == page.settings['DEFAULT_LANG']
 
+@profiler.profiled('page_hierarchy.override_metadata')
 def override_metadata(content_object):
     if type(content_object) is not contents.Page:
         return
@@ -44,40 +54,77 @@ def override_metadata(content_object):
         if not hasattr(page, 'override_' + key):
             setattr(page, 'override_' + key, _override_value(page, key))
 
+@profiler.profiled('page_hierarchy.set_relationships')
 def set_relationships(generator):
     def _all_pages():
         return chain(generator.pages, generator.translations)
 
-    # initialize parents and children lists
+    # initialize parents and children lists, and index pages by URL and, for
+    # the translation fallback below, by slug and source directory
+    pages_by_url = {}
+    pages_by_source = {}
     for page in _all_pages():
         page.parent = None
         page.parents = []
         page.children = []
+        pages_by_url.setdefault(page.url, []).append(page)
+    for page in generator.pages:
+        key = page.slug, os.path.dirname(page.source_path)
+        pages_by_source.setdefault(key, []).append(page)
 
     # set immediate parents and children
     for page in _all_pages():
         # Parent of /a/b/ is /a/, parent of /a/b.html is /a/
         parent_url = os.path.dirname(page.url[:-1])
         if parent_url: parent_url += '/'
-        for page2 in _all_pages():
-            if page2.url == parent_url and page2 != page:
+        for page2 in pages_by_url.get(parent_url, []):
+            if page2 != page:
                 page.parent = page2
                 page2.children.append(page)
         # If no parent found, try the parent of the default language page
         if not page.parent and not in_default_lang(page):
-            for page2 in generator.pages:
-                if (page.slug == page2.slug and
-                    os.path.dirname(page.source_path) ==
-                    os.path.dirname(page2.source_path)):
-                    # Only set the parent but not the children, obviously
-                    page.parent = page2.parent
+            key = page.slug, os.path.dirname(page.source_path)
+            for page2 in pages_by_source.get(key, []):
+                # Only set the parent but not the children, obviously
+                page.parent = page2.parent
 
     # set all parents (ancestors)
     for page in _all_pages():
         p = page
         while p.parent:
-            page.parents.insert(0, p.parent)
+            page.parents.append(p.parent)
             p = p.parent
+        page.parents.reverse()
+
+    set_sequences(generator)
+
+def set_sequences(generator):
+    for page in chain(generator.pages, generator.translations):
+        page.previous_page = None
+        page.next_page = None
+    # Pages are saved as {slug}/index.html, and the slug is the path in the
+    # sitemap
+    pages_by_path = {}
+    for page in generator.pages:
+        pages_by_path[os.path.dirname(page.save_as)] = page
+    # Without a sitemap, for example when the plugin is used on its own,
+    # pages are not linked
+    try:
+        sitemap = load_sitemap()
+    except OSError:
+        return
+    # A section of the sitemap is a course, so the last page of one course
+    # doesn't lead to the first page of the next
+    for sequence in sitemap.sequences():
+        pages = []
+        for pagename, entry in sequence:
+            if entry in pages_by_path:
+                page = pages_by_path[entry]
+                page.sitemap_path = entry
+                pages.append(page)
+        for page, next_page in zip(pages, pages[1:]):
+            page.next_page = next_page
+            next_page.previous_page = page
 
 
 def register():
@@ -0,0 +1,182 @@
+# coding=utf-8
+
+'''
+An opt-in profiler for the build. When enabled (see BUILD_PROFILE in
+baseconf.py), the wall time and the memory allocated by each stage of the
+build are recorded for each page, and written to a JSON report at the end of
+the build. Stages that are not specific to a page, such as the page_hierarchy
+signal handlers, are recorded for the site as a whole.
+
+The report can be checked against a budget, for example in CI:
+
+    python3 plugins/profiler.py profile.json budget.yaml
+
+where budget.yaml maps stage names to a maximum total time in seconds, and
+optionally 'page' to a maximum time per page. The exit status is 1 if the
+budget is exceeded.
+'''
+
+import os
+import sys
+import json
+import time
+import functools
+import tracemalloc
+from contextlib import contextmanager
+import yaml
+
+SITE = '(site)'
+enabled = False
+trace_allocations = False
+# Maps pages to stages to [seconds, bytes, count]
+_records = {}
+
+
+def enable(allocations=True):
+
+    global enabled, trace_allocations
+    enabled = True
+    trace_allocations = allocations
+    if allocations and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+@contextmanager
+def stage(name, page=SITE):
+
+    '''Records the time and memory that the body takes. Stages should not be
+    nested, because the allocation peak is reset at the start of each stage.'''
+
+    if not enabled:
+        yield
+        return
+    if trace_allocations:
+        tracemalloc.reset_peak()
+        start_memory = tracemalloc.get_traced_memory()[0]
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        dt = time.perf_counter() - t0
+        allocated = tracemalloc.get_traced_memory()[1] - start_memory \
+            if trace_allocations else 0
+        record(page, name, dt, allocated)
+
+
+def profiled(name):
+
+    '''A decorator that records each call of a function as a stage.'''
+
+    def decorator(fnc):
+        @functools.wraps(fnc)
+        def inner(*args, **kwargs):
+            with stage(name):
+                return fnc(*args, **kwargs)
+        return inner
+    return decorator
+
+
+def record(page, name, seconds, allocated=0, count=1):
+
+    entry = _records.setdefault(page, {}).setdefault(name, [0, 0, 0])
+    entry[0] += seconds
+    entry[1] = max(entry[1], allocated)
+    entry[2] += count
+
+
+def take_records():
+
+    '''Returns and forgets all records. This is used to send records from
+    worker processes back to the main process.'''
+
+    global _records
+    records = _records
+    _records = {}
+    return records
+
+
+def merge(records):
+
+    for page, stages in records.items():
+        for name, (seconds, allocated, count) in stages.items():
+            record(page, name, seconds, allocated, count)
+
+
+def report(top_n=10):
+
+    '''Returns the report as a dict.'''
+
+    pages = {}
+    stages = {}
+    for page, page_stages in _records.items():
+        pages[page] = {
+            'total': sum(v[0] for v in page_stages.values()),
+            'stages': {name: {'time': v[0], 'allocated': v[1], 'count': v[2]}
+                       for name, v in page_stages.items()}
+            }
+        for name, (seconds, allocated, count) in page_stages.items():
+            total = stages.setdefault(name, {'time': 0, 'allocated': 0,
+                                             'count': 0})
+            total['time'] += seconds
+            total['allocated'] = max(total['allocated'], allocated)
+            total['count'] += count
+    slowest = sorted((page for page in pages if page != SITE),
+                     key=lambda page: pages[page]['total'], reverse=True)
+    return {
+        'stages': stages,
+        'slowest': [[page, pages[page]['total']] for page in slowest[:top_n]],
+        'pages': pages
+        }
+
+
+def write_report(path, top_n=10):
+
+    data = report(top_n)
+    folder = os.path.dirname(path)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    with open(path, 'w') as fd:
+        json.dump(data, fd, indent=1, sort_keys=True)
+    print('Build profile written to %s' % path)
+    for name, total in sorted(data['stages'].items(),
+                              key=lambda item: -item[1]['time']):
+        print('%10.3f s  %s' % (total['time'], name))
+    for page, seconds in data['slowest']:
+        print('%10.3f s  %s' % (seconds, page))
+
+
+def check_budget(data, budget):
+
+    '''Returns a list of messages for all budgets that are exceeded.'''
+
+    failures = []
+    for name, limit in budget.items():
+        if name == 'page':
+            for page, page_data in data['pages'].items():
+                if page != SITE and page_data['total'] > limit:
+                    failures.append('%s: %.3f s > %.3f s'
+                                    % (page, page_data['total'], limit))
+            continue
+        seconds = data['stages'].get(name, {}).get('time', 0)
+        if seconds > limit:
+            failures.append('%s: %.3f s > %.3f s' % (name, seconds, limit))
+    return failures
+
+
+def main():
+
+    if len(sys.argv) != 3:
+        print(__doc__)
+        sys.exit(2)
+    with open(sys.argv[1]) as fd:
+        data = json.load(fd)
+    with open(sys.argv[2]) as fd:
+        budget = yaml.load(fd, Loader=yaml.SafeLoader)
+    failures = check_budget(data, budget)
+    for failure in failures:
+        print('over budget: %s' % failure)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,173 @@
+# encoding=utf-8
+
+'''
+A persistent, content-addressed cache for rendered pages. Every entry is a
+pickle file in the cache folder, named after the hash of everything that went
+into rendering it. Entries are never invalidated explicitly: if any input
+changes, the key changes, and the old entry is eventually evicted once the
+cache grows beyond its size cap (least-recently used first).
+
+Recently used entries are also kept in memory, so that a long-running process
+(see build-server.py) doesn't need to read them from disk again.
+'''
+
+import os
+import pickle
+import hashlib
+import tempfile
+from collections import OrderedDict
+
+
+def cache_key(*parts):
+
+    '''Return a hex digest for a sequence of str or bytes parts.'''
+
+    h = hashlib.sha1()
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode('utf-8')
+        # Prefix the length so that ('ab', 'c') and ('a', 'bc') differ
+        h.update(b'%d:' % len(part))
+        h.update(part)
+    return h.hexdigest()
+
+
+class RenderCache:
+
+    def __init__(self, path, max_size=256 * 1024 ** 2,
+                 memory_size=64 * 1024 ** 2):
+
+        self.path = path
+        self.max_size = max_size
+        self.memory_size = memory_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._index = None
+        # The total size of the entries in the index
+        self._size = 0
+        # Maps keys to (value, size), least-recently used first
+        self._memory = OrderedDict()
+        self._memory_used = 0
+
+    def _entry_path(self, key):
+
+        return os.path.join(self.path, key + '.pickle')
+
+    def _load_index(self):
+
+        # The index maps keys to (last use, size). It is built lazily from the
+        # file system, so that a build with only hits never lists the folder.
+        if self._index is not None:
+            return
+        self._index = {}
+        self._size = 0
+        if not os.path.isdir(self.path):
+            return
+        for entry in os.scandir(self.path):
+            if not entry.name.endswith('.pickle'):
+                continue
+            st = entry.stat()
+            self._index[entry.name[:-7]] = st.st_mtime, st.st_size
+            self._size += st.st_size
+
+    @property
+    def size(self):
+
+        self._load_index()
+        return self._size
+
+    def get(self, key):
+
+        '''Return the cached value for key, or None.'''
+
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            self.hits += 1
+            return self._memory[key][0]
+        path = self._entry_path(key)
+        try:
+            with open(path, 'rb') as fd:
+                data = fd.read()
+            value = pickle.loads(data)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._remember(key, value, len(data))
+        # Touch the entry so that eviction is least-recently used
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        if self._index is not None and key in self._index:
+            self._index[key] = os.path.getmtime(path), self._index[key][1]
+        return value
+
+    def put(self, key, value):
+
+        os.makedirs(self.path, exist_ok=True)
+        data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        path = self._entry_path(key)
+        os.replace(tmp_path, path)
+        self._remember(key, value, len(data))
+        self._load_index()
+        if key in self._index:
+            self._size -= self._index[key][1]
+        self._index[key] = os.path.getmtime(path), len(data)
+        self._size += len(data)
+        self._evict()
+
+    def _remember(self, key, value, size):
+
+        if size > self.memory_size:
+            return
+        if key in self._memory:
+            self._memory_used -= self._memory.pop(key)[1]
+        self._memory[key] = value, size
+        self._memory_used += size
+        while self._memory_used > self.memory_size:
+            self._memory_used -= self._memory.popitem(last=False)[1][1]
+
+    def _evict(self):
+
+        if self.size <= self.max_size:
+            return
+        for key, (mtime, size) in sorted(self._index.items(),
+                                         key=lambda item: item[1][0]):
+            try:
+                os.remove(self._entry_path(key))
+            except OSError:
+                pass
+            del self._index[key]
+            if key in self._memory:
+                self._memory_used -= self._memory.pop(key)[1]
+            self.evictions += 1
+            self._size -= size
+            if self._size <= self.max_size:
+                break
+
+    def clear(self):
+
+        self._load_index()
+        for key in list(self._index):
+            try:
+                os.remove(self._entry_path(key))
+            except OSError:
+                pass
+        self._index = {}
+        self._size = 0
+        self._memory.clear()
+        self._memory_used = 0
+
+    def reset_counters(self):
+
+        self.hits = self.misses = self.evictions = 0
+
+    def report(self):
+
+        return 'render cache: %d hits, %d misses, %d evictions' % (
+            self.hits, self.misses, self.evictions)
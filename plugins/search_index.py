@@ -0,0 +1,147 @@
+# coding=utf-8
+
+'''
+Builds a static search index, which is queried in the browser by
+themes/cogsci/static/js/search.js, so that search doesn't need a server.
+
+When a page is rendered, page_document() extracts its searchable content:
+the weight of every term in the text, and the headings from the table of
+contents. This is cached with the rendered page, so that only pages that
+are rendered again need to be tokenized again. At the end of the build,
+SearchIndex combines the documents into an inverted index that is split
+into shards by the first two characters of each term, so that the browser
+only fetches the shards that contain the terms of a query. All files are
+named after a hash of their content, except for search/index.json, which
+lists the others.
+'''
+
+import os
+import re
+import json
+import html
+import hashlib
+from collections import Counter
+from inject_constants import write_atomic
+
+# Bump this when the format of the index changes
+VERSION = 1
+SEARCH_FOLDER = 'search'
+TITLE_WEIGHT = 10
+HEADING_WEIGHT = 5
+TAG = re.compile(r'<[^>]+>')
+WORD = re.compile(r'\w+')
+SHARD_PREFIX = re.compile(r'[a-z0-9]{2}')
+STOPWORDS = frozenset('''
+a an and are as at be but by can do does for from has have how if in into is
+it its not of on or so than that the their then there these this to was we
+what when which will with you your
+'''.split())
+
+
+def tokenize(text):
+
+    return [term for term in WORD.findall(text.lower())
+            if len(term) > 1 and term not in STOPWORDS]
+
+
+def shard_name(term):
+
+    '''Terms are sharded by their first two characters, or collected in a
+    single shard if these are not ASCII letters or digits.'''
+
+    return term[:2] if SHARD_PREFIX.match(term) else '_'
+
+
+def flatten_toc(toc_tokens):
+
+    headings = []
+    for token in toc_tokens:
+        headings.append([token['id'], html.unescape(token['name'])])
+        headings += flatten_toc(token['children'])
+    return headings
+
+
+def page_document(content, toc_tokens):
+
+    '''Returns the searchable content of a rendered page, as a dict with the
+    headings (as [id, name] lists) and the weight of each term.'''
+
+    weights = Counter(tokenize(html.unescape(TAG.sub(' ', content))))
+    headings = flatten_toc(toc_tokens)
+    for heading_id, name in headings:
+        for term in tokenize(name):
+            weights[term] += HEADING_WEIGHT
+    return {'headings': headings, 'terms': dict(weights)}
+
+
+def _dumps(data):
+
+    return json.dumps(data, separators=(',', ':'), sort_keys=True,
+                      ensure_ascii=False).encode('utf-8')
+
+
+class SearchIndex:
+
+    def __init__(self):
+
+        self._pages = {}
+
+    def add(self, url, title, document):
+
+        self._pages[url] = title, document
+
+    def clear(self):
+
+        self._pages.clear()
+
+    def write(self, output_path):
+
+        '''Writes the index to the search folder in output_path. Files that
+        are already there are not written again, and files that are no
+        longer used are removed.'''
+
+        folder = os.path.join(output_path, SEARCH_FOLDER)
+        os.makedirs(folder, exist_ok=True)
+        docs = []
+        shards = {}
+        for doc, url in enumerate(sorted(self._pages)):
+            title, document = self._pages[url]
+            docs.append([url, title, document['headings']])
+            weights = Counter(document['terms'])
+            for term in tokenize(title):
+                weights[term] += TITLE_WEIGHT
+            for term, weight in weights.items():
+                # Postings are flat lists of document, weight pairs
+                shards.setdefault(shard_name(term), {}).setdefault(
+                    term, []).extend([doc, weight])
+        docs_name = self._write_file(folder, 'docs', _dumps(docs))
+        files = {shard: self._write_file(folder, shard, _dumps(terms))
+                 for shard, terms in shards.items()}
+        index = {'version': VERSION, 'docs': docs_name, 'shards': files,
+                 'stopwords': sorted(STOPWORDS)}
+        index_path = os.path.join(folder, 'index.json')
+        # Files from the previous index are kept, for browsers that are still
+        # using it
+        try:
+            with open(index_path) as fd:
+                previous = json.load(fd)
+        except (OSError, ValueError):
+            previous = {'docs': None, 'shards': {}}
+        keep = {'index.json', docs_name, previous['docs']} \
+            | set(files.values()) | set(previous['shards'].values())
+        write_atomic(index_path, _dumps(index))
+        for basename in os.listdir(folder):
+            # Precompressed siblings (see fingerprint.py) go with their file
+            if basename.endswith(('.gz', '.br')) and basename[:-3] in keep:
+                continue
+            if basename not in keep:
+                os.remove(os.path.join(folder, basename))
+        print('search index: %d pages, %d shards' % (len(docs), len(files)))
+
+    def _write_file(self, folder, name, data):
+
+        basename = '%s.%s.json' % (name, hashlib.sha1(data).hexdigest()[:8])
+        path = os.path.join(folder, basename)
+        if not os.path.exists(path):
+            write_atomic(path, data)
+        return basename
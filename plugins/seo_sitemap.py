@@ -0,0 +1,244 @@
+# coding=utf-8
+
+'''
+Writes the SEO sitemap as sitemap.xml, in the format of
+https://www.sitemaps.org/protocol.html, to the root of the output. This is
+used by parse-theme.py and build-server.py after Pelican has generated the
+site, because the modification dates are derived from the generated pages.
+
+The <lastmod> of a page is the date on which the hash of its content last
+changed. Only the content section of the page is hashed, after minifying
+it, so that changes to the theme or the menu, and running html_optimize.py,
+don't make every page look modified. The hashes and dates are kept in a
+manifest. Pages that are not in the manifest, which is the case for all
+pages in a fresh checkout, get the date of the last commit that changed
+their source, or its figures, listings and tables, so that the dates don't
+depend on whether the manifest was kept. This needs the full git history
+(a shallow clone gives every page the date of its only commit). Pages that
+haven't been generated are listed without a date.
+
+URLs are written to the sitemap while they are read from sitemap.yaml.
+A sitemap can contain at most 50,000 URLs and 50 MB, so if there are more,
+they are split over sitemap-1.xml, sitemap-2.xml, etc., and sitemap.xml
+becomes a sitemap index that refers to these.
+'''
+
+import os
+import re
+import glob
+import hashlib
+import datetime
+import tempfile
+import subprocess
+from xml.sax.saxutils import escape
+from inject_constants import load_manifest, save_manifest
+from html_optimize import minify
+
+DEFAULT_MANIFEST_PATH = '.cache/sitemap-lastmod.json'
+DEFAULT_SOURCE_PATH = 'content/pages'
+SITEMAP_NAME = 'sitemap.xml'
+SHARD_NAME = 'sitemap-%d.xml'
+SHARD_PATTERN = 'sitemap-*.xml'
+MAX_URLS = 50000
+# The limit is 50 MiB, and this leaves room for the closing tag
+MAX_BYTES = 50 * 1024 ** 2 - 1024
+XML_HEADER = '<?xml version="1.0" encoding="UTF-8"?>\n'
+URLSET_START = \
+    '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n'
+URLSET_END = '</urlset>\n'
+INDEX_START = \
+    '<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n'
+INDEX_END = '</sitemapindex>\n'
+CONTENT_SECTION = re.compile(r'<section id="content".*</section>', re.DOTALL)
+# A file that belongs to a page: the page itself, or a file in one of its
+# img/, lst/ or tbl/ folders (see page_paths() in cogsci-preprocess.py)
+PAGE_FILE = re.compile(r'(?:(.*)\.md|(.*)/(?:img|lst|tbl)/([^/]+)/.*)$')
+
+
+def content_hash(path):
+
+    '''Returns a hash of the content section of a generated page, or None if
+    the page doesn't exist.'''
+
+    try:
+        with open(path, encoding='utf-8', errors='surrogateescape') as fd:
+            html = fd.read()
+    except OSError:
+        return None
+    m = CONTENT_SECTION.search(html)
+    content = minify(m.group(0) if m is not None else html)
+    return hashlib.sha1(content.encode('utf-8', 'surrogateescape')
+                        ).hexdigest()
+
+
+def commit_dates(source_path):
+
+    '''Returns a dict that maps entries (paths of pages relative to
+    source_path, without extension) to the date of the last commit that
+    changed the page or its files. The dict is empty if git is not available
+    or source_path is not in a repository.'''
+
+    source_path = os.path.relpath(source_path)
+    try:
+        log = subprocess.run(
+            ['git', '-c', 'core.quotepath=off', 'log', '--format=%x00%cs',
+             '--name-only', '--relative', '--', source_path],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True,
+            check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return {}
+    dates = {}
+    date = None
+    for line in log.splitlines():
+        if line.startswith('\0'):
+            date = line[1:]
+            continue
+        if date is None or not line:
+            continue
+        m = PAGE_FILE.match(os.path.relpath(line, source_path))
+        if m is None:
+            continue
+        entry = m.group(1) or '%s/%s' % (m.group(2), m.group(3))
+        # The log starts with the most recent commit
+        dates.setdefault(entry, date)
+    return dates
+
+
+def url_entry(url, lastmod=None):
+
+    if lastmod is None:
+        return '<url><loc>%s</loc></url>\n' % escape(url)
+    return '<url><loc>%s</loc><lastmod>%s</lastmod></url>\n' % (
+        escape(url), lastmod)
+
+
+class Shard:
+
+    '''A sitemap file that is written while URLs are added, to a temporary
+    file that replaces the actual file once it is complete.'''
+
+    def __init__(self, folder, number):
+
+        self.number = number
+        self.urls = 0
+        self.size = len(XML_HEADER) + len(URLSET_START) + len(URLSET_END)
+        fd, self._tmp_path = tempfile.mkstemp(dir=folder, suffix='.tmp')
+        self._fd = os.fdopen(fd, 'w', encoding='utf-8')
+        self._fd.write(XML_HEADER + URLSET_START)
+
+    def fits(self, entry):
+
+        return self.urls < MAX_URLS and \
+            self.size + len(entry.encode('utf-8')) <= MAX_BYTES
+
+    def add(self, entry):
+
+        self._fd.write(entry)
+        self.urls += 1
+        self.size += len(entry.encode('utf-8'))
+
+    def close(self, path):
+
+        self._fd.write(URLSET_END)
+        self._fd.close()
+        os.chmod(self._tmp_path, 0o644)
+        os.replace(self._tmp_path, path)
+
+    def discard(self):
+
+        self._fd.close()
+        os.remove(self._tmp_path)
+
+
+def lastmod_dates(pages, output_path, source_path, manifest, modified,
+                  changed=None):
+
+    '''Yields (url, lastmod) tuples for (url, entry) tuples, updates the
+    manifest with the content hashes and dates, and adds the URLs of pages
+    whose content changed to modified. If changed is given, only pages whose
+    path is in it, or that are not in the manifest, are hashed.'''
+
+    today = datetime.date.today().isoformat()
+    dates = None
+    for url, entry in pages:
+        path = os.path.join(output_path, entry, 'index.html')
+        if changed is not None and url in manifest and path not in changed:
+            yield url, manifest[url]['lastmod']
+            continue
+        h = content_hash(path)
+        if h is None:
+            yield url, manifest.get(url, {}).get('lastmod')
+            continue
+        previous = manifest.get(url)
+        if previous is None:
+            # The log is only read if there are pages that need it
+            if dates is None:
+                dates = commit_dates(source_path)
+            manifest[url] = {'hash': h,
+                             'lastmod': dates.get(entry, today)}
+            modified.append(url)
+        elif previous['hash'] != h:
+            manifest[url] = {'hash': h, 'lastmod': today}
+            modified.append(url)
+        yield url, manifest[url]['lastmod']
+
+
+def write_sitemap(pages, output_path, siteurl,
+                  source_path=DEFAULT_SOURCE_PATH,
+                  manifest_path=DEFAULT_MANIFEST_PATH, changed=None):
+
+    '''Writes sitemap.xml, and if necessary its shards, to output_path. pages
+    is an iterable of (url, entry) tuples, where entry is the path of a page
+    relative to output_path, and of its source relative to source_path.
+    changed is an optional collection of generated pages that changed since
+    the last run, in which case other pages are not read. Returns the number
+    of URLs.'''
+
+    manifest = load_manifest(manifest_path)
+    modified = []
+    shards = [Shard(output_path, 1)]
+    try:
+        for url, lastmod in lastmod_dates(pages, output_path, source_path,
+                                          manifest, modified, changed):
+            entry = url_entry(url, lastmod)
+            if not shards[-1].fits(entry):
+                shards[-1].close(os.path.join(output_path,
+                                              SHARD_NAME % shards[-1].number))
+                shards.append(Shard(output_path, shards[-1].number + 1))
+            shards[-1].add(entry)
+    except BaseException:
+        shards[-1].discard()
+        raise
+    sitemap_path = os.path.join(output_path, SITEMAP_NAME)
+    if len(shards) == 1:
+        shards[0].close(sitemap_path)
+    else:
+        shards[-1].close(os.path.join(output_path,
+                                      SHARD_NAME % shards[-1].number))
+        _write_index(sitemap_path, siteurl, shards)
+    # Shards that are left over from a larger sitemap
+    written = {os.path.join(output_path, SHARD_NAME % shard.number)
+               for shard in shards} if len(shards) > 1 else set()
+    for path in glob.glob(os.path.join(output_path, SHARD_PATTERN)):
+        if path not in written:
+            os.remove(path)
+    if modified:
+        save_manifest(manifest_path, manifest)
+    urls = sum(shard.urls for shard in shards)
+    print('generated sitemap with %d urls in %d file(s), %d modified'
+          % (urls, len(shards), len(modified)))
+    return urls
+
+
+def _write_index(path, siteurl, shards):
+
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.',
+                                    suffix='.tmp')
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        f.write(XML_HEADER + INDEX_START)
+        for shard in shards:
+            f.write('<sitemap><loc>%s/%s</loc></sitemap>\n'
+                    % (escape(siteurl), SHARD_NAME % shard.number))
+        f.write(INDEX_END)
+    os.chmod(tmp_path, 0o644)
+    os.replace(tmp_path, path)
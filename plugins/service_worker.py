@@ -0,0 +1,103 @@
+# coding=utf-8
+
+'''
+Generates output/sw.js, a service worker that caches the site in the
+browser, so that the tutorials and exercises keep working offline, and
+revisits don't download everything again. This is used by parse-theme.py
+and build-server.py after fingerprint.py, because the service worker lists
+the fingerprinted theme files.
+
+The service worker is generated from themes/cogsci/service-worker.js
+(which describes the caching strategies) by filling in a precache manifest
+and a version. The manifest lists the pages in the sitemap (the same URLs
+as in sitemap.xml), the fingerprinted theme files, and the Python files
+that Brython imports from /theme/py, each with a revision: a hash of the
+file's content. The version is a hash of the manifest, so that browsers
+install a new service worker whenever a listed file changes, and only
+download the files whose revision changed. Data files and images are not
+precached, but are cached once they are used.
+
+The service worker needs to be served from the root of the site, and
+without long-lived cache headers, so that browsers notice when it changes.
+'''
+
+import os
+import json
+import hashlib
+from inject_constants import replace_constants, write_atomic, load_manifest
+from dependencies import signature
+from fingerprint import DEFAULT_MANIFEST_PATH, ASSETS_FOLDER, THEME_FOLDER, \
+    IMPORT_FOLDER, compress
+
+DEFAULT_TEMPLATE_PATH = 'themes/cogsci/service-worker.js'
+SERVICE_WORKER_NAME = 'sw.js'
+
+
+# Revisions by path, with the signature of the file, so that a process that
+# generates the service worker more than once, such as build-server.py, only
+# reads files that changed
+_revisions = {}
+
+
+def revision(path):
+
+    sig = signature(path)
+    if _revisions.get(path, (None,))[0] != sig:
+        with open(path, 'rb') as fd:
+            _revisions[path] = sig, hashlib.sha1(fd.read()).hexdigest()[:12]
+    return _revisions[path][1]
+
+
+def precache_manifest(dirname, pages, manifest_path=DEFAULT_MANIFEST_PATH):
+
+    '''Returns a list of [url, revision] lists. pages is an iterable of
+    (url, entry) tuples, where url is relative to the root of the site, and
+    entry is the path of a page relative to dirname. Pages that haven't been
+    generated are skipped.'''
+
+    manifest = []
+    for url, entry in [('/', '')] + list(pages):
+        path = os.path.join(dirname, entry, 'index.html')
+        if os.path.exists(path):
+            manifest.append([url, revision(path)])
+    # The name of a fingerprinted file is its revision
+    for relpath in sorted(load_manifest(manifest_path).get('assets',
+                                                           {}).values()):
+        manifest.append(['/%s/%s' % (ASSETS_FOLDER, relpath), ''])
+    import_path = os.path.join(dirname, THEME_FOLDER, IMPORT_FOLDER)
+    if os.path.isdir(import_path):
+        for basename in sorted(os.listdir(import_path)):
+            if basename.endswith('.py'):
+                manifest.append([
+                    '/%s/%s/%s' % (THEME_FOLDER, IMPORT_FOLDER, basename),
+                    revision(os.path.join(import_path, basename))])
+    return manifest
+
+
+def write_service_worker(dirname, pages, template_path=DEFAULT_TEMPLATE_PATH,
+                         manifest_path=DEFAULT_MANIFEST_PATH):
+
+    '''Writes sw.js to dirname, and compresses it, if it changed. Returns
+    the version.'''
+
+    manifest = precache_manifest(dirname, pages, manifest_path)
+    with open(template_path) as fd:
+        template = fd.read()
+    version = hashlib.sha1(json.dumps([template, manifest]).encode('utf-8')
+                           ).hexdigest()[:12]
+    data = replace_constants(template, {
+        'version': version,
+        'precache': json.dumps(manifest, separators=(',', ':'))
+        }).encode('utf-8')
+    path = os.path.join(dirname, SERVICE_WORKER_NAME)
+    try:
+        with open(path, 'rb') as fd:
+            changed = fd.read() != data
+    except OSError:
+        changed = True
+    if changed:
+        write_atomic(path, data)
+        compress(path, data)
+    print('generated service worker %s with %d precached files%s'
+          % (version, len(manifest), '' if changed else ' (unchanged)'))
+    return version
@@ -0,0 +1,326 @@
+# coding=utf-8
+
+'''
+The structure of the site is defined in sitemap.yaml. This module parses it
+once, and exposes everything that is derived from it: the mega menu, the live
+sitemap, the SEO sitemap, and the table of internal links. The parsed and
+compiled sitemap is cached on disk, and only parsed again when sitemap.yaml
+changes, which is first checked by modification time and size, and then by a
+hash of its contents.
+'''
+
+import os
+import pickle
+import hashlib
+import tempfile
+from collections import OrderedDict
+import yaml
+
+# Bump this when the compiled representation changes
+CACHE_VERSION = 1
+DEFAULT_PATH = 'sitemap.yaml'
+DEFAULT_CACHE_PATH = '.cache/sitemap.pickle'
+
+
+def orderedLoad(stream, Loader=getattr(yaml, 'CLoader', yaml.Loader),
+                object_pairs_hook=OrderedDict):
+
+    class OrderedLoader(Loader):
+        pass
+    def construct_mapping(loader, node):
+        loader.flatten_mapping(node)
+        return object_pairs_hook(loader.construct_pairs(node))
+    OrderedLoader.add_constructor(
+        yaml.resolver.BaseResolver.DEFAULT_MAPPING_TAG,
+        construct_mapping)
+    return yaml.load(stream, OrderedLoader)
+
+
+def isseparator(pagename):
+
+    for ch in pagename:
+        if ch != '_':
+            return False
+    return True
+
+
+def build_menu(d, root, suffix='', lvl=1):
+
+    l = []
+    for pagename, entry in d.items():
+        if isseparator(pagename):
+            l.append('</ul></li>\n<li class="col-sm-3"><ul>')
+            continue
+        if entry is None:
+            l.append('%s<li class="dropdown-header dropdown-header-level-%d">%s</li>' \
+                % ('\t'*lvl, lvl, pagename))
+            continue
+        if isinstance(entry, dict):
+            if lvl == 1:
+                l.append(
+                    ('<li class="dropdown mega-dropdown">'
+                    '<a href="#" class="dropdown-toggle level-%d" data-toggle="dropdown">'
+                    '%s&nbsp;<span class="glyphicon glyphicon-menu-down"></span></a>') \
+                    % (lvl+1, pagename))
+                l.append('<ul class="dropdown-menu mega-dropdown-menu row"><li class="col-sm-3"><ul>')
+                l.append(build_menu(entry, root, suffix, lvl+1))
+                l.append('</ul></li></ul></li>')
+            else:
+                l.append('%s<li class="dropdown-header dropdown-header-level-%d">%s</li>' \
+                    % ('\t'*(lvl+1), lvl+1, pagename))
+                l.append(build_menu(entry, root, suffix, lvl+1))
+            continue
+        if entry.startswith('http'):
+            l.append('%s<li class="level-%d"><a href="%s">%s</a></li>' \
+                % ('\t'*lvl, lvl, entry, pagename))
+        else:
+            l.append('%s<li class="level-%d"><a href="%s/%s%s">%s</a></li>' \
+                % ('\t'*lvl, lvl, root, entry, suffix, pagename))
+    return '\n'.join(l)
+
+
+def _menu_columns(d, root, suffix, lvl, columns):
+
+    for pagename, entry in d.items():
+        if isseparator(pagename):
+            columns.append([])
+        elif entry is None:
+            columns[-1].append([lvl, pagename])
+        elif isinstance(entry, dict):
+            columns[-1].append([lvl + 1, pagename])
+            _menu_columns(entry, root, suffix, lvl + 1, columns)
+        elif entry.startswith('http'):
+            columns[-1].append([lvl, pagename, entry])
+        else:
+            columns[-1].append([lvl, pagename, '%s/%s%s' % (root, entry,
+                                                            suffix)])
+    return columns
+
+
+def build_menu_data(d, root, suffix=''):
+
+    '''Returns the mega menu as compact, JSON-serializable lists, which are
+    rendered in the browser by themes/cogsci/static/js/mega-menu.js into the
+    same HTML as build_menu(). Items are [level, label] for headers,
+    [level, label, url] for links, and [1, label, columns] for dropdowns,
+    where columns is a list of lists of items.'''
+
+    items = []
+    for pagename, entry in d.items():
+        if isseparator(pagename):
+            continue
+        if entry is None:
+            items.append([1, pagename])
+        elif isinstance(entry, dict):
+            items.append([1, pagename,
+                          _menu_columns(entry, root, suffix, 2, [[]])])
+        elif entry.startswith('http'):
+            items.append([1, pagename, entry])
+        else:
+            items.append([1, pagename, '%s/%s%s' % (root, entry, suffix)])
+    return items
+
+
+def build_menu_fallback(d, root, suffix=''):
+
+    '''Returns a minimal menu for browsers without JavaScript, with one link
+    per top-level entry. Dropdowns link to their first page.'''
+
+    l = []
+    for pagename, entry in d.items():
+        if isinstance(entry, list):
+            entry = entry[0]
+        if isinstance(entry, dict):
+            pages = flatten(entry)
+            if not pages:
+                continue
+            entry = pages[0][1]
+        if isseparator(pagename) or not entry:
+            continue
+        href = entry if entry.startswith('http') \
+            else '%s/%s%s' % (root, entry, suffix)
+        l.append('<li class="level-1"><a href="%s">%s</a></li>'
+                 % (href, pagename))
+    return '\n'.join(l)
+
+
+def build_live_sitemap(d, suffix=''):
+
+    sitemap = OrderedDict()
+    for pagename, entry in d.items():
+        if isinstance(entry, list):
+            cls = entry[1]
+            entry = entry[0]
+        else:
+            cls = ''
+        if isseparator(pagename) or entry in [None, '']:
+            continue
+        if isinstance(entry, dict):
+            sitemap[pagename] = build_live_sitemap(entry, suffix)
+            continue
+        if entry.startswith('http'):
+            sitemap[pagename] = entry
+        else:
+            sitemap[pagename] = '/' + entry + suffix
+    return sitemap
+
+
+def flatten(d):
+
+    '''Returns a list of (pagename, entry) tuples for all internal pages, in
+    the order in which they appear in the sitemap.'''
+
+    pages = []
+    for pagename, entry in d.items():
+        if isinstance(entry, list):
+            entry = entry[0]
+        if isseparator(pagename) or entry in [None, '']:
+            continue
+        if isinstance(entry, dict):
+            pages += flatten(entry)
+            continue
+        if not entry.startswith('http'):
+            pages.append((pagename, entry))
+    return pages
+
+
+def process_links(pages):
+
+    '''Returns a (links, duplicate_names) tuple. links maps both the full
+    entry (e.g. basic/syntax) and its last component (e.g. syntax) to the full
+    entry, except for names that occur more than once.'''
+
+    links = {}
+    duplicate_names = []
+    for pagename, entry in pages:
+        name = entry.split('/')[-1]
+        if not name.strip():
+            continue
+        links[entry] = entry
+        if entry == name or name in duplicate_names:
+            continue
+        if name not in links:
+            links[name] = entry
+            continue
+        duplicate_names.append(name)
+        del links[name]
+        print('Duplicate name: %s' % name)
+    return links, duplicate_names
+
+
+class Sitemap:
+
+    def __init__(self, path=DEFAULT_PATH, cache_path=DEFAULT_CACHE_PATH):
+
+        self.path = path
+        self.cache_path = cache_path
+        self._menu = {}
+        self._load()
+
+    def _load(self):
+
+        st = os.stat(self.path)
+        signature = CACHE_VERSION, st.st_mtime_ns, st.st_size
+        compiled = None
+        try:
+            with open(self.cache_path, 'rb') as fd:
+                compiled = pickle.load(fd)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            pass
+        if compiled is not None and compiled['signature'] == signature:
+            self.__dict__.update(compiled['data'])
+            return
+        with open(self.path, 'rb') as fd:
+            source = fd.read()
+        digest = hashlib.sha1(source).hexdigest()
+        if compiled is None or compiled['digest'] != digest \
+                or compiled['signature'][0] != CACHE_VERSION:
+            compiled = {'digest': digest, 'data': self._compile(source)}
+        compiled['signature'] = signature
+        self.__dict__.update(compiled['data'])
+        self._save(compiled)
+
+    def _compile(self, source):
+
+        tree = orderedLoad(source.decode('utf-8'))
+        pages = flatten(tree)
+        links, duplicate_names = process_links(pages)
+        return {
+            'tree': tree,
+            'pages': pages,
+            'links': links,
+            'duplicate_names': duplicate_names,
+            'live_sitemap': build_live_sitemap(tree)
+            }
+
+    def _save(self, compiled):
+
+        folder = os.path.dirname(self.cache_path) or '.'
+        try:
+            os.makedirs(folder, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=folder, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(compiled, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self.cache_path)
+        except OSError as e:
+            print('Failed to cache sitemap: %s' % e)
+
+    def menu(self, root, suffix=''):
+
+        '''Returns the HTML for the mega menu.'''
+
+        if (root, suffix) not in self._menu:
+            self._menu[root, suffix] = build_menu(self.tree, root, suffix)
+        return self._menu[root, suffix]
+
+    def menu_data(self, root, suffix=''):
+
+        '''Returns the mega menu as data. See build_menu_data().'''
+
+        return build_menu_data(self.tree, root, suffix)
+
+    def menu_fallback(self, root, suffix=''):
+
+        return build_menu_fallback(self.tree, root, suffix)
+
+    def seo_sitemap(self, root, suffix=''):
+
+        '''Returns a list of absolute URLs of all internal pages.'''
+
+        return [url for url, entry in self.seo_pages(root, suffix)]
+
+    def sequences(self):
+
+        '''Returns a list with a list of (pagename, entry) tuples for every
+        top-level section of the sitemap, such as Python Basics, in the
+        order in which the pages are meant to be read.'''
+
+        sequences = []
+        for pagename, entry in self.tree.items():
+            pages = flatten({pagename: entry})
+            if pages:
+                sequences.append(pages)
+        return sequences
+
+    def seo_pages(self, root, suffix=''):
+
+        '''Yields (url, entry) tuples for all internal pages, in the order of
+        sitemap.yaml. See seo_sitemap.py.'''
+
+        for pagename, entry in self.pages:
+            yield root + '/' + entry + suffix, entry
+
+
+_loaded = {}
+
+
+def load(path=DEFAULT_PATH, cache_path=DEFAULT_CACHE_PATH):
+
+    '''Returns a Sitemap for path. Within a process, the same Sitemap object
+    is returned for as long as the file doesn't change.'''
+
+    st = os.stat(path)
+    signature = st.st_mtime_ns, st.st_size
+    if path not in _loaded or _loaded[path][0] != signature:
+        _loaded[path] = signature, Sitemap(path, cache_path)
+    return _loaded[path][1]
@@ -0,0 +1,224 @@
+// The service worker, from which plugins/service_worker.py generates
+// output/sw.js after every build, by filling in the version and the
+// precache manifest. The pages in the sitemap, the fingerprinted theme
+// files, and the Python files that Brython imports are cached when the
+// service worker is installed, so that the tutorials and the exercises also
+// work offline, or on a poor connection. Pages and other files are then
+// served from the cache while they are updated in the background
+// (stale-while-revalidate), and fingerprinted files and images, which never
+// change, are served from the cache without asking the server
+// (cache-first). Brython adds a ?v= query to the modules that it imports,
+// unless it is told to use the browser cache, so the query is ignored for
+// modules, which are cached under their URL without it.
+//
+// The precache manifest is a list of [url, revision] pairs. When it
+// changes, a new version of the service worker is installed. Entries whose
+// revision didn't change are copied from the previous cache, instead of
+// being downloaded again, and caches and fingerprinted files that are no
+// longer listed are removed once the new version takes over.
+
+var VERSION = '$version$';
+var PRECACHE_MANIFEST = $precache$;
+var CACHE_PREFIX = 'pythontutorials-';
+var PRECACHE = CACHE_PREFIX + 'precache-' + VERSION;
+var RUNTIME = CACHE_PREFIX + 'runtime';
+// Stored in the precache, to know which revisions it contains
+var MANIFEST_KEY = '/__precache-manifest';
+var VERSIONED_PREFIXES = ['/assets/', '/images/'];
+// The folder from which Brython imports modules
+var IMPORT_PREFIX = '/theme/py/';
+// Third-party scripts and styles, such as the Brython runtime, that the
+// pages need
+var CDN_HOSTS = ['cdn.jsdelivr.net', 'cdnjs.cloudflare.com',
+	'ajax.googleapis.com', 'fonts.googleapis.com', 'fonts.gstatic.com'];
+var MAX_RUNTIME_ENTRIES = 200;
+
+var precached = {};
+PRECACHE_MANIFEST.forEach(function (entry) {
+	precached[new URL(entry[0], self.location).href] = entry[1];
+});
+
+function is_versioned(url) {
+	var pathname = new URL(url, self.location).pathname;
+	return VERSIONED_PREFIXES.some(function (prefix) {
+		return pathname.startsWith(prefix);
+	});
+}
+
+function clean_response(response) {
+	// A navigation can't be answered with a response that was redirected,
+	// for example from /basic/syntax to /basic/syntax/
+	if (!response.redirected) return Promise.resolve(response);
+	return response.blob().then(function (body) {
+		return new Response(body, {status: response.status,
+			statusText: response.statusText, headers: response.headers});
+	});
+}
+
+function previous_revisions() {
+	return caches.keys().then(function (names) {
+		return Promise.all(names.filter(function (name) {
+			return name.startsWith(CACHE_PREFIX + 'precache-') &&
+				name != PRECACHE;
+		}).map(function (name) {
+			return caches.open(name).then(function (cache) {
+				return cache.match(MANIFEST_KEY);
+			}).then(function (response) {
+				return response === undefined ? [] : response.json();
+			}).then(function (manifest) {
+				return {name: name, manifest: manifest};
+			});
+		}));
+	});
+}
+
+function precache_entry(cache, previous, url, revision) {
+	for (var i = 0; i < previous.length; i++) {
+		var found = previous[i].manifest.some(function (entry) {
+			return entry[0] == url && entry[1] == revision;
+		});
+		if (found) {
+			return caches.open(previous[i].name).then(function (old) {
+				return old.match(url);
+			}).then(function (response) {
+				if (response === undefined) return download(cache, url);
+				return cache.put(url, response);
+			});
+		}
+	}
+	return download(cache, url);
+}
+
+function download(cache, url) {
+	return fetch(url, {credentials: 'same-origin'}).then(function (response) {
+		if (!response.ok) throw new Error(url + ': ' + response.status);
+		return clean_response(response);
+	}).then(function (response) {
+		return cache.put(url, response);
+	});
+}
+
+self.addEventListener('install', function (event) {
+	event.waitUntil(Promise.all([caches.open(PRECACHE),
+			previous_revisions()]).then(function (results) {
+		var cache = results[0], previous = results[1];
+		return Promise.all(PRECACHE_MANIFEST.map(function (entry) {
+			// A single missing file shouldn't prevent the rest from being
+			// available offline
+			return precache_entry(cache, previous, entry[0],
+				entry[1]).catch(function (error) {
+				console.log(error);
+			});
+		})).then(function () {
+			return cache.put(MANIFEST_KEY,
+				new Response(JSON.stringify(PRECACHE_MANIFEST)));
+		});
+	}).then(function () {
+		return self.skipWaiting();
+	}));
+});
+
+self.addEventListener('activate', function (event) {
+	event.waitUntil(caches.keys().then(function (names) {
+		return Promise.all(names.filter(function (name) {
+			return name.startsWith(CACHE_PREFIX) && name != PRECACHE &&
+				name != RUNTIME;
+		}).map(function (name) {
+			return caches.delete(name);
+		}));
+	}).then(function () {
+		return caches.open(RUNTIME);
+	}).then(function (cache) {
+		// Fingerprinted theme files that are no longer listed have been
+		// replaced by new versions
+		return cache.keys().then(function (requests) {
+			return Promise.all(requests.filter(function (request) {
+				return new URL(request.url).pathname.startsWith('/assets/') &&
+					!(request.url in precached);
+			}).map(function (request) {
+				return cache.delete(request);
+			}));
+		});
+	}).then(function () {
+		return self.clients.claim();
+	}));
+});
+
+function trim_runtime(cache) {
+	// Entries are listed in the order in which they were added
+	return cache.keys().then(function (requests) {
+		var excess = requests.length - MAX_RUNTIME_ENTRIES;
+		return Promise.all(requests.slice(0, Math.max(excess, 0)).map(
+			function (request) {
+				return cache.delete(request);
+			}));
+	});
+}
+
+function store(request, response) {
+	var name = request.url in precached ? PRECACHE : RUNTIME;
+	return Promise.all([caches.open(name),
+			clean_response(response)]).then(function (results) {
+		var cache = results[0];
+		return cache.put(request, results[1]).then(function () {
+			if (name == RUNTIME) return trim_runtime(cache);
+		});
+	});
+}
+
+function cacheable(response) {
+	// Responses from other origins are opaque, and their status is unknown
+	return response.ok || response.type == 'opaque';
+}
+
+function module_request(url) {
+	return new Request(url.origin + url.pathname, {credentials: 'same-origin'});
+}
+
+function stale_while_revalidate(event, request) {
+	request = request || event.request;
+	var update = fetch(request).then(function (response) {
+		if (!cacheable(response)) return response;
+		return store(request, response.clone()).then(function () {
+			return response;
+		});
+	});
+	// Without a connection, the cached response is all there is
+	event.waitUntil(update.catch(function () {}));
+	return caches.match(request, {ignoreVary: true}).then(
+		function (response) {
+			return response || update;
+		});
+}
+
+function cache_first(event) {
+	var request = event.request;
+	return caches.match(request, {ignoreVary: true}).then(
+		function (response) {
+			if (response !== undefined) return response;
+			return fetch(request).then(function (response) {
+				if (cacheable(response)) {
+					event.waitUntil(store(request, response.clone()));
+				}
+				return response;
+			});
+		});
+}
+
+self.addEventListener('fetch', function (event) {
+	var request = event.request;
+	if (request.method != 'GET') return;
+	var url = new URL(request.url);
+	if (url.origin == self.location.origin) {
+		if (is_versioned(url.href)) {
+			event.respondWith(cache_first(event));
+		} else if (url.pathname.startsWith(IMPORT_PREFIX) && url.search) {
+			event.respondWith(stale_while_revalidate(event,
+				module_request(url)));
+		} else {
+			event.respondWith(stale_while_revalidate(event));
+		}
+	} else if (CDN_HOSTS.indexOf(url.hostname) >= 0) {
+		event.respondWith(stale_while_revalidate(event));
+	}
+});
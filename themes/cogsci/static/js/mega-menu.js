@@ -0,0 +1,41 @@
+// Renders the mega menu from the JSON that is generated by build-menu.py,
+// if MENU_MODE is 'json' (see baseconf.py). The menu is then downloaded
+// once, and cached by the browser, instead of being part of every page.
+// Until it has been rendered, or if JavaScript is disabled, the menu
+// element contains a minimal menu with one link per section.
+
+function mega_menu_item(item) {
+	var level = item[0], label = item[1], target = item[2];
+	if (target === undefined) {
+		return '<li class="dropdown-header dropdown-header-level-' + level +
+			'">' + label + '</li>';
+	}
+	if (typeof target == 'string') {
+		return '<li class="level-' + level + '"><a href="' + target + '">' +
+			label + '</a></li>';
+	}
+	return '<li class="dropdown mega-dropdown">' +
+		'<a href="#" class="dropdown-toggle level-2" data-toggle="dropdown">' +
+		label + '&nbsp;<span class="glyphicon glyphicon-menu-down"></span></a>' +
+		'<ul class="dropdown-menu mega-dropdown-menu row">' +
+		target.map(function (column) {
+			return '<li class="col-sm-3"><ul>' +
+				column.map(mega_menu_item).join('') + '</ul></li>';
+		}).join('') + '</ul></li>';
+}
+
+function mega_menu_init() {
+	var menu = document.getElementById('mega-menu');
+	if (menu === null || !menu.dataset.menu) return;
+	fetch(menu.dataset.menu).then(function (response) {
+		if (!response.ok) throw new Error('Failed to load the menu');
+		return response.json();
+	}).then(function (items) {
+		menu.innerHTML = items.map(mega_menu_item).join('');
+	}).catch(function (error) {
+		// The fallback menu stays in place
+		console.log(error);
+	});
+}
+
+mega_menu_init();
@@ -0,0 +1,154 @@
+// Searches the static index that is generated by plugins/search_index.py.
+// Only the shards that contain the terms of a query are fetched, and they
+// are kept in memory for later queries.
+
+var search_index = null;
+var search_base = null;
+var search_shards = {};
+
+function search_fetch(url) {
+	return fetch(url).then(function (response) {
+		if (!response.ok) throw new Error('Failed to load ' + url);
+		return response.json();
+	});
+}
+
+function search_load(url) {
+	if (search_index === null) {
+		search_base = url.substring(0, url.lastIndexOf('/') + 1);
+		search_index = search_fetch(url).then(function (index) {
+			return search_fetch(search_base + index.docs).then(function (docs) {
+				index.docs = docs;
+				index.stopwords = new Set(index.stopwords);
+				return index;
+			});
+		});
+		// Try again on the next query if loading failed
+		search_index.catch(function () {
+			search_index = null;
+		});
+	}
+	return search_index;
+}
+
+function search_shard(index, term) {
+	var name = /^[a-z0-9]{2}/.test(term) ? term.substring(0, 2) : '_';
+	if (!(name in index.shards)) return Promise.resolve({});
+	if (!(name in search_shards)) {
+		search_shards[name] = search_fetch(search_base + index.shards[name]);
+	}
+	return search_shards[name];
+}
+
+function search_tokenize(index, text) {
+	var terms = text.toLowerCase().match(/[\p{L}\p{N}_]+/gu) || [];
+	return terms.filter(function (term) {
+		return term.length > 1 && !index.stopwords.has(term);
+	});
+}
+
+// Returns the scores of all pages that contain any of the given terms of a
+// shard, as an object that maps page numbers to scores.
+function search_scores(index, shard, matches) {
+	var scores = {};
+	matches.forEach(function (match) {
+		var postings = shard[match];
+		var idf = Math.log(1 + 2 * index.docs.length / postings.length);
+		for (var i = 0; i < postings.length; i += 2) {
+			var score = (1 + Math.log(postings[i + 1])) * idf;
+			scores[postings[i]] = Math.max(scores[postings[i]] || 0, score);
+		}
+	});
+	return scores;
+}
+
+// Returns a Promise of a list of {url, title} results, best first. Pages
+// must contain all terms of the query. Unless the query ends with a space,
+// the last term also matches longer terms, so that results appear while
+// typing. If a term occurs in a heading, the result links to the heading.
+function search(url, query, max_results) {
+	return search_load(url).then(function (index) {
+		var terms = search_tokenize(index, query);
+		var prefix = !/\s$/.test(query);
+		return Promise.all(terms.map(function (term) {
+			return search_shard(index, term);
+		})).then(function (shards) {
+			var scores = null;
+			var matched = [];
+			terms.forEach(function (term, i) {
+				var matches;
+				if (prefix && i == terms.length - 1) {
+					matches = Object.keys(shards[i]).filter(function (match) {
+						return match.startsWith(term);
+					});
+				} else {
+					matches = term in shards[i] ? [term] : [];
+				}
+				matched = matched.concat(matches);
+				var term_scores = search_scores(index, shards[i], matches);
+				if (scores === null) {
+					scores = term_scores;
+					return;
+				}
+				var combined = {};
+				for (var doc in scores) {
+					if (doc in term_scores) {
+						combined[doc] = scores[doc] + term_scores[doc];
+					}
+				}
+				scores = combined;
+			});
+			if (scores === null) return [];
+			return Object.keys(scores).sort(function (a, b) {
+				return scores[b] - scores[a];
+			}).slice(0, max_results).map(function (doc) {
+				var page = index.docs[doc];
+				var result = {url: page[0], title: page[1]};
+				var heading = page[2].find(function (heading) {
+					var words = search_tokenize(index, heading[1]);
+					return matched.some(function (match) {
+						return words.indexOf(match) >= 0;
+					});
+				});
+				if (heading) {
+					result.url += '#' + heading[0];
+					result.heading = heading[1];
+				}
+				return result;
+			});
+		});
+	});
+}
+
+function search_init() {
+	var form = document.getElementById('search-form');
+	if (form === null) return;
+	var input = form.querySelector('input');
+	var list = document.getElementById('search-results');
+	var timeout = null;
+	form.addEventListener('submit', function (event) {
+		event.preventDefault();
+	});
+	input.addEventListener('input', function () {
+		clearTimeout(timeout);
+		timeout = setTimeout(function () {
+			var query = input.value;
+			search(form.dataset.index, query, 10).then(function (results) {
+				// Ignore results for a query that has changed since
+				if (query != input.value) return;
+				list.innerHTML = '';
+				results.forEach(function (result) {
+					var item = document.createElement('li');
+					var link = document.createElement('a');
+					link.href = result.url;
+					link.textContent = result.heading ?
+						result.title + ' › ' + result.heading : result.title;
+					item.appendChild(link);
+					list.appendChild(item);
+				});
+			});
+		}, 100);
+	});
+}
+
+document.addEventListener('DOMContentLoaded', search_init);
@@ -0,0 +1,181 @@
+"""
+Runs the code of an exercise: first the prevalidation code, then the code
+that the learner wrote, and then the validation code, all in the same
+workspace. This module doesn't depend on the browser, so that it can run in
+a web worker (see exercise_worker.py), on the main thread as a fallback, or
+under CPython, for example to check exercises headlessly.
+
+The code runs with a wall-clock time limit, which is checked while it runs
+through sys.settrace(), and its output is capped. Time spent waiting for
+input() doesn't count towards the limit. Code that blocks, or that
+catches the exception that signals the time limit, can't be stopped this
+way; in the browser, the worker is then terminated by the main thread.
+"""
+
+import sys
+import time
+import builtins
+
+DEFAULT_TIMEOUT = 5
+DEFAULT_MAX_OUTPUT = 100000
+# Output is passed on once a line is complete, or when this many characters
+# are waiting
+CHUNK_SIZE = 1024
+
+
+class TimeLimitExceeded(BaseException):
+
+    # A BaseException, so that learner code with `except Exception` doesn't
+    # catch it
+    pass
+
+
+class OutputLimitExceeded(BaseException):
+
+    pass
+
+
+class BoundedOutput:
+
+    """A file-like object that keeps at most max_output characters, and
+    passes output on to a callback while it is being written."""
+
+    def __init__(self, max_output=DEFAULT_MAX_OUTPUT, on_output=None):
+        self.max_output = max_output
+        self.on_output = on_output
+        self.truncated = False
+        self._parts = []
+        self._size = 0
+        self._pending = []
+        self._pending_size = 0
+
+    def write(self, s):
+        room = self.max_output - self._size
+        if len(s) > room:
+            s = s[:room]
+            self.truncated = True
+        self._parts.append(s)
+        self._size += len(s)
+        if self.on_output is not None:
+            self._pending.append(s)
+            self._pending_size += len(s)
+            if '\n' in s or self._pending_size >= CHUNK_SIZE:
+                self.flush()
+        if self.truncated:
+            raise OutputLimitExceeded(
+                f'Output limit of {self.max_output} characters exceeded')
+        return len(s)
+
+    def flush(self):
+        if self.on_output is not None and self._pending:
+            self.on_output(''.join(self._pending))
+        self._pending = []
+        self._pending_size = 0
+
+    def getvalue(self):
+        return ''.join(self._parts)
+
+
+class Clock:
+
+    """Keeps track of the deadline, which is postponed while the code waits
+    for input()."""
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.deadline = time.time() + timeout
+        self.waiting = 0
+
+    def paused(self, fnc):
+
+        def wrapper(*args, **kwargs):
+            self.waiting += 1
+            t0 = time.time()
+            try:
+                return fnc(*args, **kwargs)
+            finally:
+                self.deadline += time.time() - t0
+                self.waiting -= 1
+
+        return wrapper
+
+    @property
+    def expired(self):
+        return not self.waiting and time.time() > self.deadline
+
+
+def _tracer(clock):
+
+    def trace(frame, event, arg):
+        if event == 'call':
+            # Without opcode events, a loop on a single line never triggers
+            # a check
+            try:
+                frame.f_trace_opcodes = True
+            except AttributeError:
+                pass
+        if clock.expired:
+            raise TimeLimitExceeded(
+                f'Time limit of {clock.timeout} s exceeded')
+        return trace
+
+    return trace
+
+
+def run(code, prevalidate=None, validate=None, timeout=DEFAULT_TIMEOUT,
+        max_output=DEFAULT_MAX_OUTPUT, on_output=None):
+
+    """Runs an exercise and returns a dict with the (stripped) output, and
+    whether the validation code considered the result correct, which is None
+    if there is no validation code. As on the main thread, exceptions in the
+    learner's code are printed to the output, and they are also described by
+    error. If a limit is exceeded, this is also printed to the output, and
+    timed_out or truncated is True."""
+
+    output = BoundedOutput(max_output, on_output)
+    workspace = {}
+    result = {'correct': None, 'timed_out': False, 'truncated': False,
+              'error': None}
+    limit_message = None
+    clock = Clock(timeout)
+    input_ = builtins.input
+    builtins.input = clock.paused(input_)
+    stdout = sys.stdout
+    sys.stdout = output
+    sys.settrace(_tracer(clock))
+    try:
+        if prevalidate is not None:
+            exec(prevalidate, workspace)
+        try:
+            exec(code, workspace)
+        except Exception as e:
+            result['error'] = f'{type(e).__name__}: {e!s}'
+            print(e)
+        # The validation code is not part of the learner's output
+        sys.stdout = stdout
+        if validate is not None:
+            exec(validate, workspace)
+            result['correct'] = bool(workspace.get('correct', False))
+    except TimeLimitExceeded as e:
+        result['timed_out'] = True
+        limit_message = str(e)
+    except OutputLimitExceeded as e:
+        result['truncated'] = True
+        limit_message = str(e)
+    except Exception as e:
+        # Errors in the prevalidation or validation code are not the
+        # learner's, so they are logged rather than printed to the output
+        sys.stdout = stdout
+        print(f'Failed to validate exercise: {e!s}')
+        result['correct'] = False
+    finally:
+        sys.settrace(None)
+        sys.stdout = stdout
+        builtins.input = input_
+        output.flush()
+    result['output'] = output.getvalue().strip()
+    if limit_message is not None:
+        result['output'] += '\n' + limit_message
+        if on_output is not None:
+            on_output('\n' + limit_message)
+    return result
@@ -0,0 +1,33 @@
+"""
+A web worker that runs exercises with exercise_runner, so that the page
+stays responsive while the learner's code runs. Jobs and results are sent
+as JSON. Output is streamed back to the main thread while the code runs.
+"""
+
+import json
+import builtins
+from browser import bind, self
+import exercise_runner
+
+
+def no_input(prompt=''):
+    # Code that calls input() runs on the main thread (see
+    # install_exercises.py), so this only happens if that wasn't detected
+    raise RuntimeError('input() is not available in this exercise')
+
+
+builtins.input = no_input
+
+
+def send_output(text):
+    self.send(json.dumps({'type': 'output', 'text': text}))
+
+
+@bind(self, 'message')
+def message(event):
+    job = json.loads(event.data)
+    result = exercise_runner.run(job['code'], job['prevalidate'],
+                                 job['validate'], job['timeout'],
+                                 job['max_output'], send_output)
+    result['type'] = 'done'
+    self.send(json.dumps(result))
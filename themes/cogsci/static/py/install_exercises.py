@@ -1,9 +1,13 @@
-import sys
-import io
+import re
 import json
 import base64
-from browser import document, html, window
+from browser import document, html, window, timer
 from browser.local_storage import storage
+try:
+    from browser import worker
+except ImportError:
+    worker = None
+import exercise_runner
 
 
 RUN_HTML = '<span class="glyphicon glyphicon-play-circle" aria-hidden="true"></span> Run'
@@ -11,26 +15,315 @@ SOLVED_HTML = '<span class="glyphicon glyphicon-ok-circle" aria-hidden="true"></
 INCORRECT_HTML = '<span class="glyphicon glyphicon-repeat" aria-hidden="true"></span> Not yet, try again!'
 ALL_SOLVED_HTML = '<span class="glyphicon glyphicon-ok-circle" aria-hidden="true"></span> All solved!'
 RESET_HTML = '<span class="glyphicon glyphicon-refresh" aria-hidden="true"></span>'
+# Exercises are mounted when they come within this distance of the viewport
+MOUNT_MARGIN = '400px 0px'
+# The id of the script element of the worker (see base.html)
+WORKER_ID = 'exercise-worker'
+# In seconds
+EXERCISE_TIMEOUT = 5
+# The time that the worker gets on top of the time limit before the main
+# thread terminates it, in seconds
+WORKER_GRACE = 2
+MAX_OUTPUT = 100000
+# Progress is stored in one record per page, under this prefix, and an index
+# record with the progress of all pages
+STORAGE_PREFIX = 'exercises:'
+INDEX_KEY = STORAGE_PREFIX + 'index'
+# Changes are written at most this often, in milliseconds
+WRITE_DELAY = 1000
+# Only the start of long outputs is stored
+MAX_STORED_OUTPUT = 2000
+# The records of the pages that were visited least recently are removed when
+# there are more than this many, or when local storage is full
+MAX_STORED_PAGES = 200
+# input() shows a prompt, which is only possible on the main thread
+USES_INPUT = re.compile(r'\binput\s*\(')
 
 
-def enc(s):
-    return base64.urlsafe_b64encode(s.encode('utf-8')).decode('utf-8')
-    
-    
 def dec(s):
+    # Exercises used to be stored base64-encoded, one key per exercise
     return base64.urlsafe_b64decode(s.encode('utf-8')).decode('utf-8')
 
 
+def read_record(key):
+    if key not in storage:
+        return {}
+    try:
+        record = json.loads(storage[key])
+    except Exception as e:
+        print(f'Failed to read {key}: {e!s}')
+        return {}
+    if not isinstance(record, dict):
+        print(f'Failed to read {key}: not a dict')
+        return {}
+    return record
+
+
+def progress_summary(exclude=None):
+    """Returns the number of solved exercises and the number of exercises
+    with progress tracking on all pages that have been visited, except for
+    the exclude page. This only reads the index record, and not the records
+    of the pages."""
+    index = read_record(INDEX_KEY)
+    pages = [info for page, info in index.items() if page != exclude]
+    return (sum(info.get('solved', 0) for info in pages),
+            sum(info.get('total', 0) for info in pages))
+
+
+class ProgressStore:
+    
+    """Keeps the code, output and solved state of the exercises on a page in
+    a single local-storage record. Changes are collected in memory, and
+    written together after WRITE_DELAY, or when the page is hidden."""
+    
+    def __init__(self, page, exercise_ids):
+        self._key = STORAGE_PREFIX + page
+        self.page = page
+        self._timer = None
+        record = read_record(self._key)
+        # Exercises that no longer exist are dropped
+        self._exercises = {id_: info
+                           for id_, info in record.get('exercises', {}).items()
+                           if id_ in exercise_ids}
+        for id_ in exercise_ids:
+            if id_ not in storage:
+                continue
+            # Records from before there was one record per page are moved
+            legacy = read_record(id_)
+            del storage[id_]
+            try:
+                self._exercises[id_] = {'code': dec(legacy.get('code', '')),
+                                        'output': dec(legacy.get('output', ''))}
+            except Exception as e:
+                print(f'Failed to restore excercise {id_}: {e!s}')
+                continue
+            if 'solved' in legacy:
+                self._exercises[id_]['solved'] = legacy['solved']
+            self.schedule()
+        self.solved = 0
+        self.total = 0
+        document.bind('visibilitychange', self._on_visibility_change)
+        window.bind('pagehide', lambda event: self.flush())
+        
+    def get(self, id_):
+        return self._exercises.get(id_, {})
+    
+    def set(self, id_, code, output, solved):
+        if len(output) > MAX_STORED_OUTPUT:
+            output = output[:MAX_STORED_OUTPUT]
+        self._exercises[id_] = {'code': code, 'output': output,
+                                'solved': solved}
+        self.schedule()
+        
+    def remove(self, id_):
+        if self._exercises.pop(id_, None) is not None:
+            self.schedule()
+            
+    def update_progress(self, solved, total):
+        self.solved = solved
+        self.total = total
+        self.schedule()
+        
+    def schedule(self):
+        if self._timer is None:
+            self._timer = timer.set_timeout(self.flush, WRITE_DELAY)
+            
+    def _on_visibility_change(self, event):
+        if document.visibilityState == 'hidden':
+            self.flush()
+            
+    def flush(self):
+        if self._timer is None:
+            return
+        timer.clear_timeout(self._timer)
+        self._timer = None
+        index = read_record(INDEX_KEY)
+        index.pop(self.page, None)
+        if self._exercises or self.total:
+            index[self.page] = {'solved': self.solved, 'total': self.total,
+                                'time': window.Date.now()}
+        record = json.dumps({'exercises': self._exercises})
+        # Pages that were visited least recently come first
+        stale = sorted((page for page in index if page != self.page),
+                       key=lambda page: index[page].get('time', 0))
+        while len(index) > MAX_STORED_PAGES and stale:
+            self._evict(index, stale.pop(0))
+        while True:
+            try:
+                if self._exercises:
+                    storage[self._key] = record
+                elif self._key in storage:
+                    del storage[self._key]
+                storage[INDEX_KEY] = json.dumps(index)
+                return
+            except Exception as e:
+                # Local storage is full, so make room and try again
+                if not stale:
+                    print(f'Failed to store progress: {e!s}')
+                    return
+                self._evict(index, stale.pop(0))
+                
+    def _evict(self, index, page):
+        print(f'Removing stored progress for {page}')
+        del index[page]
+        key = STORAGE_PREFIX + page
+        if key in storage:
+            del storage[key]
+
+
+class Runner:
+    
+    """Runs exercises one at a time in a web worker, so that the page stays
+    responsive while the code runs. The worker enforces the time and output
+    limits itself (see exercise_runner.py), but if it doesn't respond in
+    time, for example because the code catches the exception that signals
+    the time limit, it is terminated and restarted. If no worker can be
+    started, or if the code calls input(), exercises run on the main
+    thread."""
+    
+    def __init__(self):
+        self._worker = None
+        self._queue = []
+        self._current = None
+        self._timer = None
+        self.available = worker is not None \
+            and document.getElementById(WORKER_ID) is not None
+        if self.available:
+            self._start()
+        
+    def _start(self):
+        self._worker = None
+        try:
+            worker.create_worker(WORKER_ID, self._on_ready, self._on_message,
+                                 self._on_error)
+        except Exception as e:
+            print(f'Failed to start exercise worker: {e!s}')
+            self.available = False
+            self._run_queue_locally()
+        
+    def _on_ready(self, w):
+        print('Exercise worker ready')
+        self._worker = w
+        self._next()
+        
+    def _on_message(self, event):
+        message = json.loads(event.data)
+        if self._current is None:
+            return
+        job, exercise = self._current
+        if message['type'] == 'output':
+            exercise.append_output(message['text'])
+            return
+        timer.clear_timeout(self._timer)
+        self._current = None
+        try:
+            exercise.finish_run(message['output'], message['correct'])
+        finally:
+            # A failing exercise shouldn't hold up the ones after it
+            self._next()
+        
+    def _on_error(self, event):
+        print(f'Exercise worker failed: {event!s}')
+        if self._current is None:
+            # The worker itself is broken, so restarting it doesn't help
+            self.available = False
+            self._run_queue_locally()
+            return
+        self._abort('The exercise could not be run')
+        
+    def _on_timeout(self):
+        self._abort(f'Time limit of {self._current[0]["timeout"]} s exceeded')
+        
+    def _abort(self, message):
+        if self._worker is not None:
+            self._worker.terminate()
+        if self._current is not None:
+            job, exercise = self._current
+            self._current = None
+            timer.clear_timeout(self._timer)
+            exercise.finish_run(f'{exercise.output.strip()}\n{message}'.strip(),
+                                False)
+        self._start()
+        
+    def _next(self):
+        if self._current is not None or self._worker is None \
+                or not self._queue:
+            return
+        self._current = self._queue.pop(0)
+        job, exercise = self._current
+        self._worker.send(json.dumps(job))
+        self._timer = timer.set_timeout(self._on_timeout,
+                                        (job['timeout'] + WORKER_GRACE) * 1000)
+        
+    def _run_queue_locally(self):
+        while self._queue:
+            self.run_locally(*self._queue.pop(0))
+            
+    def run_locally(self, job, exercise):
+        result = exercise_runner.run(job['code'], job['prevalidate'],
+                                     job['validate'], job['timeout'],
+                                     job['max_output'])
+        exercise.finish_run(result['output'], result['correct'])
+        
+    def submit(self, job, exercise):
+        if not self.available or USES_INPUT.search(job['code']):
+            self.run_locally(job, exercise)
+            return
+        self._queue.append((job, exercise))
+        self._next()
+
+
 class Exercise:
     
+    """An exercise is mounted (i.e. its buttons and editor are created) only
+    when it comes near the viewport. Until then, its text area serves as a
+    placeholder, and its progress is taken from local storage."""
+    
     def __init__(self, exercise_manager, id_):
         
-        print(f'Installing exercise {id_}')
-        self.solved = False
         self.id = id_
+        self.mounted = False
+        self.running = False
         self._exercise_manager = exercise_manager
         self._exercise = document[id_]
         self.progress = 'no-progress' not in self._exercise.classList
+        self._is_solved = False
+        self.solved = self.stored_info().get('solved', False)
+        self._code = self._exercise.querySelector('textarea.code')
+        self._height = 100
+        for cls in self._code.classList:
+            if cls.startswith('height'):
+                self._height = int(cls[6:])
+                break
+        # Give the placeholder the size of the editor, so that the page
+        # doesn't jump when the exercise is mounted
+        self._code.style.height = f'{self._height}px'
+        self._exercise.classList.add('exercise-pending')
+        
+    @property
+    def solved(self):
+        return self._is_solved
+    
+    @solved.setter
+    def solved(self, solved):
+        if solved != self._is_solved and self.progress:
+            self._exercise_manager.solved_changed(1 if solved else -1)
+        self._is_solved = solved
+        
+    @property
+    def needs_mount(self):
+        # Exercises that were stored before the solved state was stored need
+        # to be mounted to know whether they were solved
+        info = self.stored_info()
+        return bool(info.get('output')) and 'solved' not in info
+        
+    def mount(self):
+        if self.mounted:
+            return
+        t0 = window.performance.now()
+        print(f'Installing exercise {self.id}')
+        self.mounted = True
+        self.solved = False
         self._run = html.BUTTON(RUN_HTML)
         self._run.classList.add('btn')
         self._run.classList.add('btn-default')
@@ -64,45 +357,48 @@ class Exercise:
                 self._solution_prevalidate = element.innerHTML.strip()
             elif 'solution_validate' in element.classList:
                 self._solution_validate = element.innerHTML.strip()
-            elif 'code' in element.classList:
-                self._code = element
         self._editor = window.CodeMirror.fromTextArea(self._code,
                                                       {'theme': 'monokai'})
-        self._initial_code = self.code
-        for cls in self._code.classList:
-            if cls.startswith('height'):
-                self._editor.setSize(None, int(cls[6:]))
-                break
-        else:
-            self._editor.setSize(None, 100)
+        self._initial_code = self._code.defaultValue.strip()
+        self._editor.setSize(None, self._height)
+        self._exercise.classList.remove('exercise-pending')
         self.restore()
         self._run.bind('click', self.execute)
+        window.performance.mark(f'exercise-mounted-{self.id}')
+        print(f'Installed exercise {self.id} in '
+              f'{window.performance.now() - t0:.0f} ms')
+        
+    def stored_info(self):
+        return self._exercise_manager.store.get(self.id)
         
     def restore(self):
-        if self.id not in storage:
+        exercise_info = self.stored_info()
+        if not exercise_info:
             return
-        try:
-            exercise_info = json.loads(storage[self.id])
-        except Exception as e:
-            print(f'Failed to restore excercise {self.id}: {e!s}')
-            return
-        if not isinstance(exercise_info, dict):
-            print(f'Failed to restore excercise {self.id}: not a dict')
-            return
-        self.code = dec(exercise_info.get('code', ''))
-        output = dec(exercise_info.get('output', ''))
-        if output:
+        self.code = exercise_info.get('code', '')
+        output = exercise_info.get('output', '')
+        if exercise_info.get('solved', False):
+            # The stored output may have been truncated, so it isn't checked
+            # again
+            self.output = output
+            self._output.style.display = 'block' if output else 'none'
+            self._mark_solved()
+        elif output:
             self.process_output(output)
         
     def store(self):
-        storage[self.id] = json.dumps({'code': enc(self.code),
-                                       'output': enc(self.output)})
+        self._exercise_manager.store.set(self.id, self.code, self.output,
+                                         self.solved)
         
     def validate(self, workspace):
         if self._solution_validate is None:
             return False
         print(f'Validating exercise {self.id}')
-        exec(self._solution_validate, workspace)
+        try:
+            exec(self._solution_validate, workspace)
+        except Exception as e:
+            print(f'Failed to validate exercise: {e!s}')
+            return False
         return workspace.get('correct', False)
         
     @property
@@ -123,6 +419,9 @@ class Exercise:
     
     def reset(self):
         self.solved = False
+        if not self.mounted:
+            self._exercise_manager.store.remove(self.id)
+            return
         self._solved.style.display = 'none'
         self._run.style.display = 'block'
         self._incorrect.style.display = 'none'
@@ -131,7 +430,11 @@ class Exercise:
         self.output = ''
         self.store()
     
-    def process_output(self, output, workspace={}):
+    def process_output(self, output, correct=None):
+        """Shows the output and checks whether the exercise is solved.
+        correct is the result of the validation code if the exercise was just
+        run. When restoring the output, it is None, and the validation code is
+        run in an empty workspace."""
         if not output:
             self._output.style.display = 'none'
         else:
@@ -141,40 +444,68 @@ class Exercise:
             return
         if (output.lower() in self._solution_output
             or self.code in self._solution_code
-            or self.validate(workspace)
+            or (self.validate({}) if correct is None else correct)
         ):
-            self.solved = True
-            self._solved.style.display = 'block'
-            self._incorrect.style.display = 'none'
-            self._run.style.display = 'none'
-            self._exercise_manager.update_progress()
+            self._mark_solved()
         else:
             self._incorrect.style.display = 'block'
+            
+    def _mark_solved(self):
+        self.solved = True
+        self._solved.style.display = 'block'
+        self._incorrect.style.display = 'none'
+        self._run.style.display = 'none'
+        self._exercise_manager.update_progress()
         
     def execute(self, event=None):
+        if self.running:
+            return
         print(f'Executing exercise {self.id}')
-        code = self.code
-        buffer = io.StringIO()
-        sys.stdout = buffer
-        workspace = {}
-        if self._solution_prevalidate is not None:
-            exec(self._solution_prevalidate, workspace)
-        try:
-            exec(code, workspace)
-        except Exception as e:
-            print(e)
-        sys.stdout = sys.__stdout__
-        self.process_output(buffer.getvalue().strip(), workspace)
+        self.running = True
+        self._run.disabled = True
+        self._incorrect.style.display = 'none'
+        self.output = ''
+        self._exercise_manager.runner.submit(
+            {'code': self.code,
+             'prevalidate': self._solution_prevalidate,
+             'validate': self._solution_validate,
+             'timeout': EXERCISE_TIMEOUT,
+             'max_output': MAX_OUTPUT}, self)
+        
+    def append_output(self, text):
+        """Shows output while the code is still running."""
+        self._output.textContent += text
+        self._output.style.display = 'block'
+        
+    def finish_run(self, output, correct):
+        # correct is None if the code was stopped, or if there is no
+        # validation code, and in both cases the exercise isn't solved by it
+        self.running = False
+        self._run.disabled = False
+        self.process_output(output, bool(correct))
         self.store()
 
 
 class ExerciseManager:
     
     def __init__(self):
+        self._t0 = window.performance.now()
+        self._interactive = False
         self._exercises = []
-        for element in document.getElementsByClassName('exercise'):
-            if element.id is not None:
-                self._exercises.append(Exercise(self, element.id))
+        self.runner = Runner()
+        # Progress is counted while the exercises are created, and kept up to
+        # date by solved_changed()
+        self._total_solved = 0
+        elements = [element for element in
+                    document.getElementsByClassName('exercise')
+                    if element.id is not None]
+        self.store = ProgressStore(window.location.pathname,
+                                   [element.id for element in elements])
+        for element in elements:
+            self._exercises.append(Exercise(self, element.id))
+        self._total_progress = sum(e.progress for e in self._exercises)
+        window.exercise_progress_summary = progress_summary
+        self._by_id = {e.id: e for e in self._exercises}
         if self.total_progress:
             self._progress = html.DIV()
             self._progress.classList.add('exercises_progress')
@@ -183,21 +514,71 @@ class ExerciseManager:
             self._reset.bind('click', self.reset)
             self._reset.classList.add('exercises_reset')
             document <= self._reset
-            self.update_progress()
         else:
             self._progress = None
+        for e in self._exercises:
+            if e.needs_mount:
+                e.mount()
+        if hasattr(window, 'IntersectionObserver'):
+            # The observer reports all exercises once when it starts, so the
+            # first call of on_intersect() marks the page as interactive
+            self._observer = window.IntersectionObserver.new(
+                self.on_intersect, {'rootMargin': MOUNT_MARGIN})
+            for e in self._exercises:
+                if not e.mounted:
+                    self._observer.observe(e._exercise)
+            # Without anything to observe, the observer never reports
+            if all(e.mounted for e in self._exercises):
+                self.report_interactive()
+        else:
+            for e in self._exercises:
+                e.mount()
+            self.report_interactive()
+        self.update_progress()
+        
+    def on_intersect(self, entries, observer):
+        for entry in entries:
+            if not entry.isIntersecting:
+                continue
+            observer.unobserve(entry.target)
+            self._by_id[entry.target.id].mount()
+        self.update_progress()
+        self.report_interactive()
+        
+    def report_interactive(self):
+        """Reports the time from the start of navigation until the exercises
+        that are initially in view can be used, as a performance mark, and as
+        an exercises-interactive event on the window, so that it can be
+        collected by analytics."""
+        if self._interactive:
+            return
+        self._interactive = True
+        now = window.performance.now()
+        window.performance.mark('exercises-interactive')
+        detail = {'page': window.location.pathname,
+                  'time_to_interactive': now,
+                  'setup_time': now - self._t0,
+                  'mounted': sum(e.mounted for e in self._exercises),
+                  'total': len(self._exercises)}
+        print(f'Exercises interactive after {now:.0f} ms '
+              f'({detail["mounted"]} of {detail["total"]} mounted)')
+        window.dispatchEvent(window.CustomEvent.new(
+            'exercises-interactive', {'detail': detail}))
     
     @property
     def total_progress(self):
-        return sum(e.progress for e in self._exercises)
+        return self._total_progress
         
     @property
     def total_solved(self):
-        return sum(e.solved for e in self._exercises if e.progress)
+        return self._total_solved
         
     @property
     def all_solved(self):
-        return all(e.solved for e in self._exercises if e.progress)
+        return self._total_solved == self._total_progress
+    
+    def solved_changed(self, delta):
+        self._total_solved += delta
         
     def reset(self, event):
         for e in self._exercises:
@@ -208,10 +589,17 @@ class ExerciseManager:
         if not self.total_progress:
             return
         print('Updating progress')
+        self.store.update_progress(self.total_solved, self.total_progress)
+        site_solved, site_total = progress_summary(exclude=self.store.page)
+        self._progress.title = \
+            f'{site_solved + self.total_solved} of ' \
+            f'{site_total + self.total_progress} exercises solved on all ' \
+            f'pages that you visited'
         if self.all_solved:
             self._progress.classList.add('all_solved')
             self._progress.html = ALL_SOLVED_HTML
         else:
+            self._progress.classList.remove('all_solved')
             self._progress.html = \
                 f'{self.total_solved} / {self.total_progress}<br /><small>solved</small>'
 
@@ -0,0 +1,363 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+"""
+Checks that the reference solutions of the exercises still work, for
+example after a new release of NumPy or DataMatrix, without clicking
+through every page. The following are extracted from content/pages:
+
+- Mini exercises: the `.exercise` blocks in the pages. If such a block has
+  solution_code, this is run with the solution_prevalidate and
+  solution_validate code, in the same way as in the browser (see
+  themes/cogsci/static/py/exercise_runner.py). The solution passes if its
+  output matches one of the solution_output blocks, or if the validation
+  code considers it correct. Blocks without solution_code can't be run, but
+  their prevalidation and validation code is checked for syntax errors.
+- Solutions: the Python code blocks of the *-solution pages. These pass if
+  they run without errors. If the code asks for input, the answers are
+  taken from the __Output:__ block that follows it.
+
+Every solution runs in a separate process, with a time limit, from the
+root of the repository, so that data files are found. Results are cached by
+a hash of the code, the data files that it refers to, and the installed
+packages, so that only solutions that are affected by a change run again.
+
+    python3 validate-exercises.py
+    # Only pages whose path contains numerical, and run everything again
+    python3 validate-exercises.py numerical --force
+
+The exit status is 1 if a solution failed.
+"""
+
+import os
+import re
+import sys
+import json
+import html
+import time
+import hashlib
+import argparse
+import builtins
+import subprocess
+import importlib.metadata
+from concurrent.futures import ThreadPoolExecutor
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'plugins'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'themes', 'cogsci', 'static', 'py'))
+from inject_constants import load_manifest, save_manifest
+import exercise_runner
+
+# Bump this when the way in which solutions are run changes
+VERSION = 1
+CONTENT_PATH = 'content/pages'
+DATA_PATH = 'data'
+CACHE_PATH = '.cache/exercises.json'
+DEFAULT_TIMEOUT = 30
+# The time that a process gets on top of the time limit before it is killed
+KILL_GRACE = 5
+EXERCISE_START = re.compile(r'<div\s[^>]*class="exercise"[^>]*>')
+DIV_TAG = re.compile(r'<(/?)div\b[^>]*>')
+EXERCISE_ID = re.compile(r'\bid="([^"]+)"')
+SOLUTION_BLOCK = re.compile(
+    r'<div\s[^>]*class="solution_(\w+)"[^>]*>(.*?)</div>', re.DOTALL)
+FENCE = re.compile(
+    r'^(```|~~~)[ \t]*\{?[ \t]*\.?([\w-]*)[^\n]*\n(.*?)^\1[ \t]*$',
+    re.DOTALL | re.MULTILINE)
+OUTPUT_LABEL = re.compile(r'\A\s*__Output:__\s*\Z')
+DATA_FILE = re.compile(r'''['"](?:\./)?(%s/[^'"]+)['"]''' % DATA_PATH)
+
+
+class ScriptedInput:
+
+    """Replaces input() with answers that are taken from an example of the
+    output, in which every prompt is followed by what the user typed."""
+
+    def __init__(self, transcript):
+        self._lines = transcript.splitlines() if transcript else []
+        self.exhausted = False
+
+    def __call__(self, prompt=''):
+        prompt = str(prompt)
+        while self._lines:
+            line = self._lines.pop(0)
+            if prompt and line.startswith(prompt):
+                answer = line[len(prompt):]
+                print(prompt + answer)
+                return answer
+        self.exhausted = True
+        raise EOFError('no scripted input left')
+
+
+def exercise_blocks(text):
+
+    """Yields the id and the content of every exercise block. Blocks contain
+    nested divs, so the end is found by counting div tags."""
+
+    for start in EXERCISE_START.finditer(text):
+        depth = 0
+        for tag in DIV_TAG.finditer(text, start.start()):
+            depth += -1 if tag.group(1) else 1
+            if not depth:
+                break
+        m = EXERCISE_ID.search(start.group(0))
+        yield (m.group(1) if m else 'exercise at line %d'
+               % (text.count('\n', 0, start.start()) + 1),
+               text[start.end():tag.start()])
+
+
+def extract_exercises(path, text):
+
+    """Extracts mini exercises in the same way as Exercise.mount() in
+    install_exercises.py."""
+
+    for exercise_id, block in exercise_blocks(text):
+        exercise = {'path': path, 'name': exercise_id, 'kind': 'exercise',
+                    'code': [], 'output': [], 'prevalidate': None,
+                    'validate': None}
+        for kind, content in SOLUTION_BLOCK.findall(block):
+            content = html.unescape(content).strip()
+            if kind == 'code':
+                exercise['code'].append('\n'.join(
+                    line for line in content.splitlines()
+                    if line.strip() and not line.strip().startswith('#')))
+            elif kind == 'output':
+                exercise['output'].append(content.lower())
+            elif kind in ('prevalidate', 'validate'):
+                exercise[kind] = content
+        yield exercise
+
+
+def extract_solutions(path, text):
+
+    """Extracts the Python code blocks from a solution page, each with the
+    example output that follows it, if any."""
+
+    fences = list(FENCE.finditer(text))
+    for i, fence in enumerate(fences):
+        if fence.group(2) != 'python':
+            continue
+        transcript = None
+        if i + 1 < len(fences) and OUTPUT_LABEL.match(
+                text[fence.end():fences[i + 1].start()]):
+            transcript = fences[i + 1].group(3)
+        yield {'path': path, 'name': 'solution %d' % (i + 1),
+               'kind': 'solution', 'code': [fence.group(3)],
+               'transcript': transcript}
+
+
+def collect(filters):
+
+    exercises = []
+    for dirpath, dirnames, filenames in os.walk(CONTENT_PATH):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            path = os.path.join(dirpath, filename)
+            if not filename.endswith('.md') \
+                    or not all(f in path for f in filters):
+                continue
+            with open(path) as fd:
+                text = fd.read()
+            exercises += extract_exercises(path, text)
+            if '-solution' in filename:
+                exercises += extract_solutions(path, text)
+    return exercises
+
+
+def environment_digest():
+
+    """A hash of the Python version and of all installed packages, so that
+    cached results are discarded when any of them changes."""
+
+    packages = sorted('%s==%s' % (dist.metadata['Name'], dist.version)
+                      for dist in importlib.metadata.distributions())
+    return hashlib.sha1(
+        json.dumps([sys.version, packages]).encode('utf-8')).hexdigest()
+
+
+def data_digest(code):
+
+    h = hashlib.sha1()
+    for path in sorted(set(DATA_FILE.findall(code))):
+        h.update(path.encode('utf-8'))
+        try:
+            with open(path, 'rb') as fd:
+                h.update(fd.read())
+        except OSError:
+            pass
+    return h.hexdigest()
+
+
+def job_key(job, environment):
+
+    return hashlib.sha1(json.dumps(
+        [VERSION, environment, data_digest(job['code']), job],
+        sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def run_job(job):
+
+    """Runs a single job in the current process, and returns a dict with the
+    status (passed, failed or skipped) and a message. This is what the
+    processes that are started by run_isolated() do."""
+
+    scripted_input = ScriptedInput(job.get('transcript'))
+    builtins.input = scripted_input
+    t0 = time.time()
+    result = exercise_runner.run(job['code'], job.get('prevalidate'),
+                                 job.get('validate'), job['timeout'])
+    duration = time.time() - t0
+    if result['timed_out']:
+        return {'status': 'failed', 'duration': duration,
+                'message': 'time limit of %s s exceeded' % job['timeout']}
+    if result['truncated']:
+        return {'status': 'failed', 'duration': duration,
+                'message': 'output limit exceeded'}
+    if result['error'] is not None:
+        if scripted_input.exhausted:
+            return {'status': 'skipped', 'duration': duration,
+                    'message': 'asks for input that the page does not show'}
+        return {'status': 'failed', 'duration': duration,
+                'message': result['error']}
+    if result['correct'] is False:
+        return {'status': 'failed', 'duration': duration,
+                'message': 'validation code says incorrect'}
+    expected = job.get('output', [])
+    # As in Exercise.process_output(), either the output or the validation
+    # code needs to be right
+    if expected and not result['correct'] \
+            and result['output'].lower() not in expected:
+        return {'status': 'failed', 'duration': duration,
+                'message': 'unexpected output: %r' % result['output'][:200]}
+    return {'status': 'passed', 'duration': duration, 'message': ''}
+
+
+def run_isolated(job):
+
+    """Runs a job in a new Python process, which is killed if it doesn't
+    finish in time, for example because the code blocks."""
+
+    env = dict(os.environ, MPLBACKEND='Agg')
+    try:
+        process = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--run-job'],
+            input=json.dumps(job), capture_output=True, text=True,
+            timeout=job['timeout'] + KILL_GRACE, env=env)
+    except subprocess.TimeoutExpired:
+        return {'status': 'failed', 'duration': job['timeout'],
+                'message': 'killed after %s s' % job['timeout']}
+    # The result is the last line of the output, after anything that the
+    # code printed outside of sys.stdout
+    lines = process.stdout.strip().splitlines()
+    try:
+        return json.loads(lines[-1])
+    except (IndexError, ValueError):
+        return {'status': 'failed', 'duration': 0,
+                'message': (process.stderr.strip().splitlines() or
+                            ['process exited with %d' % process.returncode])[-1]}
+
+
+def check_syntax(exercise):
+
+    for kind in ('prevalidate', 'validate'):
+        if exercise[kind] is None:
+            continue
+        try:
+            compile(exercise[kind], kind, 'exec')
+        except SyntaxError as e:
+            return 'syntax error in %s code: %s' % (kind, e)
+    return None
+
+
+def plan(exercise, timeout):
+
+    """Returns the jobs for an exercise, or a result if it can't be run."""
+
+    error = check_syntax(exercise) if exercise['kind'] == 'exercise' \
+        else None
+    if error is not None:
+        return [], {'status': 'failed', 'duration': 0, 'message': error}
+    if not exercise['code']:
+        return [], {'status': 'skipped', 'duration': 0,
+                    'message': 'no reference solution'}
+    jobs = []
+    for code in exercise['code']:
+        job = {'code': code, 'timeout': timeout}
+        if exercise['kind'] == 'exercise':
+            job.update(prevalidate=exercise['prevalidate'],
+                       validate=exercise['validate'],
+                       output=exercise['output'])
+        else:
+            job['transcript'] = exercise['transcript']
+        jobs.append(job)
+    return jobs, None
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description='Checks the reference solutions of the exercises')
+    parser.add_argument('filters', nargs='*',
+                        help='Only check pages whose path contains these')
+    parser.add_argument('--timeout', type=float, default=DEFAULT_TIMEOUT,
+                        help='The time limit per solution in seconds')
+    parser.add_argument('--processes', type=int, default=os.cpu_count())
+    parser.add_argument('--force', action='store_true',
+                        help='Ignore cached results')
+    parser.add_argument('--verbose', action='store_true',
+                        help='Also list solutions that passed')
+    parser.add_argument('--run-job', action='store_true',
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.run_job:
+        result = run_job(json.load(sys.stdin))
+        sys.stdout.write('\n' + json.dumps(result) + '\n')
+        return
+    t0 = time.time()
+    exercises = collect(args.filters)
+    environment = environment_digest()
+    cache = load_manifest(CACHE_PATH)
+    results = {}
+    pending = {}
+    cached = 0
+    for i, exercise in enumerate(exercises):
+        jobs, result = plan(exercise, args.timeout)
+        if result is not None:
+            results[i] = [result]
+            continue
+        results[i] = []
+        for job in jobs:
+            key = job_key(job, environment)
+            if key in cache and not args.force:
+                results[i].append(cache[key])
+                cached += 1
+            else:
+                pending.setdefault(key, (job, []))[1].append(i)
+    print('Running %d solutions (%d cached)' % (len(pending), cached))
+    with ThreadPoolExecutor(max(1, args.processes)) as executor:
+        keys = list(pending)
+        for key, result in zip(keys, executor.map(
+                lambda key: run_isolated(pending[key][0]), keys)):
+            # Failures are not cached, so that they are checked again
+            if result['status'] != 'failed':
+                cache[key] = result
+            for i in pending[key][1]:
+                results[i].append(result)
+    save_manifest(CACHE_PATH, cache)
+    counts = {'passed': 0, 'failed': 0, 'skipped': 0}
+    for i, exercise in enumerate(exercises):
+        for result in results[i]:
+            counts[result['status']] += 1
+            if result['status'] == 'passed' and not args.verbose:
+                continue
+            print('%-7s %s: %s%s' % (
+                result['status'], exercise['path'], exercise['name'],
+                ' (%s)' % result['message'] if result['message'] else ''))
+    print('%(passed)d passed, %(failed)d failed, %(skipped)d skipped'
+          % counts + ' in %.1f s' % (time.time() - t0))
+    if counts['failed']:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()